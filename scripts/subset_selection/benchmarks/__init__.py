@@ -0,0 +1,5 @@
+"""
+CPU-only end-to-end benchmarks of subset selection on synthetic data.
+
+Run ``python -m scripts.subset_selection.benchmarks.run_benchmark --help``.
+"""
@@ -0,0 +1,177 @@
+"""
+Check the native facility location optimizers against submodlib on a fixture.
+
+A small clustered set of unit vectors is turned into the same additive cosine
+kernel the pipeline builds for a fold, and every optimizer is run with both
+backends. ``NaiveGreedy`` and ``LazyGreedy`` are deterministic and must select
+the same items in the same order. ``LazierThanLazyGreedy`` samples with a
+different random generator in each backend, so only its objective value is
+compared, within ``--tolerance``; with ``epsilon`` at least the fold size it
+samples every item and must match ``LazyGreedy`` exactly.
+
+Example:
+    python -m scripts.subset_selection.benchmarks.compare_optimizers \\
+        --rows 500 --budget 50 --epsilons 0.1,0.5,160
+"""
+
+# Standard
+from typing import List, Optional, Tuple
+import argparse
+import logging
+import sys
+
+# Third Party
+from submodlib import FacilityLocationFunction
+import numpy as np
+import torch
+
+# Local
+from ..utils.facility_location import FacilityLocation
+from ..utils.subset_selection_utils import compute_pairwise_dense_streaming
+
+logger = logging.getLogger(__name__)
+
+
+def make_fixture(rows: int, dimension: int, num_clusters: int, seed: int) -> np.ndarray:
+    """Generate clustered unit vectors of shape (rows, dimension)."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dimension))
+    embeddings = centers[rng.integers(num_clusters, size=rows)]
+    embeddings = embeddings + 0.5 * rng.standard_normal((rows, dimension))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings.astype(np.float32)
+
+
+def run_submodlib(
+    kernel: np.ndarray, budget: int, optimizer: str, epsilon: float
+) -> List[Tuple[int, float]]:
+    """Maximize with submodlib, configured as in the pipeline."""
+    function = FacilityLocationFunction(
+        n=kernel.shape[0], sijs=kernel, mode="dense", separate_rep=False
+    )
+    return function.maximize(
+        budget=budget,
+        optimizer=optimizer,
+        epsilon=epsilon,
+        stopIfZeroGain=False,
+        stopIfNegativeGain=False,
+        verbose=False,
+        show_progress=False,
+    )
+
+
+def run_native(
+    kernel: np.ndarray, budget: int, optimizer: str, epsilon: float, seed: int
+) -> List[Tuple[int, float]]:
+    """Maximize with the native optimizer, configured as in the pipeline."""
+    function = FacilityLocation(torch.from_numpy(kernel), symmetric=True)
+    return function.maximize(
+        budget=budget, optimizer=optimizer, epsilon=epsilon, seed=seed
+    )
+
+
+def compare(
+    kernel: np.ndarray,
+    budget: int,
+    optimizer: str,
+    epsilon: float,
+    tolerance: float,
+    seed: int,
+    exact: bool,
+) -> bool:
+    """
+    Compare both backends for one optimizer setting and log the outcome.
+
+    Returns:
+        bool: Whether the backends agree, on the selection if ``exact`` and on
+        the objective value otherwise.
+    """
+    expected = run_submodlib(kernel, budget, optimizer, epsilon)
+    selected = run_native(kernel, budget, optimizer, epsilon, seed)
+    expected_value = sum(gain for _, gain in expected)
+    value = sum(gain for _, gain in selected)
+    relative_gap = (expected_value - value) / expected_value
+
+    if exact:
+        same_items = [item for item, _ in expected] == [item for item, _ in selected]
+        passed = same_items and abs(relative_gap) <= 1e-4
+    else:
+        passed = relative_gap <= tolerance
+    logger.info(
+        f"{'ok  ' if passed else 'FAIL'} {optimizer:<20} epsilon={epsilon:<8g} "
+        f"submodlib={expected_value:.4f} native={value:.4f} "
+        f"gap={relative_gap:+.2%}"
+    )
+    return passed
+
+
+def _float_list(value: str) -> List[float]:
+    return [float(v) for v in value.split(",")]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the comparison and exit with status 1 if any setting disagrees."""
+    parser = argparse.ArgumentParser(
+        description="Compare native facility location optimizers with submodlib"
+    )
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--dimension", type=int, default=32)
+    parser.add_argument("--num-clusters", type=int, default=20)
+    parser.add_argument("--budget", type=int, default=50)
+    parser.add_argument(
+        "--epsilons",
+        type=_float_list,
+        default=[0.1, 0.5, 160.0],
+        help="LazierThanLazyGreedy epsilons compared by objective value",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.02,
+        help="Largest relative shortfall of the native LazierThanLazyGreedy "
+        "objective value",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    embeddings = make_fixture(args.rows, args.dimension, args.num_clusters, args.seed)
+    kernel = compute_pairwise_dense_streaming(
+        torch.from_numpy(embeddings),
+        metric="cosine",
+        device="cpu",
+        scaling="additive",
+    )
+
+    results = [
+        compare(kernel, args.budget, "NaiveGreedy", 0.1, 0, args.seed, exact=True),
+        compare(kernel, args.budget, "LazyGreedy", 0.1, 0, args.seed, exact=True),
+        # Sampling every item reduces it to lazy greedy in both backends
+        compare(
+            kernel,
+            args.budget,
+            "LazierThanLazyGreedy",
+            float(args.rows),
+            0,
+            args.seed,
+            exact=True,
+        ),
+    ]
+    for epsilon in args.epsilons:
+        results.append(
+            compare(
+                kernel,
+                args.budget,
+                "LazierThanLazyGreedy",
+                epsilon,
+                args.tolerance,
+                args.seed,
+                exact=False,
+            )
+        )
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""
+End-to-end benchmark of ``subset_datasets`` on synthetic data, on CPU only.
+
+Every configuration of the parameter grid runs in a fresh process: a synthetic
+conversation dataset is written to disk, a stub encoder maps every row to a
+precomputed clustered embedding, and the full pipeline is run in testing mode.
+The stage timings the pipeline reports through its metrics hook and the peak
+resident set size are written to a JSON report, which can be compared with the
+report of another commit.
+
+Example:
+    python -m scripts.subset_selection.benchmarks.run_benchmark \\
+        --rows 10000,100000 --num-folds 10,50 --output report.json
+"""
+
+# Standard
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# Third Party
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Per-fold metrics of the pipeline summed over folds, by worker stage
+FOLD_STAGES = {
+    "fold_similarity_seconds": "similarity",
+    "fold_maximize_seconds": "maximize",
+}
+
+STUB_ENCODER = "benchmark_stub"
+_SAMPLE_ID = re.compile(r"sample (\d+)")
+_WORDS = ("alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta")
+
+# Set in the benchmark process and inherited by its forked workers
+_EMBEDDINGS: Optional[np.ndarray] = None
+_TIMINGS_DIR: Optional[str] = None
+
+# Metrics of the run, collected by _collect_metric in the benchmark process
+_stages: Dict[str, float] = defaultdict(float)
+_worker_stages: Dict[str, float] = defaultdict(float)
+
+
+class StubEncoder:
+    """Encoder returning the precomputed synthetic embedding of every sample."""
+
+    def __init__(self, **kwargs: Any) -> None:
+        """Accept and ignore the arguments of a real encoder."""
+        self.encode_seconds = 0.0
+        self.timings_file = os.path.join(_TIMINGS_DIR, f"{uuid.uuid4().hex}.json")
+
+    def encode(self, inputs: List[str], instruction: str = "", **kwargs: Any):
+        """
+        Look up the embeddings of the sample ids in the rendered texts.
+
+        The encoding workers are not visible to the pipeline's metrics, so every
+        encoder persists its own total encoding time to the timings directory.
+        """
+        # Third Party
+        # pylint: disable=import-outside-toplevel
+        import torch
+
+        start = time.perf_counter()
+        ids = [int(_SAMPLE_ID.search(text).group(1)) for text in inputs]
+        embeddings = torch.from_numpy(_EMBEDDINGS[ids])
+        self.encode_seconds += time.perf_counter() - start
+
+        with open(f"{self.timings_file}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.encode_seconds, f)
+        os.replace(f"{self.timings_file}.tmp", self.timings_file)
+        return embeddings
+
+
+def _collect_metric(name: str, value: float, labels: Dict[str, str]) -> None:
+    """Metrics hook of the pipeline, summing stage and fold timings."""
+    if name == "stage_seconds":
+        _stages[labels["stage"]] += value
+    elif name in FOLD_STAGES:
+        _worker_stages[FOLD_STAGES[name]] += value
+
+
+def make_synthetic_data(
+    data_file: str,
+    num_rows: int,
+    dimension: int,
+    num_clusters: int = 100,
+    duplicate_fraction: float = 0.0,
+    text_words: int = 64,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Write a synthetic conversation dataset and return the embeddings of its samples.
+
+    Embeddings are unit-norm points scattered around ``num_clusters`` random
+    centres. A ``duplicate_fraction`` of the rows repeat an earlier row exactly.
+
+    Args:
+        data_file (str): Path of the ``.jsonl`` file to write.
+        num_rows (int): Number of rows.
+        dimension (int): Embedding dimension.
+        num_clusters (int): Number of embedding clusters.
+        duplicate_fraction (float): Fraction of rows that duplicate an earlier row.
+        text_words (int): Number of words of every assistant message.
+        seed (int): Seed of the generated data.
+
+    Returns:
+        np.ndarray: float32 embeddings of shape (num_rows, dimension), indexed by
+        the sample id in the rendered text.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((num_clusters, dimension), dtype=np.float32)
+    embeddings = centres[rng.integers(num_clusters, size=num_rows)]
+    embeddings += 0.5 * rng.standard_normal((num_rows, dimension), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    # Every duplicate copies a random earlier row
+    sample_ids = np.arange(num_rows)
+    duplicates = np.flatnonzero(rng.random(num_rows) < duplicate_fraction)
+    duplicates = duplicates[duplicates > 0]
+    for row, source in zip(duplicates, rng.integers(duplicates), strict=True):
+        sample_ids[row] = sample_ids[source]
+
+    word_ids = rng.integers(len(_WORDS), size=(num_rows, text_words), dtype=np.uint8)
+    with open(data_file, "w", encoding="utf-8") as f:
+        for sample_id in sample_ids:
+            answer = " ".join(_WORDS[i] for i in word_ids[sample_id])
+            row = {
+                "messages": [
+                    {"role": "user", "content": f"Tell me about sample {sample_id}"},
+                    {"role": "assistant", "content": answer},
+                ]
+            }
+            f.write(json.dumps(row) + "\n")
+    return embeddings
+
+
+def run_configuration(params: Dict[str, Any], work_dir: str) -> Dict[str, Any]:
+    """
+    Run the pipeline once and measure it. Meant to run in a fresh process.
+
+    Args:
+        params (Dict[str, Any]): Parameters of the configuration.
+        work_dir (str): Empty directory for the data and the outputs.
+
+    Returns:
+        Dict[str, Any]: Stage timings in seconds and peak memory in MB.
+    """
+    global _EMBEDDINGS, _TIMINGS_DIR  # pylint: disable=global-statement
+    # Keep the datasets cache of the benchmark out of the user's cache
+    os.environ["HF_DATASETS_CACHE"] = os.path.join(work_dir, "hf_cache")
+    # Local
+    # pylint: disable=import-outside-toplevel
+    from .. import subset_datasets
+    from ..encoders import ENCODER_REGISTRY
+
+    ENCODER_REGISTRY[STUB_ENCODER] = StubEncoder
+    _TIMINGS_DIR = os.path.join(work_dir, "timings")
+    os.makedirs(_TIMINGS_DIR)
+
+    data_file = os.path.join(work_dir, "data.jsonl")
+    _EMBEDDINGS = make_synthetic_data(
+        data_file,
+        params["rows"],
+        params["dimension"],
+        duplicate_fraction=params["duplicate_fraction"],
+        seed=params["seed"],
+    )
+    subset_sizes = [round(0.1 * (i + 1), 1) for i in range(params["num_sizes"])]
+
+    start = time.perf_counter()
+    subset_datasets(
+        [data_file],
+        subset_sizes,
+        testing_mode=True,
+        output_dir=os.path.join(work_dir, "output"),
+        num_folds=params["num_folds"],
+        epsilon=params["epsilon"],
+        encoder_type=STUB_ENCODER,
+        seed=params["seed"],
+        metrics_hook=_collect_metric,
+        **params["options"],
+    )
+    total = time.perf_counter() - start
+
+    # Every encoder instance has its own file
+    for name in os.listdir(_TIMINGS_DIR):
+        if name.endswith(".json"):
+            with open(os.path.join(_TIMINGS_DIR, name), encoding="utf-8") as f:
+                _worker_stages["encode"] += json.load(f)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "total_seconds": total,
+        "stages": dict(_stages),
+        "worker_stages": {
+            stage: _worker_stages[stage]
+            for stage in ("encode", *FOLD_STAGES.values())
+        },
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        * scale
+        / 2**20,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        * scale
+        / 2**20,
+    }
+
+
+def _run_configuration_to_file(
+    params: Dict[str, Any], work_dir: str, result_file: str, verbose: bool
+) -> None:
+    """Process entry point writing the result of run_configuration to a file."""
+    if not verbose:
+        logging.disable(logging.WARNING)
+    # A spawned process defaults to spawning its own workers, while the pipeline
+    # relies on forked workers inheriting the module state
+    multiprocessing.set_start_method("fork", force=True)
+    result = run_configuration(params, work_dir)
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+def _environment() -> Dict[str, Any]:
+    """Describe the machine and the code the benchmark ran on."""
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=False,
+    ).stdout.strip()
+    return {
+        "git_commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _run_key(params: Dict[str, Any]) -> str:
+    """Key matching the same configuration across reports."""
+    return json.dumps(params, sort_keys=True)
+
+
+def compare_reports(baseline: Dict[str, Any], report: Dict[str, Any]) -> None:
+    """Print the change of every timing between two reports, per configuration."""
+    baseline_runs = {_run_key(run["params"]): run for run in baseline["runs"]}
+    for run in report["runs"]:
+        old = baseline_runs.get(_run_key(run["params"]))
+        if old is None or "error" in run or "error" in old:
+            continue
+        print(f"\n{_run_key(run['params'])}")
+        print(f"  {'':<16}{'baseline':>12}{'current':>12}")
+        rows = [("total", old["total_seconds"], run["total_seconds"])]
+        for group in ("stages", "worker_stages"):
+            rows += [
+                (stage, old[group].get(stage, 0.0), seconds)
+                for stage, seconds in run[group].items()
+            ]
+        rows.append(("peak_rss_mb", old["peak_rss_mb"], run["peak_rss_mb"]))
+        for name, before, after in rows:
+            ratio = f"{after / before:6.2f}x" if before > 0 else "      -"
+            print(f"  {name:<16}{before:12.3f}{after:12.3f}  {ratio}")
+
+
+def _int_list(value: str) -> List[int]:
+    """Parse a comma-separated list of integers."""
+    return [int(item) for item in value.split(",")]
+
+
+def _float_list(value: str) -> List[float]:
+    """Parse a comma-separated list of floats."""
+    return [float(item) for item in value.split(",")]
+
+
+def _option(value: str) -> tuple:
+    """Parse a KEY=VALUE option, with VALUE parsed as JSON if possible."""
+    key, _, raw = value.partition("=")
+    try:
+        return key, json.loads(raw)
+    except json.JSONDecodeError:
+        return key, raw
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the benchmark grid and write the JSON report."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark subset selection end to end on synthetic data (CPU only)"
+    )
+    parser.add_argument("--rows", type=_int_list, default=[10000])
+    parser.add_argument("--dimensions", type=_int_list, default=[64])
+    parser.add_argument("--num-folds", type=_int_list, default=[10])
+    parser.add_argument("--epsilons", type=_float_list, default=[0.1])
+    parser.add_argument(
+        "--num-sizes",
+        type=_int_list,
+        default=[1],
+        help="Numbers of subset sizes requested at once (10%%, 20%%, ...), at most 10",
+    )
+    parser.add_argument("--duplicate-fraction", type=float, default=0.0)
+    parser.add_argument(
+        "--set",
+        type=_option,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Extra subset_datasets option for every run, e.g. optimizer_backend=native",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--compare", help="Report of an earlier run to compare with")
+    parser.add_argument("--work-dir", help="Directory for the runs' data and outputs")
+    parser.add_argument("--keep", action="store_true", help="Keep the runs' outputs")
+    parser.add_argument("--verbose", action="store_true", help="Show pipeline logs")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    if any(not 0 < num_sizes <= 10 for num_sizes in args.num_sizes):
+        parser.error("--num-sizes values must be between 1 and 10")
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="subset_selection_bench_")
+    options = dict(args.set)
+
+    # Fresh processes, so the peak memory of one run does not carry over
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    grid = itertools.product(
+        args.rows, args.dimensions, args.num_folds, args.epsilons, args.num_sizes
+    )
+    for run_idx, (rows, dimension, num_folds, epsilon, num_sizes) in enumerate(grid):
+        params = {
+            "rows": rows,
+            "dimension": dimension,
+            "num_folds": num_folds,
+            "epsilon": epsilon,
+            "num_sizes": num_sizes,
+            "duplicate_fraction": args.duplicate_fraction,
+            "seed": args.seed,
+            "options": options,
+        }
+        run_dir = os.path.join(work_dir, f"run_{run_idx}")
+        os.makedirs(run_dir, exist_ok=True)
+        result_file = os.path.join(run_dir, "result.json")
+        logger.info(f"Running {_run_key(params)}")
+
+        process = context.Process(
+            target=_run_configuration_to_file,
+            args=(params, run_dir, result_file, args.verbose),
+        )
+        process.start()
+        process.join()
+        if process.exitcode == 0:
+            with open(result_file, encoding="utf-8") as f:
+                result = json.load(f)
+            logger.info(
+                f"Finished in {result['total_seconds']:.2f}s, "
+                f"peak RSS {result['peak_rss_mb']:.0f} MB"
+            )
+        else:
+            result = {"error": f"exit code {process.exitcode}"}
+            logger.error(f"Run failed with exit code {process.exitcode}")
+        runs.append({"params": params, **result})
+        if not args.keep:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    report = {"environment": _environment(), "runs": runs}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Saved report to {args.output}")
+    if not args.keep and not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ Command-line interface for subset selection.
 """
 
 import argparse
+import json
 import sys
 
 from .subset_selection import subset_datasets
@@ -55,12 +56,143 @@ def parse_args():
         default=160.0,
         help="Epsilon parameter for optimization (default: 160.0 for large datasets, use 0.1-1.0 for small)",
     )
+    parser.add_argument(
+        "--similarity-mode",
+        type=str,
+        default="dense",
+        choices=["dense", "sparse_knn"],
+        help="Similarity kernel per fold: full 'dense' matrix or top-k 'sparse_knn' neighbours (default: dense)",
+    )
+    parser.add_argument(
+        "--num-neighbors",
+        type=int,
+        default=100,
+        help="Neighbours kept per sample with --similarity-mode sparse_knn (default: 100)",
+    )
+    parser.add_argument(
+        "--knn-backend",
+        type=str,
+        default="exact",
+        choices=["exact", "ivf"],
+        help="Neighbour search in sparse_knn mode: 'exact' or approximate 'ivf' index (default: exact)",
+    )
+    parser.add_argument(
+        "--ivf-num-lists",
+        type=int,
+        default=0,
+        help="Inverted lists of the ivf index; 0 uses sqrt(fold size) (default: 0)",
+    )
+    parser.add_argument(
+        "--ivf-num-probes",
+        type=int,
+        default=8,
+        help="Inverted lists scanned per sample by the ivf index (default: 8)",
+    )
+    parser.add_argument(
+        "--ivf-pq-subspaces",
+        type=int,
+        default=0,
+        help="Product quantization subspaces of the ivf index; 0 disables PQ (default: 0)",
+    )
+    parser.add_argument(
+        "--optimizer-backend",
+        type=str,
+        default="submodlib",
+        choices=["submodlib", "native"],
+        help="Facility location optimizer: 'submodlib' or the built-in torch 'native' one (default: submodlib)",
+    )
+    parser.add_argument(
+        "--partition",
+        type=str,
+        default="random",
+        choices=["random", "kmeans"],
+        help="How samples are split into folds: 'random' or semantically coherent 'kmeans' clusters (default: random)",
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=None,
+        help="Collapse rows whose embeddings have at least this cosine similarity before selection (default: disabled)",
+    )
+    parser.add_argument(
+        "--merge-strategy",
+        type=str,
+        default="gain_sort",
+        choices=["gain_sort", "greedi"],
+        help="How fold selections are combined: sort by gain or a 'greedi' second selection round (default: gain_sort)",
+    )
+    parser.add_argument(
+        "--merge-oversampling",
+        type=float,
+        default=2.0,
+        help="Factor by which folds over-select for the greedi second round (default: 2.0)",
+    )
+    parser.add_argument(
+        "--mmap-embeddings",
+        action="store_true",
+        help="Memory-map embeddings from a .npy file next to embeddings.h5 instead of loading them into RAM",
+    )
+    parser.add_argument(
+        "--row-filter",
+        type=json.loads,
+        default=None,
+        help="""Only process Parquet rows matching this JSON filter, e.g. '[["lang", "==", "en"]]'""",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read the input files in bounded-size blocks instead of loading them with datasets",
+    )
+    parser.add_argument(
+        "--skip-materialization",
+        action="store_true",
+        help="Only write the ranked index and metadata files, not a copy of every subset",
+    )
     parser.add_argument(
         "--num-gpus",
         type=int,
         default=None,
         help="Number of GPUs to use (default: auto-detect all available)",
     )
+    parser.add_argument(
+        "--cpu-mode",
+        action="store_true",
+        help="Run on CPU workers when no GPUs are available, e.g. on CPU-only clusters",
+    )
+    parser.add_argument(
+        "--cpu-encoding-workers",
+        type=int,
+        default=-1,
+        help="Encoding processes in CPU mode, each pinned to its share of the cores; -1 sizes them from available cores and memory (default: -1)",
+    )
+    parser.add_argument(
+        "--cpu-selection-workers",
+        type=int,
+        default=0,
+        help="CPU workers selecting folds alongside the GPUs; -1 sizes them from available cores and memory (default: 0)",
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=-1,
+        help="Processes rendering templates before encoding; -1 uses all cores, 0 renders in the encoding workers (default: -1)",
+    )
+    parser.add_argument(
+        "--prometheus-metrics",
+        action="store_true",
+        help="Also write run metrics in the Prometheus text format to the output directory",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Run as one rank of a torchrun job spanning several nodes",
+    )
+    parser.add_argument(
+        "--distributed-timeout-minutes",
+        type=int,
+        default=1440,
+        help="How long ranks wait for each other at synchronization points (default: 1440)",
+    )
     parser.add_argument(
         "--combine-files",
         action="store_true",
@@ -83,6 +215,18 @@ def parse_args():
         default="Snowflake/snowflake-arctic-embed-l-v2.0",
         help="Encoder model name (default: Snowflake/snowflake-arctic-embed-l-v2.0)",
     )
+    parser.add_argument(
+        "--embedding-cache-dir",
+        type=str,
+        default=None,
+        help="Directory of a persistent embedding cache; only uncached texts are encoded (default: disabled)",
+    )
+    parser.add_argument(
+        "--embedding-cache-max-gb",
+        type=float,
+        default=50.0,
+        help="Size cap of the embedding cache in GB, enforced with LRU eviction (default: 50)",
+    )
     parser.add_argument(
         "--template-name",
         type=str,
@@ -119,6 +263,7 @@ def main():
     print(f"  Output directory: {args.output_dir}")
     print(f"  Number of folds: {args.num_folds}")
     print(f"  Epsilon: {args.epsilon}")
+    print(f"  Similarity mode: {args.similarity_mode}")
     
     # Build kwargs
     kwargs = {
@@ -126,15 +271,41 @@ def main():
         "batch_size": args.batch_size,
         "num_folds": args.num_folds,
         "epsilon": args.epsilon,
+        "similarity_mode": args.similarity_mode,
+        "num_neighbors": args.num_neighbors,
+        "knn_backend": args.knn_backend,
+        "ivf_num_lists": args.ivf_num_lists,
+        "ivf_num_probes": args.ivf_num_probes,
+        "ivf_pq_subspaces": args.ivf_pq_subspaces,
+        "optimizer_backend": args.optimizer_backend,
+        "partition": args.partition,
+        "dedup_threshold": args.dedup_threshold,
+        "merge_strategy": args.merge_strategy,
+        "merge_oversampling": args.merge_oversampling,
+        "mmap_embeddings": args.mmap_embeddings,
+        "row_filter": args.row_filter,
+        "streaming": args.streaming,
+        "materialize_subsets": not args.skip_materialization,
         "combine_files": args.combine_files,
         "encoder_type": args.encoder_type,
         "encoder_model": args.encoder_model,
+        "cache_dir": args.embedding_cache_dir,
+        "cache_max_size_gb": args.embedding_cache_max_gb,
         "template_name": args.template_name,
         "seed": args.seed,
+        "prometheus_metrics": args.prometheus_metrics,
+        "distributed": args.distributed,
+        "distributed_timeout_minutes": args.distributed_timeout_minutes,
     }
     
     if args.num_gpus is not None:
         kwargs["num_gpus"] = args.num_gpus
+    kwargs["num_render_workers"] = args.render_workers
+    if args.cpu_mode:
+        kwargs["cpu_mode"] = True
+    kwargs["num_cpu_encoding_workers"] = args.cpu_encoding_workers
+    if args.cpu_selection_workers:
+        kwargs["num_cpu_selection_workers"] = args.cpu_selection_workers
     
     try:
         subset_datasets(
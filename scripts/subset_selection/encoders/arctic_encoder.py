@@ -9,7 +9,6 @@ from tqdm import tqdm
 from transformers import AutoModel, AutoTokenizer
 import numpy as np
 import torch
-import torch.distributed as dist
 import torch.nn.functional as F
 
 logger = logging.getLogger(__name__)
@@ -91,6 +90,10 @@ class ArcticEmbedEncoder:
             testing_mode=testing_mode,
         )
 
+        # Largest mini-batch size that fits in memory, per padded-length bucket.
+        # Lowered whenever a mini-batch runs out of memory and kept across calls.
+        self.max_batch_sizes: Dict[int, int] = {}
+
         self._initialize_model()
 
     def _initialize_model(self) -> None:
@@ -166,6 +169,11 @@ class ArcticEmbedEncoder:
         texts = [f"{instruction}: {text}" for text in texts]
         return texts
 
+    @staticmethod
+    def _length_bucket(padded_length: int) -> int:
+        """Round a padded sequence length up to the next power of two."""
+        return 1 << max(0, padded_length - 1).bit_length()
+
     @torch.no_grad()
     def encode(
         self,
@@ -174,36 +182,80 @@ class ArcticEmbedEncoder:
         return_tensors: bool = True,
         show_progress: bool = True,
     ) -> Union[torch.Tensor, np.ndarray]:
-        """Encode texts into embeddings."""
+        """
+        Encode texts into embeddings.
+
+        Inputs are sorted by length and tokenized one mini-batch at a time, so each
+        mini-batch is only padded to its own longest text. The embeddings are
+        returned in the original input order.
+
+        If a mini-batch runs out of GPU memory, only that mini-batch is retried
+        with half the size, and the reduced size is remembered for its length
+        bucket so later mini-batches of similar length start from it.
+        """
         input_was_string = isinstance(inputs, str)
         inputs = self._prepare_inputs(inputs, instruction)
 
-        encodings = self.tokenizer(
-            inputs,
-            max_length=self.cfg.model_config["max_length"],
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-        ).to(self.cfg.device)
+        # Longest first, so similarly sized texts share a mini-batch
+        order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]), reverse=True)
 
         embeddings_list = []
-        for i in tqdm(
-            range(0, len(inputs), self.cfg.batch_size),
-            disable=not show_progress or len(inputs) < 256,
-        ):
-            batch = {k: v[i : i + self.cfg.batch_size] for k, v in encodings.items()}
-            outputs = self.model(**batch)
+        progress_bar = tqdm(
+            total=len(inputs), disable=not show_progress or len(inputs) < 256
+        )
+        i = 0
+        while i < len(inputs):
+            batch_texts = [inputs[j] for j in order[i : i + self.cfg.batch_size]]
+            batch = self.tokenizer(
+                batch_texts,
+                max_length=self.cfg.model_config["max_length"],
+                padding=True,
+                truncation=True,
+                return_tensors="pt",
+            )
+            bucket = self._length_bucket(batch["input_ids"].shape[1])
+            batch_size = min(
+                len(batch_texts), self.max_batch_sizes.get(bucket, self.cfg.batch_size)
+            )
+
+            while True:
+                out_of_memory = False
+                try:
+                    # Texts are sorted longest first, so a prefix of the batch is
+                    # never padded to more than the batch itself
+                    mini_batch = {
+                        k: v[:batch_size].to(self.cfg.device) for k, v in batch.items()
+                    }
+                    outputs = self.model(**mini_batch)
+                    break
+                except torch.cuda.OutOfMemoryError:
+                    if batch_size == 1:
+                        raise
+                    out_of_memory = True
+                if out_of_memory:
+                    # Outside the except block, the traceback no longer holds the
+                    # failed forward pass's activations, so they can be freed
+                    mini_batch = outputs = None
+                    torch.cuda.empty_cache()
+                    batch_size //= 2
+                    self.max_batch_sizes[bucket] = batch_size
+                    logger.warning(
+                        f"Out of memory on {self.cfg.device} for sequence length bucket "
+                        f"{bucket}, retrying with batch size {batch_size}"
+                    )
+
             # Take the first token embedding (CLS) and normalize it
             embeddings = F.normalize(outputs.last_hidden_state[:, 0], p=2, dim=1)
             embeddings_list.append(embeddings.cpu())
+            progress_bar.update(batch_size)
+            i += batch_size
+        progress_bar.close()
 
-        embeddings = torch.cat(embeddings_list, dim=0)
+        sorted_embeddings = torch.cat(embeddings_list, dim=0)
+        embeddings = torch.empty_like(sorted_embeddings)
+        embeddings[torch.tensor(order)] = sorted_embeddings
         if input_was_string:
             embeddings = embeddings[0]
 
         return embeddings if return_tensors else embeddings.numpy()
 
-
-def cleanup():
-    if dist.is_initialized():
-        dist.destroy_process_group()
\ No newline at end of file
@@ -1,27 +1,77 @@
 # Standard
-from dataclasses import dataclass, field
-from multiprocessing import Pool
-from typing import Any, Dict, List, TypedDict, TypeVar, Union
+from dataclasses import dataclass, field, fields
+from multiprocessing import Array, Pool, Value
+from multiprocessing import TimeoutError as PoolTimeoutError
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    TypeVar,
+    Union,
+)
 import gc
 import glob
+import hashlib
+import json
 import logging
 import math
 import os
+import queue
 import re
+import shutil
+import threading
+import time
 
 # Third Party
 from datasets import concatenate_datasets, load_dataset
-from jinja2 import BaseLoader, Environment
+from jinja2 import BaseLoader, Environment, meta
 from tqdm import tqdm
 import h5py
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import torch
 
 # Local
 from .encoders import get_encoder_class
+from .utils.ann_index import build_knn_graph
+from .utils.clustering import balance_clusters, minibatch_kmeans
+from .utils.deduplication import find_near_duplicates
+from .utils.distributed import (
+    barrier,
+    broadcast_object,
+    cleanup,
+    gather_objects,
+    get_rank,
+    get_world_size,
+    init_distributed,
+)
+from .utils.embedding_cache import EmbeddingCache
+from .utils.facility_location import FacilityLocation
+from .utils.metrics import MetricsHook, MetricsRecorder
+from .utils.streaming import (
+    RowFilter,
+    StreamingDataset,
+    filter_expression,
+    filter_parquet_rows,
+    table_digest,
+)
 from .utils.subset_selection_utils import (
-    compute_pairwise_dense,
+    attach_array,
+    build_sparse_knn_kernel,
+    compute_pairwise_dense_streaming,
+    compute_pairwise_sparse_knn,
+    get_cpu_worker_split,
+    get_default_num_cpu_workers,
     get_default_num_gpus,
+    get_num_available_cores,
+    pin_cpu_worker,
+    publish_array,
     retry_on_exception,
 )
 
@@ -34,6 +84,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# tqdm's monitor thread can hold tqdm's lock while worker processes are forked,
+# deadlocking the worker's first progress bar (e.g. when a failed stage is retried)
+tqdm.monitor_interval = 0
+
+# Rows rendered per task and per Arrow file by the rendering pre-stage
+RENDER_CHUNK_ROWS = 10000
+# Rows hashed into each block digest of the input fingerprint
+FINGERPRINT_BLOCK_ROWS = 10000
+# Batches of texts an encoding worker prepares ahead of the one it encodes
+PREFETCH_BATCHES = 2
+# Host memory of a CPU encoding worker (model weights and activations), used to
+# size the number of CPU workers
+CPU_ENCODER_BYTES = 4 * 1024**3
+
 
 @dataclass
 class BasicConfig:
@@ -52,11 +116,156 @@ class BasicConfig:
             "For smaller datasets, consider using much smaller values (starting from 0.1).",
         },
     )
+    similarity_mode: str = field(
+        default="dense",
+        metadata={
+            "advanced": True,
+            "help": "How the per-fold similarity kernel is built. 'dense' materializes the full "
+            "fold-by-fold matrix; 'sparse_knn' keeps only each sample's top num_neighbors "
+            "neighbours, so memory grows linearly with the fold size.",
+        },
+    )
+    num_neighbors: int = field(
+        default=100,
+        metadata={
+            "advanced": True,
+            "help": "Number of nearest neighbours kept per sample when similarity_mode is 'sparse_knn'.",
+        },
+    )
+    knn_backend: str = field(
+        default="exact",
+        metadata={
+            "advanced": True,
+            "help": "How neighbours are found in 'sparse_knn' mode. 'exact' compares every pair "
+            "block by block; 'ivf' uses an approximate inverted file index, which scales to folds "
+            "(or a single global fold) of millions of samples.",
+        },
+    )
+    ivf_num_lists: int = field(
+        default=0,
+        metadata={
+            "advanced": True,
+            "help": "Number of inverted lists of the 'ivf' index; 0 uses the square root of the fold size.",
+        },
+    )
+    ivf_num_probes: int = field(
+        default=8,
+        metadata={
+            "advanced": True,
+            "help": "Number of inverted lists scanned per sample by the 'ivf' index.",
+        },
+    )
+    ivf_pq_subspaces: int = field(
+        default=0,
+        metadata={
+            "advanced": True,
+            "help": "Product quantization subspaces of the 'ivf' index (must divide the embedding "
+            "dimension); 0 stores full vectors. PQ reduces index memory at some recall cost.",
+        },
+    )
+    optimizer_backend: str = field(
+        default="submodlib",
+        metadata={
+            "advanced": True,
+            "help": "Facility location optimizer. 'submodlib' copies each fold's kernel to the host "
+            "and uses submodlib; 'native' runs lazy greedy in torch on the device holding the kernel.",
+        },
+    )
+    partition: str = field(
+        default="random",
+        metadata={
+            "advanced": True,
+            "help": "How samples are split into folds. 'random' shuffles them into equal folds; "
+            "'kmeans' clusters the embeddings with mini-batch k-means into num_folds clusters "
+            "and packs the clusters into folds of balanced size.",
+        },
+    )
+    dedup_threshold: Optional[float] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "If set, rows whose embeddings have at least this cosine similarity to an "
+            "earlier kept row are removed before selection. Neighbours are found with "
+            "knn_backend. A mapping from every removed row to its kept row is saved.",
+        },
+    )
+    merge_strategy: str = field(
+        default="gain_sort",
+        metadata={
+            "advanced": True,
+            "help": "How per-fold selections are combined. 'gain_sort' sorts all fold winners by "
+            "their gains; 'greedi' runs a second facility location round over the union of the "
+            "fold winners, which also removes redundancy across folds.",
+        },
+    )
+    merge_oversampling: float = field(
+        default=2.0,
+        metadata={
+            "advanced": True,
+            "help": "With merge_strategy 'greedi', factor by which every fold over-selects so the "
+            "second round has candidates to choose from.",
+        },
+    )
+    mmap_embeddings: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Keep embeddings on disk as a raw .npy file next to embeddings.h5 and memory-map "
+            "it for subset selection instead of reading the whole HDF5 dataset into memory.",
+        },
+    )
+    row_filter: Optional[RowFilter] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Only process the rows of Parquet inputs matching this filter, given in the "
+            "format of pyarrow.parquet.read_table(filters=...), e.g. [('lang', '==', 'en')]. It is "
+            "pushed down to the reader, which skips row groups by their statistics.",
+        },
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Read JSON Lines, CSV or Parquet inputs from disk in bounded-size blocks, keeping "
+            "only the offset of every row in memory, instead of loading them with `datasets`. For "
+            "inputs larger than memory or than the free space for the `datasets` cache.",
+        },
+    )
+    materialize_subsets: bool = field(
+        default=True,
+        metadata={
+            "advanced": True,
+            "help": "Write every subset as a copy of its rows in the input format. If False, only "
+            "the ranked index and metadata files are written, and subsets can be built from them "
+            "later.",
+        },
+    )
 
     def __post_init__(self):
         """Validate configuration after initialization."""
         if not 0 < self.epsilon <= 160:
             raise ValueError("epsilon must be between 0 and 160")
+        if self.similarity_mode not in ("dense", "sparse_knn"):
+            raise ValueError("similarity_mode must be one of 'dense' or 'sparse_knn'")
+        if self.num_neighbors <= 0:
+            raise ValueError("num_neighbors must be positive")
+        if self.knn_backend not in ("exact", "ivf"):
+            raise ValueError("knn_backend must be one of 'exact' or 'ivf'")
+        if self.ivf_num_lists < 0 or self.ivf_pq_subspaces < 0:
+            raise ValueError("ivf_num_lists and ivf_pq_subspaces must not be negative")
+        if self.ivf_num_probes <= 0:
+            raise ValueError("ivf_num_probes must be positive")
+        if self.optimizer_backend not in ("submodlib", "native"):
+            raise ValueError("optimizer_backend must be one of 'submodlib' or 'native'")
+        if self.partition not in ("random", "kmeans"):
+            raise ValueError("partition must be one of 'random' or 'kmeans'")
+        if self.dedup_threshold is not None and not 0 < self.dedup_threshold <= 1:
+            raise ValueError("dedup_threshold must be between 0 and 1")
+        if self.merge_strategy not in ("gain_sort", "greedi"):
+            raise ValueError("merge_strategy must be one of 'gain_sort' or 'greedi'")
+        if self.merge_oversampling < 1:
+            raise ValueError("merge_oversampling must be at least 1")
 
     def validate_epsilon_for_dataset_size(self, dataset_size: int) -> None:
         """
@@ -91,6 +300,21 @@ class EncoderConfig:
         default="Snowflake/snowflake-arctic-embed-l-v2.0", metadata={"advanced": True}
     )
     testing_mode: bool = False
+    cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Directory of a persistent embedding cache keyed by rendered text, encoder model, "
+            "instruction and template. Only cache misses are encoded. Disabled if not set.",
+        },
+    )
+    cache_max_size_gb: float = field(
+        default=50.0,
+        metadata={
+            "advanced": True,
+            "help": "Size cap of the embedding cache; least recently used entries are evicted beyond it.",
+        },
+    )
 
 
 @dataclass
@@ -117,10 +341,77 @@ class SystemConfig:
     max_retries: int = field(default=3, metadata={"advanced": True})
     retry_delay: int = field(default=30, metadata={"advanced": True})
     testing_mode: bool = field(default=False, metadata={"advanced": True})
+    cpu_mode: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Run on CPU workers when no GPUs are available, e.g. on CPU-only "
+            "clusters. Without it, a missing GPU is an error outside testing mode.",
+        },
+    )
+    num_cpu_encoding_workers: int = field(
+        default=-1,
+        metadata={
+            "advanced": True,
+            "help": "Encoding processes when running without GPUs, each pinned to "
+            "its share of the cores. -1 sizes them from the available cores and "
+            "memory, about 8 cores each.",
+        },
+    )
+    num_cpu_selection_workers: int = field(
+        default=0,
+        metadata={
+            "advanced": True,
+            "help": "Number of CPU workers that select folds alongside the GPU workers. "
+            "-1 sizes the pool automatically from the available cores and memory.",
+        },
+    )
+    num_render_workers: int = field(
+        default=-1,
+        metadata={
+            "advanced": True,
+            "help": "Processes rendering the templates into an Arrow file before encoding. "
+            "-1 uses all available cores; 0 renders inside the encoding workers instead.",
+        },
+    )
+    distributed: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Run as one rank of a torch.distributed job launched with torchrun, "
+            "one rank per node. Ranks encode slices of the rows and select shares of "
+            "the folds, and rank 0 merges the results. output_dir must be shared.",
+        },
+    )
+    distributed_timeout_minutes: int = field(
+        default=1440,
+        metadata={
+            "advanced": True,
+            "help": "How long a rank waits for the others, e.g. while they encode.",
+        },
+    )
+    prometheus_metrics: bool = field(
+        default=False,
+        metadata={
+            "advanced": True,
+            "help": "Also write the run metrics in the Prometheus text format, "
+            "for the node exporter's textfile collector.",
+        },
+    )
+    metrics_hook: Optional[MetricsHook] = field(
+        default=None,
+        metadata={
+            "advanced": True,
+            "help": "Called as hook(name, value, labels) with every metric as it is "
+            "recorded, to forward metrics to an external system.",
+        },
+    )
 
     def __post_init__(self):
         """Initialize num_gpus after other fields are set."""
-        self.num_gpus = get_default_num_gpus(testing_mode=self.testing_mode)
+        self.num_gpus = get_default_num_gpus(
+            testing_mode=self.testing_mode, cpu_mode=self.cpu_mode
+        )
 
 
 @dataclass
@@ -183,6 +474,11 @@ class DataProcessor:
             k: self.env.from_string(v) for k, v in config.template.templates.items()
         }
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Replaced for every dataset processed
+        self.metrics = MetricsRecorder("", config.system.metrics_hook)
+        # Input files and, per dataset row, its file and row number in that file,
+        # if a row filter makes them differ from the dataset rows
+        self.input_rows: Optional[Tuple[List[str], np.ndarray, np.ndarray]] = None
 
         # Set random seeds
         np.random.seed(config.system.seed)
@@ -216,14 +512,65 @@ class DataProcessor:
         Returns:
             Combined dataset or list of individual datasets.
         """
+        if self.config.basic.streaming:
+            if len(input_files) > 1 and not self.config.basic.combine_files:
+                raise ValueError(
+                    "Multiple datasets provided but combine_files is not enabled"
+                )
+            # Rows are read from the files on demand, through an index of their offsets
+            dataset = StreamingDataset(input_files, self.config.basic.row_filter)
+            self.input_rows = None
+            if self.config.basic.row_filter is not None:
+                # Offsets of Parquet rows are their row numbers
+                self.input_rows = (dataset.files, dataset.file_ids, dataset.offsets)
+            return dataset
+
+        self.input_rows = None
+        if self.config.basic.row_filter is not None:
+            file_rows = [
+                filter_parquet_rows(input_file, self.config.basic.row_filter)
+                for input_file in input_files
+                if input_file.endswith(".parquet")
+            ]
+            if len(file_rows) == len(input_files):
+                self.input_rows = (
+                    list(input_files),
+                    np.repeat(
+                        np.arange(len(input_files), dtype=np.int32),
+                        [len(rows) for rows in file_rows],
+                    ),
+                    np.concatenate(file_rows),
+                )
+
         datasets = []
 
         for input_file in input_files:
             file_extension = input_file.split(".")[-1]
             if file_extension == "jsonl":
                 file_extension = "json"
+            load_kwargs = {}
+            if file_extension == "parquet":
+                if self.config.basic.row_filter is not None:
+                    # Pushed down to the Parquet reader
+                    load_kwargs["filters"], _ = filter_expression(
+                        self.config.basic.row_filter
+                    )
+                if not self.config.basic.materialize_subsets:
+                    # Without subset files, no other column is ever needed
+                    fields = self._template_fields()
+                    load_kwargs["columns"] = [
+                        name
+                        for name in pq.read_schema(input_file).names
+                        if name in fields
+                    ]
+            elif self.config.basic.row_filter is not None:
+                raise ValueError("row_filter is only supported for Parquet inputs")
             dataset = load_dataset(
-                file_extension, data_files=input_file, split="train", cache_dir=None
+                file_extension,
+                data_files=input_file,
+                split="train",
+                cache_dir=None,
+                **load_kwargs,
             )
             datasets.append(dataset)
 
@@ -237,6 +584,38 @@ class DataProcessor:
             )
         return datasets[0]
 
+    def _template_fields(self) -> Set[str]:
+        """Top-level fields referenced by the template used for the embeddings."""
+        source = self.config.template.templates.get(
+            self.config.template.template_name, ""
+        )
+        return meta.find_undeclared_variables(self.env.parse(source))
+
+    def _project_template_fields(self, dataset):
+        """
+        Drop the columns the template does not reference.
+
+        Rendering then never reads or decodes them, which matters for datasets
+        with large columns, e.g. metadata or tool calls, that do not affect the
+        embeddings. The input fingerprint is computed on the kept columns only,
+        so changes to the other columns do not invalidate the embeddings, except
+        for streamed JSON Lines and CSV records, which are hashed whole.
+
+        Args:
+            dataset: The dataset to project.
+
+        Returns:
+            The dataset with only the referenced columns.
+        """
+        fields = self._template_fields()
+        if isinstance(dataset, StreamingDataset):
+            return dataset.select_columns(fields)
+        columns = [name for name in dataset.column_names if name in fields]
+        if len(columns) == len(dataset.column_names):
+            return dataset
+        logger.info(f"Reading only the columns {columns} for the embeddings")
+        return dataset.select_columns(columns)
+
     def calculate_subset_size(
         self, total_samples: int, size_spec: Union[int, float]
     ) -> int:
@@ -276,11 +655,33 @@ class DataProcessor:
             return f"percent_{size_spec:.1f}"
         return f"samples_{actual_size}"
 
+    def _embedding_settings(self) -> Dict[str, str]:
+        """Settings that must match for existing embeddings to be reused."""
+        return {
+            "encoder_type": self.config.encoder.encoder_type,
+            "encoder_model": self.config.encoder.encoder_model,
+            "instruction": self.config.encoder.instruction,
+            "template_name": self.config.template.template_name,
+            "template": self.config.template.templates.get(
+                self.config.template.template_name, ""
+            ),
+        }
+
     @retry_on_exception
     def generate_embeddings(self, dataset, output_dir: str) -> str:
         """
         Generates embeddings for the dataset and saves them to the output directory, using multiple GPUs in parallel.
 
+        A manifest recording the input fingerprint, row count and embedding
+        settings is written next to the embeddings. Existing embeddings are
+        reused only if the manifest matches; if the dataset has only grown,
+        just the new tail rows are encoded and appended. The rows are only
+        hashed if the metadata of the input files changed.
+
+        When running distributed, every rank encodes a contiguous slice of the
+        rows and rank 0 merges the shards of all ranks. The output directory
+        must be on a filesystem shared by all ranks.
+
         Args:
             dataset: The dataset to process.
             output_dir (str): The directory where embeddings will be saved.
@@ -290,39 +691,259 @@ class DataProcessor:
         """
         os.makedirs(output_dir, exist_ok=True)
         merged_path = os.path.join(output_dir, "embeddings.h5")
+        manifest_path = os.path.join(output_dir, "manifest.json")
+        settings = self._embedding_settings()
+        total_samples = len(dataset)
+        source_fingerprint = _source_fingerprint(dataset)
+
+        # Rank 0 alone checks (and may remove) the shared embeddings file, and
+        # hashes the rows if needed
+        start_row, block_digests = None, None
+        if get_rank() == 0:
+            start_row, block_digests = self._embedding_start_row(
+                dataset, merged_path, manifest_path, source_fingerprint
+            )
+        start_row, block_digests = broadcast_object((start_row, block_digests))
+        if start_row is None:
+            return merged_path
+        input_fingerprint = _input_fingerprint(block_digests)
+
+        # Shard checkpoints are only resumed for the same input, settings and rows
+        checkpoint_key = hashlib.sha256(
+            json.dumps(
+                [input_fingerprint, settings, start_row], sort_keys=True
+            ).encode("utf-8")
+        ).hexdigest()
+        # Every rank encodes its slice of the rows into its own shard directory
+        rank, world_size = get_rank(), get_world_size()
+        rows_per_rank = -(-(total_samples - start_row) // world_size)
+        rank_start = min(start_row + rank * rows_per_rank, total_samples)
+        rank_end = min(rank_start + rows_per_rank, total_samples)
+        rank_dir = output_dir
+        if world_size > 1:
+            rank_dir = os.path.join(output_dir, f"rank_{rank}")
+        shard_files, source_rows = [], None
+        if rank_start < rank_end:
+            with self.metrics.stage("encode"):
+                shard_files, source_rows = self._encode_rows(
+                    dataset, rank_start, rank_dir, checkpoint_key, end_row=rank_end
+                )
+        shard_groups = gather_objects((shard_files, source_rows))
+
+        if rank == 0:
+            # Merge all shard files, in rank order
+            shard_groups = [group for group in shard_groups if group[0]]
+            merged_bytes = os.path.getsize(merged_path) if start_row > 0 else 0
+            with self.metrics.stage("merge_shards"):
+                _merge_shard_files(shard_groups, merged_path, append=start_row > 0)
+            self.metrics.add(
+                "bytes_written", os.path.getsize(merged_path) - merged_bytes
+            )
+            _write_manifest(
+                manifest_path,
+                {
+                    "input_fingerprint": input_fingerprint,
+                    "source_fingerprint": source_fingerprint,
+                    "row_count": total_samples,
+                    "block_rows": FINGERPRINT_BLOCK_ROWS,
+                    "block_digests": block_digests,
+                    "settings": settings,
+                },
+            )
+            if world_size > 1:
+                for rank_dir in glob.glob(os.path.join(output_dir, "rank_*")):
+                    if not os.listdir(rank_dir):
+                        os.rmdir(rank_dir)
+        # The other ranks wait for the merged file
+        barrier()
+
+        return merged_path
+
+    def _embedding_start_row(
+        self,
+        dataset,
+        merged_path: str,
+        manifest_path: str,
+        source_fingerprint: Optional[str],
+    ) -> Tuple[Optional[int], List[str]]:
+        """
+        Decide which rows of the dataset need to be encoded.
 
-        # If embeddings already exist, return early
+        If the manifest has the same source fingerprint and row count, the
+        embeddings are up to date without reading the rows. Otherwise the rows
+        are hashed once, and compared block by block with the digests in the
+        manifest, so an input that only grew is recognized without hashing its
+        old rows twice. Existing embeddings that cannot be reused are removed.
+
+        Args:
+            dataset: The dataset to process.
+            merged_path (str): Path of the merged embeddings file.
+            manifest_path (str): Path of the manifest written next to it.
+            source_fingerprint (Optional[str]): Fingerprint of the input files'
+                metadata, see ``_source_fingerprint``.
+
+        Returns:
+            Tuple[Optional[int], List[str]]: First row to encode, or None if the
+            embeddings are up to date, and the block digests of all rows.
+        """
+        output_dir = os.path.dirname(merged_path)
+        settings = self._embedding_settings()
+        total_samples = len(dataset)
+        start_row = 0
+        block_digests = None
         if os.path.exists(merged_path):
-            logger.info(f"Embeddings file already exists in {output_dir}, skipping")
-            return merged_path
+            manifest = _read_manifest(manifest_path)
+            if manifest is None:
+                logger.warning(
+                    f"Embeddings in {output_dir} have no valid manifest and cannot be validated, regenerating"
+                )
+            elif manifest["settings"] != settings:
+                logger.warning(
+                    f"Embedding settings changed since {merged_path} was written, regenerating"
+                )
+            elif manifest["row_count"] > total_samples:
+                logger.warning(
+                    f"Input changed since {merged_path} was written, regenerating"
+                )
+            elif (
+                manifest["row_count"] == total_samples
+                and source_fingerprint is not None
+                and manifest.get("source_fingerprint") == source_fingerprint
+            ):
+                logger.info(f"Embeddings in {output_dir} are up to date, skipping")
+                return None, manifest["block_digests"]
+            else:
+                block_digests = _block_digests(dataset, 0, total_samples)
+                if manifest["row_count"] == total_samples:
+                    if block_digests == manifest["block_digests"]:
+                        logger.info(
+                            f"Embeddings in {output_dir} are up to date, skipping"
+                        )
+                        # Only the metadata changed, e.g. the files were copied
+                        _write_manifest(
+                            manifest_path,
+                            {**manifest, "source_fingerprint": source_fingerprint},
+                        )
+                        return None, block_digests
+                    logger.warning(
+                        f"Input changed since {merged_path} was written, regenerating"
+                    )
+                elif _is_prefix(dataset, manifest, block_digests):
+                    start_row = manifest["row_count"]
+                    logger.info(
+                        f"Dataset grew from {start_row} to {total_samples} rows, "
+                        "encoding only the new rows"
+                    )
+                else:
+                    logger.warning(
+                        f"Input changed since {merged_path} was written, regenerating"
+                    )
+
+            if start_row == 0:
+                os.remove(merged_path)
+        if block_digests is None:
+            block_digests = _block_digests(dataset, 0, total_samples)
+        return start_row, block_digests
+
+    def _encode_rows(
+        self,
+        dataset,
+        start_row: int,
+        output_dir: str,
+        checkpoint_key: str,
+        end_row: Optional[int] = None,
+    ) -> Tuple[List[str], Optional[np.ndarray]]:
+        """
+        Encode the dataset rows from ``start_row`` onwards, sharded across workers.
+
+        With the rendering pre-stage, exact duplicates are found across all rows
+        from the hashes of the rendered texts, and only the first row holding
+        every distinct text is sharded and encoded. The embeddings are copied
+        back to the duplicate rows when the shards are merged.
+
+        Args:
+            dataset: The dataset to process.
+            start_row (int): First row to encode.
+            output_dir (str): The directory where shard files will be saved.
+            checkpoint_key (str): Identifies the run, so that shards interrupted
+                by an earlier attempt of the same run are resumed.
+            end_row (Optional[int]): Row after the last one to encode. Defaults to
+                the end of the dataset.
 
+        Returns:
+            Tuple[List[str], Optional[np.ndarray]]: Paths of the shard files, in
+            row order, and for every row the row of its embedding in the shard
+            files, or None if they hold one embedding per row.
+        """
         # Get number of GPUs to use
+        cpu_threads = None
         if torch.cuda.is_available():
             num_gpus = min(self.config.system.num_gpus, torch.cuda.device_count())
         else:
-            # In testing mode without GPU, use 1 CPU "worker"
-            num_gpus = 1
+            # Without GPUs, split the cores between CPU workers, each running
+            # its own encoder with a share of the cores
+            num_gpus, cpu_threads = get_cpu_worker_split(
+                self.config.system.num_cpu_encoding_workers, CPU_ENCODER_BYTES
+            )
+            logger.info(f"Each CPU worker encodes with {cpu_threads} threads")
         logger.info(f"Using {num_gpus} {'GPU' if torch.cuda.is_available() else 'CPU worker'}{'s' if num_gpus > 1 else ''} for embedding generation")
 
+        total_samples = len(dataset) if end_row is None else end_row
+        num_rows = total_samples - start_row
+
+        rendered_dir = None
+        unique_rows, source_rows = None, None
+        num_render_workers = self.config.system.num_render_workers
+        if num_render_workers < 0:
+            num_render_workers = get_num_available_cores()
+        if num_render_workers > 0:
+            rendered_dir = os.path.join(output_dir, "rendered", checkpoint_key[:16])
+            with self.metrics.stage("render"):
+                self._render_rows(
+                    dataset, start_row, total_samples, rendered_dir, num_render_workers
+                )
+            # Encode every distinct text once, whichever shard its rows fall into
+            unique_rows, source_rows = _unique_rendered_rows(rendered_dir, num_rows)
+            logger.info(
+                f"Exact duplicates: {num_rows - len(unique_rows)}/{num_rows} rows "
+                "reuse the embedding of an earlier row"
+            )
+            if len(unique_rows) == num_rows:
+                source_rows = None
+
         # Create dataset shards - one per GPU
-        total_samples = len(dataset)
-        per_gpu_samples = (total_samples + num_gpus - 1) // num_gpus  # Ceiling division
+        num_shard_rows = num_rows if unique_rows is None else len(unique_rows)
+        per_gpu_samples = (num_shard_rows + num_gpus - 1) // num_gpus
 
         # Prepare arguments for parallel processing
         args_list = []
         for gpu_id in range(num_gpus):
             # Calculate start and end indices for this shard
             start_idx = gpu_id * per_gpu_samples
-            end_idx = min(start_idx + per_gpu_samples, total_samples)
+            end_idx = min(start_idx + per_gpu_samples, num_shard_rows)
 
-            if start_idx >= total_samples:
+            if start_idx >= num_shard_rows:
                 continue  # Skip if this GPU has no data to process
 
+            if unique_rows is None:
+                dataset_shard = dataset.select(
+                    range(start_row + start_idx, start_row + end_idx)
+                )
+                rendered = None
+                shard_key = (
+                    f"{checkpoint_key}:{start_row + start_idx}:{start_row + end_idx}"
+                )
+            else:
+                # Workers read their texts from the rendered chunks only
+                dataset_shard = None
+                rendered = (rendered_dir, unique_rows[start_idx:end_idx])
+                shard_key = f"{checkpoint_key}:unique:{start_idx}:{end_idx}"
+
             # Create arguments for this GPU
             args_list.append(
                 (
                     gpu_id,
-                    dataset.select(range(start_idx, end_idx)),
+                    dataset_shard,
                     output_dir,
                     self.config.encoder.encoder_type,
                     self.config.encoder.encoder_model,
@@ -331,75 +952,271 @@ class DataProcessor:
                     self.config.template.templates,
                     self.config.basic.batch_size,
                     self.config.encoder.testing_mode,
+                    self.config.encoder.cache_dir,
+                    self.config.encoder.cache_max_size_gb,
+                    shard_key,
+                    rendered,
+                    cpu_threads,
                 )
             )
 
         # Process dataset shards in parallel
         with Pool(processes=num_gpus) as pool:
-            shard_files = pool.map(_process_dataset_shard, args_list)
+            shard_results = pool.map(_process_dataset_shard, args_list)
+        if rendered_dir is not None:
+            shutil.rmtree(os.path.dirname(rendered_dir))
+
+        for _, shard_stats in shard_results:
+            for name in ("encoded_rows", "unique_texts", "duplicate_rows", "cache_hits"):
+                self.metrics.add(name, shard_stats[name])
+            self.metrics.observe_peak(
+                "device_peak_bytes", shard_stats["device_peak_bytes"]
+            )
+        if source_rows is not None:
+            # Rows that take the embedding of an earlier row holding the same text
+            self.metrics.add("encoded_rows", num_rows - len(unique_rows))
+            self.metrics.add("duplicate_rows", num_rows - len(unique_rows))
 
         # Filter out None values (failed shards)
-        shard_files = [f for f in shard_files if f is not None]
+        shard_files = [f for f, _ in shard_results if f is not None]
 
         if not shard_files:
             raise ValueError("No embeddings were generated from any GPU")
 
-        # Merge all shard files
-        _merge_shard_files(shard_files, merged_path)
+        return shard_files, source_rows
 
-        return merged_path
+    def _render_rows(
+        self,
+        dataset,
+        start_row: int,
+        end_row: int,
+        rendered_dir: str,
+        num_workers: int,
+    ) -> None:
+        """
+        Render the template for a range of rows into Arrow files, in parallel.
+
+        Rows are rendered in chunks of ``RENDER_CHUNK_ROWS``, each written to its
+        own Arrow IPC file holding a ``text`` column and a ``hash`` column of
+        16-byte text hashes, so the encoding workers only read finished texts
+        and exact duplicates can be found without reading the texts. Chunks
+        written by an interrupted attempt are kept.
+
+        Args:
+            dataset: The dataset to render.
+            start_row (int): First row to render.
+            end_row (int): Row after the last one to render.
+            rendered_dir (str): Directory of the chunk files.
+            num_workers (int): Number of rendering processes.
+        """
+        os.makedirs(rendered_dir, exist_ok=True)
+        tasks = [
+            (
+                chunk_start,
+                min(chunk_start + RENDER_CHUNK_ROWS, end_row),
+                _rendered_chunk_file(
+                    rendered_dir, (chunk_start - start_row) // RENDER_CHUNK_ROWS
+                ),
+            )
+            for chunk_start in range(start_row, end_row, RENDER_CHUNK_ROWS)
+        ]
+        logger.info(
+            f"Rendering {end_row - start_row} rows with {num_workers} workers"
+        )
+        with Pool(
+            processes=min(num_workers, len(tasks)),
+            initializer=_init_render_worker,
+            initargs=(
+                dataset,
+                self.config.template.templates.get(
+                    self.config.template.template_name, ""
+                ),
+            ),
+        ) as pool:
+            for _ in pool.imap_unordered(_render_chunk_task, tasks):
+                pass
 
     def select_subsets(
-        self, dataset_name: str, embeddings: torch.Tensor
+        self,
+        dataset_name: str,
+        embeddings: torch.Tensor,
+        embeddings_path: Optional[str] = None,
     ) -> Dict[Union[int, float], List[int]]:
         """
         Enhanced subset selection supporting both percentage and absolute size specifications.
-        """
-        indices = np.arange(len(embeddings))
-        np.random.shuffle(indices)
 
-        fold_size = len(embeddings) // self.config.basic.num_folds
-        remainder = len(embeddings) % self.config.basic.num_folds
+        Args:
+            dataset_name (str): Name of the dataset, used for output file names.
+            embeddings (torch.Tensor): Embeddings of the dataset.
+            embeddings_path (Optional[str]): ``.npy`` file the embeddings are mapped from.
+                If given, workers map it directly instead of a temporary copy.
 
-        folds = []
-        start_idx = 0
-        for i in range(self.config.basic.num_folds):
-            extra = 1 if i < remainder else 0
-            end_idx = start_idx + fold_size + extra
-            folds.append(indices[start_idx:end_idx])
-            start_idx = end_idx
+        When running distributed, every rank selects a share of the folds and
+        rank 0 merges them; the other ranks return an empty dict.
+        """
+        # Publish the embeddings once; workers memory-map them and only receive fold indices
+        published_path = None
+        if embeddings_path is None:
+            published_path = embeddings_path = publish_array(
+                embeddings.numpy(),
+                os.path.join(self.config.basic.output_dir, dataset_name, "embeddings"),
+            )
 
-        gpu_assignments = []
-        folds_per_gpu = self.config.basic.num_folds // self.config.system.num_gpus
-        extra_folds = self.config.basic.num_folds % self.config.system.num_gpus
+        try:
+            # Near-duplicates are removed before the quadratic fold stage; subset
+            # sizes then refer to the deduplicated rows
+            sample_indices = None
+            num_samples = len(embeddings)
+            folds = None
+            # Rank 0 partitions the samples, so that every rank has the same folds
+            if get_rank() == 0:
+                if self.config.basic.dedup_threshold is not None:
+                    with self.metrics.stage("dedup"):
+                        sample_indices = self._deduplicate(
+                            dataset_name, embeddings_path
+                        )
+                    num_samples = len(sample_indices)
 
-        start_fold = 0
-        for gpu_id in range(self.config.system.num_gpus):
-            num_folds_this_gpu = folds_per_gpu + (1 if gpu_id < extra_folds else 0)
-            end_fold = start_fold + num_folds_this_gpu
-            gpu_folds_info = [
-                (fold_idx, folds[fold_idx]) for fold_idx in range(start_fold, end_fold)
-            ]
+                with self.metrics.stage("partition"):
+                    folds = self._partition_folds(
+                        num_samples, embeddings_path, sample_indices
+                    )
+            num_samples, folds = broadcast_object((num_samples, folds))
 
-            gpu_assignments.append(
-                (
-                    gpu_id,
-                    gpu_folds_info,
-                    embeddings,
-                    self.config.subset_sizes,
-                    len(embeddings),  # Pass total samples for absolute size calculation
-                    self.config.basic.epsilon,
-                    self.config.system.testing_mode,  # Explicitly pass testing_mode
+            # GPU workers (CPU stand-ins in testing mode) plus optional CPU workers
+            num_gpu_workers = self.config.system.num_gpus
+            num_cpu_workers = self.config.system.num_cpu_selection_workers
+            if torch.cuda.is_available():
+                devices = [f"cuda:{gpu_id}" for gpu_id in range(num_gpu_workers)]
+            elif self.config.system.cpu_mode:
+                # Only CPU workers, sized automatically unless set explicitly
+                num_gpu_workers = 0
+                devices = []
+                if num_cpu_workers == 0:
+                    num_cpu_workers = -1
+            else:
+                if not self.config.system.testing_mode:
+                    raise RuntimeError(
+                        "GPU processing required but CUDA is not available"
+                    )
+                logger.warning(
+                    "Running in CPU mode for testing. "
+                    "Production use requires GPU acceleration."
                 )
+                devices = ["cpu"] * num_gpu_workers
+
+            if num_cpu_workers < 0:
+                num_cpu_workers = get_default_num_cpu_workers(
+                    bytes_per_worker=self._estimate_fold_memory_bytes(
+                        max(map(len, folds))
+                    ),
+                    reserved_workers=num_gpu_workers,
+                )
+                if not devices:
+                    num_cpu_workers = max(1, num_cpu_workers)
+            devices += ["cpu"] * num_cpu_workers
+            cpu_threads = max(
+                1,
+                (get_num_available_cores() - num_gpu_workers)
+                // max(1, num_cpu_workers),
+            )
+            logger.info(
+                f"Selecting subsets with {num_gpu_workers} GPU "
+                f"and {num_cpu_workers} CPU workers"
+            )
+
+            # Worker process id holding each device, 0 while it is free, and the
+            # number of workers that replaced a dead one
+            device_owners = Array("q", len(devices))
+            replaced_workers = Value("i", 0)
+            selection_args = (
+                self.config.subset_sizes,
+                num_samples,  # Pass total samples for absolute size calculation
+                self.config.basic.epsilon,
+                self.config.basic.similarity_mode,
+                self.config.basic.num_neighbors,
+                self.config.basic.optimizer_backend,
+                self.config.system.seed,
+                (
+                    self.config.basic.merge_oversampling
+                    if self.config.basic.merge_strategy == "greedi"
+                    else 1.0
+                ),
+                self._ivf_params(),
             )
-            start_fold = end_fold
 
-        with Pool(processes=self.config.system.num_gpus) as pool:
-            gpu_results = pool.map(process_folds_with_gpu, gpu_assignments)
+            # Workers pull folds one at a time, largest first, so no worker sits
+            # idle while another still has a backlog; results stream back as
+            # folds finish. Ranks take turns picking folds in that order.
+            tasks = sorted(
+                ((fold_idx, fold) for fold_idx, fold in enumerate(folds)),
+                key=lambda task: len(task[1]),
+                reverse=True,
+            )[get_rank() :: get_world_size()]
+            all_results = []
+            with self.metrics.stage("folds"), Pool(
+                processes=len(devices),
+                initializer=_init_fold_worker,
+                initargs=(
+                    devices,
+                    device_owners,
+                    embeddings_path,
+                    selection_args,
+                    cpu_threads,
+                    replaced_workers,
+                ),
+            ) as pool:
+                fold_results = pool.imap_unordered(
+                    _select_fold_task, tasks, chunksize=1
+                )
+                while len(all_results) < len(tasks):
+                    try:
+                        fold_idx, result, fold_stats = fold_results.next(timeout=10)
+                    except PoolTimeoutError:
+                        # The pool replaces a dead worker, but never resubmits
+                        # the fold it was selecting
+                        if replaced_workers.value:
+                            raise RuntimeError(
+                                "A fold selection worker died, e.g. killed for "
+                                "running out of memory"
+                            ) from None
+                        continue
+                    all_results.append((fold_idx, result))
+                    self.metrics.record_fold(fold_idx, fold_stats)
+                    logger.info(
+                        f"Completed fold {fold_idx + 1} "
+                        f"({len(all_results)}/{len(tasks)})"
+                    )
 
-        all_results = []
-        for gpu_result in gpu_results:
-            all_results.extend(gpu_result)
+            # Rank 0 collects the folds of all ranks and makes the final selection
+            rank_results = gather_objects(
+                (all_results, self.metrics.folds)
+            )
+            if rank_results is None:
+                return {}
+            all_results = []
+            for rank, (results, fold_stats) in enumerate(rank_results):
+                all_results.extend(results)
+                if rank > 0:
+                    for stats in fold_stats:
+                        self.metrics.record_fold(stats.pop("fold"), stats)
+
+            # Merge in fold order so the output does not depend on completion order
+            all_results.sort(key=lambda item: item[0])
+
+            second_round = None
+            if self.config.basic.merge_strategy == "greedi":
+                with self.metrics.stage("second_round"):
+                    second_round = self._select_second_round(
+                        all_results,
+                        num_samples,
+                        devices[0],
+                        embeddings_path,
+                        selection_args,
+                    )
+        finally:
+            if published_path is not None:
+                os.remove(published_path)
 
         class SubsetData(TypedDict):
             indices: List[int]
@@ -409,25 +1226,33 @@ class DataProcessor:
             size: {"indices": [], "gains": []} for size in self.config.subset_sizes
         }
 
-        for fold_idx, result in all_results:
+        for _, result in all_results:
             for size in self.config.subset_sizes:
                 combined_subsets[size]["indices"].extend(result[size]["indices"])
                 combined_subsets[size]["gains"].extend(result[size]["gains"])
 
         base_name = dataset_name
         subsets = {}
+        ranked_subsets = []
 
         for size_spec in self.config.subset_sizes:
-            actual_size = self.calculate_subset_size(len(embeddings), size_spec)
+            actual_size = self.calculate_subset_size(num_samples, size_spec)
             logger.info(f"Actual subset size: {actual_size}")
-            sorted_indices_gains = sorted(
-                zip(
-                    combined_subsets[size_spec]["indices"],
-                    combined_subsets[size_spec]["gains"],
-                ),
-                key=lambda x: x[1],
-                reverse=True,
-            )[:actual_size]  # Limit to actual_size
+            if second_round is not None:
+                # The second round is nested like the folds, so every subset
+                # is a prefix of the selection for the largest one
+                sorted_indices_gains = list(zip(*second_round, strict=True))
+                sorted_indices_gains = sorted_indices_gains[:actual_size]
+            else:
+                sorted_indices_gains = sorted(
+                    zip(
+                        combined_subsets[size_spec]["indices"],
+                        combined_subsets[size_spec]["gains"],
+                        strict=True,
+                    ),
+                    key=lambda x: x[1],
+                    reverse=True,
+                )[:actual_size]  # Limit to actual_size
 
             sorted_indices = [x[0] for x in sorted_indices_gains]
             sorted_gains = [x[1] for x in sorted_indices_gains]
@@ -438,53 +1263,357 @@ class DataProcessor:
                 f"{base_name}_fl_{self.config.basic.num_folds}_partitions_{subset_name}_metadata.npz",
             )
 
-            np.savez(metadata_file, indices=sorted_indices, gains=sorted_gains)
+            np.savez(
+                metadata_file,
+                indices=sorted_indices,
+                gains=sorted_gains,
+                **self._input_row_columns(sorted_indices),
+            )
+            self.metrics.add_file_bytes("bytes_written", metadata_file)
             logger.info(f"Saved metadata to {metadata_file}")
             subsets[size_spec] = sorted_indices
+            ranked_subsets.append((subset_name, sorted_indices, sorted_gains))
 
+        self._save_ranked_index(dataset_name, ranked_subsets, all_results)
         return subsets
 
-    def get_dataset_name(self, input_file: str) -> str:
+    def _input_row_columns(self, row_ids: List[int]) -> Dict[str, np.ndarray]:
         """
-        Get a clean dataset name from the input file path.
-
-        Args:
-            input_file (str): Input file path
+        Input file and row number in it of dataset rows, for the output files.
 
         Returns:
-            str: Clean dataset name
+            Dict[str, np.ndarray]: ``input_files`` (all input files),
+            ``input_file_ids`` and ``input_rows``, or nothing without a row filter,
+            when the row ids are the input rows.
         """
-        # Extract filename without extension and path
-        base_name = os.path.splitext(os.path.basename(input_file))[0]
-        # Clean the name to make it filesystem-friendly
-        clean_name = re.sub(r"[^\w\-_]", "_", base_name)
-        return clean_name
+        if self.input_rows is None:
+            return {}
+        files, file_ids, rows = self.input_rows
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        return {
+            "input_files": np.asarray(files),
+            "input_file_ids": file_ids[row_ids],
+            "input_rows": rows[row_ids],
+        }
 
-    def process_files(self, input_files: List[str], output_dir: str):
+    def _save_ranked_index(
+        self,
+        dataset_name: str,
+        ranked_subsets: List[Tuple[str, List[int], List[float]]],
+        fold_results: List[Tuple[int, Dict[Union[int, float], Dict[str, list]]]],
+    ) -> None:
         """
-        Process multiple input files with support for both combined and separate processing.
+        Save the selections of all subset sizes as a single Parquet index.
+
+        Every row holds the subset name, the rank of the sample within the
+        subset, its row id in the dataset, the fold it was selected from and its
+        gain, so subsets can be materialized later, or by other tools, without
+        rewriting the dataset. With a row filter, row ids refer to the filtered
+        rows, so the input file and row number in it are added as well.
 
         Args:
-            input_files (List[str]): List of input files to process
-            output_dir (str): Output directory for results
+            dataset_name (str): Name of the dataset, used for the output file name.
+            ranked_subsets: Name, row ids and gains of every subset, in rank order.
+            fold_results: Per-fold selections, in fold order.
         """
-        try:
-            if self.config.basic.combine_files:
-                # Process combined datasets
-                logger.info("Processing combined datasets...")
-                dataset = self.load_and_combine_datasets(input_files)
-                dataset_name = "combined_dataset"
+        # Fold selections are nested, so the winners for the largest size
+        # cover every selected row
+        largest_spec = max(
+            self.config.subset_sizes,
+            key=lambda spec: sum(
+                len(result[spec]["indices"]) for _, result in fold_results
+            ),
+        )
+        winners = np.concatenate(
+            [
+                np.asarray(result[largest_spec]["indices"], dtype=np.int64)
+                for _, result in fold_results
+            ]
+        )
+        winner_folds = np.concatenate(
+            [
+                np.full(len(result[largest_spec]["indices"]), fold_idx, np.int32)
+                for fold_idx, result in fold_results
+            ]
+        )
+        order = np.argsort(winners)
+        winners, winner_folds = winners[order], winner_folds[order]
 
-                # Process combined dataset
-                self._process_single_dataset(
-                    dataset, dataset_name, output_dir, input_files[0]
-                )
+        row_ids = np.concatenate(
+            [np.asarray(indices, dtype=np.int64) for _, indices, _ in ranked_subsets]
+        )
+        table = pa.table(
+            {
+                "subset": pa.array(
+                    [
+                        name
+                        for name, indices, _ in ranked_subsets
+                        for _ in range(len(indices))
+                    ]
+                ).dictionary_encode(),
+                "rank": np.concatenate(
+                    [np.arange(len(indices)) for _, indices, _ in ranked_subsets]
+                ),
+                "row_id": row_ids,
+                "fold": winner_folds[np.searchsorted(winners, row_ids)],
+                "gain": np.concatenate(
+                    [
+                        np.asarray(gains, dtype=np.float64)
+                        for _, _, gains in ranked_subsets
+                    ]
+                ),
+            }
+        )
+        input_rows = self._input_row_columns(row_ids)
+        if input_rows:
+            table = table.append_column(
+                "input_file",
+                pa.DictionaryArray.from_arrays(
+                    input_rows["input_file_ids"], input_rows["input_files"].tolist()
+                ),
+            ).append_column("input_row", pa.array(input_rows["input_rows"]))
+        index_file = os.path.join(
+            self.config.basic.output_dir,
+            f"{dataset_name}_fl_{self.config.basic.num_folds}_partitions_ranked_index.parquet",
+        )
+        pq.write_table(table, index_file)
+        self.metrics.add_file_bytes("bytes_written", index_file)
+        logger.info(f"Saved ranked index to {index_file}")
+
+    def _select_second_round(
+        self,
+        fold_results: List[Tuple[int, Dict[Union[int, float], Dict[str, list]]]],
+        num_samples: int,
+        device: str,
+        embeddings_path: str,
+        selection_args: tuple,
+    ) -> Optional[Tuple[List[int], List[float]]]:
+        """
+        Select the final subsets from the union of the fold winners (GreeDi).
+
+        Gains from different folds are not comparable and redundancy across
+        folds is never seen by the folds themselves, so facility location is run
+        once more over the winners of all folds, for the largest subset size.
+
+        Args:
+            fold_results: Per-fold selections, in fold order.
+            num_samples (int): Number of samples in the dataset.
+            device (str): Device of the worker running the second round.
+            embeddings_path (str): ``.npy`` file the embeddings are published in.
+            selection_args (tuple): Selection settings shared with the fold workers.
+
+        Returns:
+            Selected global indices and their gains in selection order, or None if
+            the fold winners are not more than the largest subset.
+        """
+        # Fold selections are nested, so the size with the most winners covers all
+        largest_spec = max(
+            self.config.subset_sizes,
+            key=lambda spec: sum(
+                len(result[spec]["indices"]) for _, result in fold_results
+            ),
+        )
+        candidates = np.concatenate(
+            [result[largest_spec]["indices"] for _, result in fold_results]
+        )
+        budget = max(
+            self.calculate_subset_size(num_samples, spec)
+            for spec in self.config.subset_sizes
+        )
+        if budget >= len(candidates):
+            logger.warning(
+                f"Skipping second-round selection: {len(candidates)} fold winners "
+                f"for a subset of {budget}; increase merge_oversampling"
+            )
+            return None
+
+        logger.info(
+            f"Selecting {budget} of {len(candidates)} fold winners in a second round"
+        )
+        with Pool(
+            processes=1,
+            initializer=_init_fold_worker,
+            initargs=(
+                [device],
+                Array("q", 1),
+                embeddings_path,
+                selection_args,
+                get_num_available_cores(),
+            ),
+        ) as pool:
+            return pool.apply(
+                _select_second_round_task, (len(fold_results), candidates, budget)
+            )
+
+    def _ivf_params(self) -> Optional[Dict[str, int]]:
+        """Parameters of the approximate neighbour index, or None for exact search."""
+        if self.config.basic.knn_backend != "ivf":
+            return None
+        return {
+            "num_lists": self.config.basic.ivf_num_lists or None,
+            "num_probes": self.config.basic.ivf_num_probes,
+            "pq_subspaces": self.config.basic.ivf_pq_subspaces,
+        }
+
+    def _deduplicate(self, dataset_name: str, embeddings_path: str) -> np.ndarray:
+        """
+        Collapse near-duplicate rows and save which kept row represents each removed one.
+
+        Args:
+            dataset_name (str): Name of the dataset, used for the output file name.
+            embeddings_path (str): ``.npy`` file the embeddings are published in.
+
+        Returns:
+            np.ndarray: Indices of the rows kept for selection, in increasing order.
+        """
+        threshold = self.config.basic.dedup_threshold
+        logger.info(f"Removing near-duplicates at cosine similarity {threshold}")
+        # Run in a worker process: CUDA must not be initialized in this process,
+        # which later forks the selection workers
+        with Pool(processes=1) as pool:
+            removed, representatives, similarities = pool.apply(
+                _find_near_duplicates,
+                (
+                    embeddings_path,
+                    threshold,
+                    "cuda:0" if torch.cuda.is_available() else "cpu",
+                    self._ivf_params(),
+                    self.config.system.seed,
+                ),
+            )
+
+        mapping_file = os.path.join(
+            self.config.basic.output_dir, f"{dataset_name}_dedup_mapping.npz"
+        )
+        np.savez(
+            mapping_file,
+            removed_indices=removed,
+            representative_indices=representatives,
+            similarities=similarities,
+        )
+        self.metrics.add_file_bytes("bytes_written", mapping_file)
+        logger.info(
+            f"Removed {len(removed)} near-duplicate rows, "
+            f"saved mapping to {mapping_file}"
+        )
+
+        num_rows = len(attach_array(embeddings_path))
+        return np.setdiff1d(np.arange(num_rows), removed, assume_unique=True)
+
+    def _partition_folds(
+        self,
+        num_samples: int,
+        embeddings_path: str,
+        sample_indices: Optional[np.ndarray] = None,
+    ) -> List[np.ndarray]:
+        """
+        Split the sample indices into folds according to the partition setting.
+
+        Args:
+            num_samples (int): Number of samples to split.
+            embeddings_path (str): ``.npy`` file the embeddings are published in.
+            sample_indices (Optional[np.ndarray]): Rows to split, if not all of them.
+
+        Returns:
+            List[np.ndarray]: Sample indices of every fold.
+        """
+        num_folds = self.config.basic.num_folds
+        if self.config.basic.partition == "kmeans":
+            logger.info(f"Clustering {num_samples} embeddings into {num_folds} folds")
+            # Cluster in a worker process: CUDA must not be initialized in this
+            # process, which later forks the selection workers
+            with Pool(processes=1) as pool:
+                assignments = pool.apply(
+                    _cluster_embeddings,
+                    (
+                        embeddings_path,
+                        num_folds,
+                        "cuda:0" if torch.cuda.is_available() else "cpu",
+                        self.config.system.seed,
+                        sample_indices,
+                    ),
+                )
+            folds = balance_clusters(
+                assignments, num_folds, seed=self.config.system.seed
+            )
+            if sample_indices is not None:
+                folds = [sample_indices[fold] for fold in folds]
+            return folds
+
+        if sample_indices is None:
+            indices = np.arange(num_samples)
+        else:
+            indices = sample_indices.copy()
+        np.random.shuffle(indices)
+
+        fold_size = num_samples // num_folds
+        remainder = num_samples % num_folds
+
+        folds = []
+        start_idx = 0
+        for i in range(num_folds):
+            extra = 1 if i < remainder else 0
+            end_idx = start_idx + fold_size + extra
+            folds.append(indices[start_idx:end_idx])
+            start_idx = end_idx
+        return folds
+
+    def _estimate_fold_memory_bytes(self, fold_size: int) -> int:
+        """Estimate the host memory needed to select subsets from one fold."""
+        # submodlib keeps its own copy of the kernel, the native optimizer does not
+        num_copies = 2 if self.config.basic.optimizer_backend == "submodlib" else 1
+        if self.config.basic.similarity_mode == "sparse_knn":
+            num_neighbors = min(self.config.basic.num_neighbors, fold_size)
+            # float32 values and int64 indices
+            return num_copies * fold_size * num_neighbors * 12
+        # The float32 kernel
+        return num_copies * fold_size * fold_size * 4
+
+    def get_dataset_name(self, input_file: str) -> str:
+        """
+        Get a clean dataset name from the input file path.
+
+        Args:
+            input_file (str): Input file path
+
+        Returns:
+            str: Clean dataset name
+        """
+        # Extract filename without extension and path
+        base_name = os.path.splitext(os.path.basename(input_file))[0]
+        # Clean the name to make it filesystem-friendly
+        clean_name = re.sub(r"[^\w\-_]", "_", base_name)
+        return clean_name
+
+    def process_files(self, input_files: List[str], output_dir: str):
+        """
+        Process multiple input files with support for both combined and separate processing.
+
+        Args:
+            input_files (List[str]): List of input files to process
+            output_dir (str): Output directory for results
+        """
+        try:
+            if self.config.basic.combine_files:
+                # Process combined datasets
+                logger.info("Processing combined datasets...")
+                dataset_name = "combined_dataset"
+                self._start_metrics(dataset_name, input_files, output_dir)
+                with self.metrics.stage("load"):
+                    dataset = self.load_and_combine_datasets(input_files)
+
+                # Process combined dataset
+                self._process_single_dataset(
+                    dataset, dataset_name, output_dir, input_files[0]
+                )
             else:
                 # Process each dataset separately
                 logger.info("Processing datasets separately...")
                 for input_file in input_files:
-                    dataset = self.load_and_combine_datasets([input_file])
                     dataset_name = self.get_dataset_name(input_file)
+                    self._start_metrics(dataset_name, [input_file], output_dir)
+                    with self.metrics.stage("load"):
+                        dataset = self.load_and_combine_datasets([input_file])
                     logger.info(f"Processing dataset: {dataset_name}")
                     self._process_single_dataset(
                         dataset, dataset_name, output_dir, input_file
@@ -494,6 +1623,44 @@ class DataProcessor:
             logger.error(f"Error processing files: {str(e)}")
             raise
 
+    def _start_metrics(
+        self, dataset_name: str, input_files: List[str], output_dir: str
+    ) -> None:
+        """
+        Start recording the metrics of a new dataset.
+
+        With ``prometheus_metrics``, the Prometheus file is rewritten after every
+        stage, so that it also covers running and failed runs.
+        """
+        prometheus_path = None
+        if self.config.system.prometheus_metrics:
+            os.makedirs(output_dir, exist_ok=True)
+            prometheus_path = self._metrics_file(
+                output_dir, dataset_name, "metrics.prom"
+            )
+        self.metrics = MetricsRecorder(
+            dataset_name, self.config.system.metrics_hook, prometheus_path
+        )
+        for input_file in input_files:
+            self.metrics.add_file_bytes("bytes_read", input_file)
+
+    @staticmethod
+    def _metrics_file(output_dir: str, dataset_name: str, suffix: str) -> str:
+        """Path of a metrics file of a dataset, per rank other than 0."""
+        if get_rank() > 0:
+            dataset_name = f"{dataset_name}_rank_{get_rank()}"
+        return os.path.join(output_dir, f"{dataset_name}_{suffix}")
+
+    def _write_metrics(self, output_dir: str) -> None:
+        """Write the metrics of the current dataset as a run report."""
+        report_file = self._metrics_file(
+            output_dir, self.metrics.dataset_name, "run_report.json"
+        )
+        self.metrics.write_json(report_file)
+        logger.info(f"Saved run report to {report_file}")
+        if self.metrics.prometheus_path is not None:
+            self.metrics.write_prometheus(self.metrics.prometheus_path)
+
     def _process_single_dataset(
         self, dataset, dataset_name: str, output_dir: str, input_file: str
     ):
@@ -515,38 +1682,54 @@ class DataProcessor:
             os.makedirs(dataset_output_dir, exist_ok=True)
 
             logger.info(f"Generating embeddings for {dataset_name}")
-            embedding_file = self.generate_embeddings(
-                dataset, os.path.join(dataset_output_dir, "embeddings")
-            )
+            with self.metrics.stage("embed"):
+                embedding_file = self.generate_embeddings(
+                    self._project_template_fields(dataset),
+                    os.path.join(dataset_output_dir, "embeddings"),
+                )
 
             logger.info("Loading embeddings for subset selection")
-            with h5py.File(embedding_file, "r") as f:
-                embeddings_data = f["embeddings"][:]
-                if embeddings_data.size == 0:
-                    logger.warning(
-                        f"No embeddings generated for dataset {dataset_name}, skipping subset selection"
-                    )
-                    return
-                embeddings = torch.tensor(embeddings_data, dtype=torch.float32)
+            embeddings_path = None
+            with self.metrics.stage("load_embeddings"):
+                if self.config.basic.mmap_embeddings:
+                    # Rank 0 writes the shared .npy file, the other ranks map it
+                    if get_rank() == 0:
+                        _ensure_npy_embeddings(embedding_file)
+                    barrier()
+                    embeddings_path = _ensure_npy_embeddings(embedding_file)
+                    embeddings_data = attach_array(embeddings_path)
+                else:
+                    with h5py.File(embedding_file, "r") as f:
+                        embeddings_data = f["embeddings"][:]
+            # For memory-mapped embeddings, this is the mapped size rather than
+            # the bytes actually read, which only selection touches
+            self.metrics.add("bytes_read", embeddings_data.nbytes)
+            if embeddings_data.size == 0:
+                logger.warning(
+                    f"No embeddings generated for dataset {dataset_name}, skipping subset selection"
+                )
+                return
+            # Zero-copy for the float32 data written by the encoders
+            embeddings = torch.from_numpy(embeddings_data.astype(np.float32, copy=False))
 
             logger.info("Selecting subsets")
-            subsets = self.select_subsets(dataset_name, embeddings)
-
-            logger.info("Saving subsets")
-            for size_spec, indices in subsets.items():
-                subset_data = dataset.select(indices)
-                subset_name = self.get_subset_name(size_spec, len(indices))
-
-                # Create subset filename with dataset name
-                output_file = os.path.join(
-                    dataset_output_dir,
-                    f"{dataset_name}_{subset_name}_subset.{input_file.split('.')[-1]}",
+            with self.metrics.stage("select"):
+                subsets = self.select_subsets(
+                    dataset_name, embeddings, embeddings_path
                 )
 
-                self._save_subset(subset_data, output_file, input_file)
+            if not self.config.basic.materialize_subsets:
                 logger.info(
-                    f"Saved subset with {len(indices)} samples to {output_file}"
+                    "Skipping subset materialization; the selections are in the "
+                    "ranked index and metadata files"
                 )
+            elif subsets:  # Empty on ranks other than 0
+                logger.info("Saving subsets")
+                with self.metrics.stage("save_subsets"):
+                    self._materialize_subsets(
+                        dataset, subsets, dataset_name, dataset_output_dir, input_file
+                    )
+            self._write_metrics(output_dir)
 
             # Clean up resources
             del dataset, embeddings
@@ -558,7 +1741,53 @@ class DataProcessor:
             logger.error(f"Error processing dataset {dataset_name}: {str(e)}")
             raise
 
-    def _save_subset(self, subset_data, output_file: str, input_file: str):
+    def _materialize_subsets(
+        self,
+        dataset,
+        subsets: Dict[Union[int, float], List[int]],
+        dataset_name: str,
+        dataset_output_dir: str,
+        input_file: str,
+    ) -> None:
+        """
+        Write every subset to its own file, one worker process per subset.
+
+        Rows are written in dataset order: each worker reads its rows with
+        increasing indices, i.e. sequentially from the memory-mapped dataset,
+        rather than jumping around in gain order. The gain order is kept in the
+        metadata files and the ranked index.
+
+        Args:
+            dataset: The dataset to take the rows from
+            subsets: Selected row ids of every subset size
+            dataset_name (str): Name of the dataset
+            dataset_output_dir (str): Output directory of the dataset
+            input_file (str): Original input file path (for extension)
+        """
+        tasks = []
+        for size_spec, indices in subsets.items():
+            subset_name = self.get_subset_name(size_spec, len(indices))
+
+            # Create subset filename with dataset name
+            output_file = os.path.join(
+                dataset_output_dir,
+                f"{dataset_name}_{subset_name}_subset.{input_file.split('.')[-1]}",
+            )
+            tasks.append((np.sort(indices), output_file))
+
+        with Pool(
+            processes=min(len(tasks), get_num_available_cores()),
+            initializer=_init_materialize_worker,
+            initargs=(dataset, input_file),
+        ) as pool:
+            for output_file, num_rows in pool.imap_unordered(
+                _materialize_subset_task, tasks
+            ):
+                self.metrics.add_file_bytes("bytes_written", output_file)
+                logger.info(f"Saved subset with {num_rows} samples to {output_file}")
+
+    @staticmethod
+    def _save_subset(subset_data, output_file: str, input_file: str):
         """
         Save subset data to file in appropriate format.
 
@@ -567,6 +1796,10 @@ class DataProcessor:
             output_file (str): Output file path
             input_file (str): Original input file path (for determining format)
         """
+        if isinstance(subset_data, StreamingDataset):
+            # Copies the records of the input files
+            subset_data.write(output_file)
+            return
         extension = input_file.split(".")[-1]
         if extension in ["json", "jsonl"]:
             subset_data.to_json(output_file, orient="records", lines=True)
@@ -577,7 +1810,13 @@ class DataProcessor:
 
 
 def _process_dataset_shard(args):
-    """Process a dataset shard on a specific GPU."""
+    """
+    Process a dataset shard on a specific GPU.
+
+    Returns:
+        The shard file, or None if no embeddings were generated, and the shard's
+        encoding statistics.
+    """
     (
         gpu_id,
         dataset_shard,
@@ -589,17 +1828,27 @@ def _process_dataset_shard(args):
         templates,
         batch_size,
         testing_mode,
+        cache_dir,
+        cache_max_size_gb,
+        checkpoint_key,
+        rendered,
+        cpu_threads,
     ) = args
 
+    num_rows = len(dataset_shard) if rendered is None else len(rendered[1])
+    cache = None
+    h5f = None
     try:
         # Set the device for this process
         if torch.cuda.is_available():
             torch.cuda.set_device(gpu_id)
+            torch.cuda.reset_peak_memory_stats(gpu_id)
             device = f"cuda:{gpu_id}"
-            logger.info(f"GPU {gpu_id} started processing {len(dataset_shard)} samples")
+            logger.info(f"GPU {gpu_id} started processing {num_rows} samples")
         else:
             device = "cpu"
-            logger.info(f"CPU worker {gpu_id} started processing {len(dataset_shard)} samples")
+            pin_cpu_worker(gpu_id, cpu_threads)
+            logger.info(f"CPU worker {gpu_id} started processing {num_rows} samples")
 
         encoder_cls = get_encoder_class(encoder_type)
 
@@ -614,85 +1863,535 @@ def _process_dataset_shard(args):
         env = Environment(loader=BaseLoader())
         templates_dict = {k: env.from_string(v) for k, v in templates.items()}
 
+        if cache_dir:
+            cache = EmbeddingCache(cache_dir, int(cache_max_size_gb * 1024**3))
+        num_cache_hits = 0
+        # Shard row of the first occurrence of every rendered text, by text hash.
+        # Rows written before a resume are not tracked.
+        first_rows: Dict[bytes, int] = {}
+        num_duplicates = 0
+
         # Create shard-specific output directory
         shard_dir = os.path.join(output_dir, f"shard_{gpu_id}")
         os.makedirs(shard_dir, exist_ok=True)
 
-        # Process batches
-        all_embeddings = []
-        batch_texts = []
+        # Open the shard file, resuming after the last checkpointed row if possible
+        shard_file = os.path.join(shard_dir, f"embeddings_shard_{gpu_id}.h5")
+        h5f, completed_rows = _open_shard_checkpoint(
+            shard_file, checkpoint_key, num_rows
+        )
+        if completed_rows:
+            logger.info(f"Resuming shard {gpu_id} from row {completed_rows}/{num_rows}")
+        num_remaining = num_rows - completed_rows
+
+        template = templates_dict.get(template_name)
+        if not template:
+            raise ValueError(f"Unknown format type: {template_name}")
+        if rendered is None:
+            text_batches = _render_batches(
+                dataset_shard.select(range(completed_rows, num_rows)),
+                template,
+                batch_size,
+            )
+        else:
+            rendered_dir, rendered_rows = rendered
+            text_batches = _read_rendered_batches(
+                rendered_dir, rendered_rows[completed_rows:], batch_size
+            )
 
         # Create progress bar
         device_name = f"GPU {gpu_id}" if torch.cuda.is_available() else f"CPU worker {gpu_id}"
         progress_bar = tqdm(
             desc=f"{device_name} generating embeddings",
-            total=len(dataset_shard),
+            total=num_rows,
+            initial=completed_rows,
             unit=" samples",
             position=gpu_id,  # Stack progress bars
             leave=True,
         )
 
-        # Process each example in the shard
-        for idx, example in enumerate(dataset_shard):
-            # Format the text using the template
-            template = templates_dict.get(template_name)
-            if not template:
-                raise ValueError(f"Unknown format type: {template_name}")
-
-            text = template.render(**example)
-            batch_texts.append(text)
-
-            # Process when batch is full or at the end
-            if len(batch_texts) == batch_size or idx == len(dataset_shard) - 1:
-                # Generate embeddings for this batch
-                with torch.no_grad():
-                    batch_embeddings = (
-                        encoder.encode(
-                            inputs=batch_texts,
-                            instruction=instruction,
-                        )
-                        .cpu()
-                        .numpy()
+        # Texts of the next batches are prepared in the background while a batch
+        # is encoded
+        for batch_texts in _prefetch(text_batches, PREFETCH_BATCHES):
+            # Generate embeddings for the texts not seen earlier in the shard
+            with torch.no_grad():
+                batch_embeddings, batch_cache_hits, batch_duplicates = (
+                    _encode_unique_texts(
+                        encoder,
+                        batch_texts,
+                        h5f,
+                        first_rows,
+                        instruction,
+                        cache,
+                        encoder_model,
+                        templates.get(template_name, ""),
                     )
+                )
+            num_cache_hits += batch_cache_hits
+            num_duplicates += batch_duplicates
 
-                all_embeddings.append(batch_embeddings)
-                progress_bar.update(len(batch_texts))
-                batch_texts = []
+            # Write the batch and checkpoint it before moving on
+            _append_to_shard(h5f, batch_embeddings)
+            progress_bar.update(len(batch_texts))
 
-                # Clean up GPU memory
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
+            # Clean up GPU memory
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
         progress_bar.close()
+        logger.info(
+            f"Exact duplicates on shard {gpu_id}: {num_duplicates}/"
+            f"{num_remaining} rows reused an earlier embedding"
+        )
+        if cache is not None:
+            logger.info(
+                f"Embedding cache hits on shard {gpu_id}: {num_cache_hits}/{num_rows}"
+            )
+        stats = {
+            "encoded_rows": num_remaining,
+            "unique_texts": num_remaining - num_duplicates,
+            "duplicate_rows": num_duplicates,
+            "cache_hits": num_cache_hits,
+            "device_peak_bytes": (
+                torch.cuda.max_memory_allocated(gpu_id)
+                if torch.cuda.is_available()
+                else 0
+            ),
+        }
 
-        # Concatenate all batches
-        if not all_embeddings:
+        if "embeddings" not in h5f:
             device_label = "GPU" if torch.cuda.is_available() else "CPU worker"
             logger.warning(f"No embeddings generated for shard on {device_label} {gpu_id}")
-            return None
-
-        embeddings = np.concatenate(all_embeddings, axis=0)
-
-        # Save embeddings to file
-        shard_file = os.path.join(shard_dir, f"embeddings_shard_{gpu_id}.h5")
-        with h5py.File(shard_file, "w") as h5f:
-            h5f.create_dataset("embeddings", data=embeddings, dtype="float32")
+            return None, stats
 
         device_label = "GPU" if torch.cuda.is_available() else "CPU worker"
         logger.info(f"{device_label} {gpu_id} completed processing. Saved to {shard_file}")
-        return shard_file
+        return shard_file, stats
 
     # pylint: disable=broad-exception-caught
     except Exception as e:
         device_label = "GPU" if torch.cuda.is_available() else "CPU worker"
         logger.error(f"Error processing shard on {device_label} {gpu_id}: {str(e)}")
         raise
+    finally:
+        if cache is not None:
+            cache.close()
+        if h5f is not None:
+            h5f.close()
+
+
+def _render_batches(dataset, template, batch_size: int) -> Iterator[List[str]]:
+    """Render the rows of a dataset in batches."""
+    for start in range(0, len(dataset), batch_size):
+        rows = dataset.select(range(start, min(start + batch_size, len(dataset))))
+        yield [template.render(**example) for example in rows]
+
+
+def _rendered_chunk_file(rendered_dir: str, chunk_idx: int) -> str:
+    """Path of the Arrow file holding a chunk of rendered texts."""
+    return os.path.join(rendered_dir, f"chunk_{chunk_idx}.arrow")
+
+
+def _read_rendered_batches(
+    rendered_dir: str, rows: np.ndarray, batch_size: int
+) -> Iterator[List[str]]:
+    """
+    Read rendered texts from the chunk files in batches.
+
+    Args:
+        rendered_dir (str): Directory of the chunk files.
+        rows (np.ndarray): Increasing positions of the texts to read, counted
+            from the first rendered row.
+        batch_size (int): Number of texts per batch.
+    """
+    texts: List[str] = []
+    chunk_ids = rows // RENDER_CHUNK_ROWS
+    breaks = np.flatnonzero(chunk_ids[1:] != chunk_ids[:-1]) + 1
+    for chunk_start, chunk_end in zip(
+        np.r_[0, breaks], np.r_[breaks, len(rows)], strict=True
+    ):
+        if chunk_start == chunk_end:
+            continue
+        chunk_idx = int(chunk_ids[chunk_start])
+        offsets = rows[chunk_start:chunk_end] - chunk_idx * RENDER_CHUNK_ROWS
+        with pa.memory_map(_rendered_chunk_file(rendered_dir, chunk_idx)) as source:
+            column = pa.ipc.open_file(source).read_all()["text"]
+            texts.extend(column.take(pa.array(offsets)).to_pylist())
+        while len(texts) >= batch_size:
+            yield texts[:batch_size]
+            texts = texts[batch_size:]
+    if texts:
+        yield texts
+
+
+def _text_hash(text: str) -> bytes:
+    """Hash of a rendered text, identifying its exact duplicates."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def _unique_rendered_rows(
+    rendered_dir: str, num_rows: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the distinct rendered texts from the text hashes of the chunk files.
+
+    Args:
+        rendered_dir (str): Directory of the chunk files.
+        num_rows (int): Number of rendered rows.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Increasing positions of the first row
+        holding every distinct text, and for every row the index of its text
+        among them.
+    """
+    hashes = np.empty((num_rows, 2), dtype=np.uint64)
+    for chunk_idx, start in enumerate(range(0, num_rows, RENDER_CHUNK_ROWS)):
+        with pa.memory_map(_rendered_chunk_file(rendered_dir, chunk_idx)) as source:
+            column = pa.ipc.open_file(source).read_all()["hash"].combine_chunks()
+            hashes[start : start + len(column)] = np.frombuffer(
+                column.buffers()[1],
+                dtype=np.uint64,
+                count=2 * len(column),
+                offset=16 * column.offset,
+            ).reshape(-1, 2)
+    _, first_rows, text_ids = np.unique(
+        hashes, axis=0, return_index=True, return_inverse=True
+    )
+    # Number the texts in order of their first row
+    order = np.argsort(first_rows)
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return first_rows[order], ranks[text_ids.reshape(-1)]
+
+
+def _prefetch(items: Iterator[T], max_items: int) -> Iterator[T]:
+    """
+    Produce the items of an iterator in a background thread.
+
+    At most ``max_items`` items are produced ahead of the consumer. Exceptions
+    raised by the iterator are re-raised to the consumer.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=max_items)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put((item, None))
+            buffer.put((done, None))
+        # pylint: disable=broad-exception-caught
+        except Exception as e:
+            buffer.put((None, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = buffer.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+def _open_shard_checkpoint(
+    shard_file: str, checkpoint_key: str, num_rows: int
+) -> Tuple[h5py.File, int]:
+    """
+    Open a shard file for streaming writes, resuming an interrupted shard.
+
+    A shard written by an earlier attempt is resumed if it belongs to the same
+    run and row range; rows written after its last checkpoint are discarded.
+    Otherwise the shard is started from scratch.
+
+    Args:
+        shard_file (str): Path of the shard file.
+        checkpoint_key (str): Identifies the run and row range of the shard.
+        num_rows (int): Number of rows in the shard.
+
+    Returns:
+        Tuple[h5py.File, int]: The open shard file and the number of completed rows.
+    """
+    if os.path.exists(shard_file):
+        try:
+            h5f = h5py.File(shard_file, "a")
+            if (
+                h5f.attrs.get("checkpoint_key") == checkpoint_key
+                and h5f.attrs.get("num_rows") == num_rows
+            ):
+                completed_rows = int(h5f.attrs["completed_rows"])
+                if "embeddings" in h5f:
+                    h5f["embeddings"].resize(completed_rows, axis=0)
+                return h5f, completed_rows
+            h5f.close()
+        except OSError as e:
+            logger.warning(f"Discarding unreadable shard checkpoint {shard_file}: {e}")
+        os.remove(shard_file)
+
+    h5f = h5py.File(shard_file, "w")
+    h5f.attrs["checkpoint_key"] = checkpoint_key
+    h5f.attrs["num_rows"] = num_rows
+    h5f.attrs["completed_rows"] = 0
+    return h5f, 0
+
+
+def _append_to_shard(h5f: h5py.File, batch_embeddings: np.ndarray) -> None:
+    """Append a batch of embeddings to a shard file and checkpoint it."""
+    if "embeddings" not in h5f:
+        h5f.create_dataset(
+            "embeddings",
+            shape=(0, batch_embeddings.shape[1]),
+            maxshape=(None, batch_embeddings.shape[1]),
+            chunks=(min(1024, len(batch_embeddings)), batch_embeddings.shape[1]),
+            dtype="float32",
+        )
+    embeddings = h5f["embeddings"]
+    start_idx = embeddings.shape[0]
+    embeddings.resize(start_idx + len(batch_embeddings), axis=0)
+    embeddings[start_idx:] = batch_embeddings
+    # The checkpoint only advances once the batch itself is on disk
+    h5f.flush()
+    h5f.attrs["completed_rows"] = start_idx + len(batch_embeddings)
+    h5f.flush()
+
+
+def _encode_unique_texts(
+    encoder,
+    texts: List[str],
+    h5f: h5py.File,
+    first_rows: Dict[bytes, int],
+    instruction: str,
+    cache: Optional[EmbeddingCache],
+    encoder_model: str,
+    template_source: str,
+) -> Tuple[np.ndarray, int, int]:
+    """
+    Encode a batch of texts, encoding each distinct text of the shard only once.
+
+    Texts are identified by a hash of their bytes. A text that already occurred
+    in the batch is copied from its first occurrence, and one that occurred in
+    an earlier batch is read back from the shard file.
+
+    Args:
+        encoder: The encoder instance.
+        texts (List[str]): Rendered texts of the batch.
+        h5f (h5py.File): Shard file the earlier batches were appended to.
+        first_rows (Dict[bytes, int]): Shard row of the first occurrence of every
+            text hash, updated with the texts of this batch.
+        instruction (str): Instruction passed to the encoder.
+        cache (Optional[EmbeddingCache]): Embedding cache, or None to always encode.
+        encoder_model (str): Name of the encoder model, part of the cache key.
+        template_source (str): Source of the template, part of the cache key.
+
+    Returns:
+        Tuple[np.ndarray, int, int]: Embeddings of shape (len(texts), dim), the number
+        of cache hits and the number of duplicate texts that were not encoded.
+    """
+    start_row = h5f["embeddings"].shape[0] if "embeddings" in h5f else 0
+    source_rows = np.empty(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        source_rows[i] = first_rows.setdefault(_text_hash(text), start_row + i)
+
+    positions = np.arange(len(texts))
+    unique = source_rows == start_row + positions
+    num_duplicates = len(texts) - int(unique.sum())
+
+    num_cache_hits = 0
+    if unique.any():
+        unique_embeddings, num_cache_hits = _encode_with_cache(
+            encoder,
+            [texts[i] for i in np.flatnonzero(unique)],
+            instruction,
+            cache,
+            encoder_model,
+            template_source,
+        )
+        dim = unique_embeddings.shape[1]
+    else:
+        dim = h5f["embeddings"].shape[1]
+    embeddings = np.empty((len(texts), dim), dtype=np.float32)
+    if unique.any():
+        embeddings[unique] = unique_embeddings
+
+    in_batch = ~unique & (source_rows >= start_row)
+    embeddings[in_batch] = embeddings[source_rows[in_batch] - start_row]
+    earlier = source_rows < start_row
+    if earlier.any():
+        # HDF5 point selections must be increasing
+        rows, inverse = np.unique(source_rows[earlier], return_inverse=True)
+        embeddings[earlier] = h5f["embeddings"][rows][inverse]
+    return embeddings, num_cache_hits, num_duplicates
+
+
+def _encode_with_cache(
+    encoder,
+    texts: List[str],
+    instruction: str,
+    cache: Optional[EmbeddingCache],
+    encoder_model: str,
+    template_source: str,
+) -> Tuple[np.ndarray, int]:
+    """
+    Encode a batch of texts, reusing cached embeddings when a cache is configured.
+
+    Args:
+        encoder: The encoder instance.
+        texts (List[str]): Rendered texts to encode.
+        instruction (str): Instruction passed to the encoder.
+        cache (Optional[EmbeddingCache]): Embedding cache, or None to always encode.
+        encoder_model (str): Name of the encoder model, part of the cache key.
+        template_source (str): Source of the template, part of the cache key.
+
+    Returns:
+        Tuple[np.ndarray, int]: Embeddings of shape (len(texts), dim) and the number of cache hits.
+    """
+    if cache is None:
+        embeddings = encoder.encode(inputs=texts, instruction=instruction)
+        return embeddings.cpu().numpy(), 0
+
+    keys = [
+        EmbeddingCache.make_key(text, encoder_model, instruction, template_source)
+        for text in texts
+    ]
+    found = cache.get_many(keys)
+    num_hits = sum(1 for key in keys if key in found)
+
+    # Encode each missing text once, even if it repeats within the batch
+    missing = {
+        key: text for key, text in zip(keys, texts, strict=True) if key not in found
+    }
+    if missing:
+        missing_keys = list(missing)
+        new_embeddings = (
+            encoder.encode(inputs=list(missing.values()), instruction=instruction)
+            .cpu()
+            .numpy()
+        )
+        cache.put_many(missing_keys, new_embeddings)
+        found.update(zip(missing_keys, new_embeddings, strict=True))
+
+    embeddings = np.stack([found[key] for key in keys]).astype(np.float32, copy=False)
+    return embeddings, num_hits
+
+
+def _source_fingerprint(dataset) -> Optional[str]:
+    """
+    Identify the input of a dataset from metadata only, without reading its rows.
+
+    ``datasets`` fingerprints a loaded dataset from the paths and modification
+    times of its files and the transforms applied since, and a
+    ``StreamingDataset`` fingerprints its files' metadata and row index. Datasets
+    built in memory may have a random fingerprint, so their rows are always
+    hashed.
+    """
+    if isinstance(dataset, StreamingDataset):
+        return dataset.fingerprint()
+    return getattr(dataset, "_fingerprint", None)
+
+
+def _block_digests(dataset, start_row: int, end_row: int) -> List[str]:
+    """
+    Hash the rows from ``start_row`` to ``end_row`` in blocks of
+    ``FINGERPRINT_BLOCK_ROWS`` rows.
+
+    ``start_row`` must be a multiple of the block size, so blocks always start
+    at the same rows and the digests of the full blocks of a prefix do not
+    depend on how many rows follow it; only the last block may be partial.
+    """
+    if not isinstance(dataset, StreamingDataset):
+        dataset = dataset.with_format("arrow")
+    digests = []
+    for start in range(start_row, end_row, FINGERPRINT_BLOCK_ROWS):
+        end = min(start + FINGERPRINT_BLOCK_ROWS, end_row)
+        if isinstance(dataset, StreamingDataset):
+            digests.append(dataset.select(range(start, end)).digest())
+        else:
+            digests.append(table_digest(dataset[start:end]))
+    return digests
+
+
+def _input_fingerprint(block_digests: List[str]) -> str:
+    """Combine the block digests of all rows into one fingerprint."""
+    return hashlib.sha256("".join(block_digests).encode("utf-8")).hexdigest()
+
+
+def _is_prefix(dataset, manifest: Dict[str, Any], block_digests: List[str]) -> bool:
+    """
+    Check whether the rows recorded in a manifest are a prefix of the dataset.
+
+    Only a partial last block of the manifest is hashed again, since it covers
+    fewer rows than the block of the dataset starting at the same row.
+    """
+    full_blocks, partial_rows = divmod(manifest["row_count"], FINGERPRINT_BLOCK_ROWS)
+    if block_digests[:full_blocks] != manifest["block_digests"][:full_blocks]:
+        return False
+    if not partial_rows:
+        return True
+    return (
+        _block_digests(
+            dataset, full_blocks * FINGERPRINT_BLOCK_ROWS, manifest["row_count"]
+        )
+        == manifest["block_digests"][full_blocks:]
+    )
+
+
+def _read_manifest(manifest_path: str) -> Optional[Dict[str, Any]]:
+    """Read an embeddings manifest, returning None if it is missing or unreadable."""
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    keys = ("input_fingerprint", "row_count", "block_digests", "settings")
+    if not all(k in manifest for k in keys):
+        return None
+    # Digests of blocks of another size cannot be compared
+    if manifest.get("block_rows") != FINGERPRINT_BLOCK_ROWS:
+        return None
+    return manifest
+
+
+def _write_manifest(manifest_path: str, manifest: Dict[str, Any]) -> None:
+    """Atomically write an embeddings manifest."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def _make_embeddings_resizable(merged_file: str) -> None:
+    """Rewrite a fixed-size embeddings file into a chunked, resizable one."""
+    tmp_file = merged_file + ".tmp"
+    with h5py.File(merged_file, "r") as src_f, h5py.File(tmp_file, "w") as dst_f:
+        src = src_f["embeddings"]
+        dst = dst_f.create_dataset(
+            "embeddings",
+            shape=src.shape,
+            maxshape=(None, src.shape[1]),
+            chunks=(min(1024, max(1, src.shape[0])), src.shape[1]),
+            dtype=src.dtype,
+        )
+        for start in range(0, src.shape[0], 65536):
+            dst[start : start + 65536] = src[start : start + 65536]
+    os.replace(tmp_file, merged_file)
 
 
-def _merge_shard_files(shard_files, merged_file):
+def _merge_shard_files(
+    shard_groups: List[Tuple[List[str], Optional[np.ndarray]]],
+    merged_file: str,
+    append: bool = False,
+):
     """
     Merge all shard files into a single embeddings file.
+
+    Every group holds the shard files of one rank, in row order, and for every
+    row of the rank the row of its embedding in those files, or None if they
+    hold one embedding per row. The embedding of a text encoded once is thereby
+    copied to every row holding the text.
+
+    With ``append`` the rows are added after the rows already stored in
+    ``merged_file``.
     """
+    shard_files = [f for files, _ in shard_groups for f in files]
     logger.info(f"Merging {len(shard_files)} shard files into {merged_file}")
 
     # Get the shape and type of embeddings from the first shard
@@ -701,33 +2400,75 @@ def _merge_shard_files(shard_files, merged_file):
         embedding_dim = first_embeddings.shape[1]
         dtype = first_embeddings.dtype
 
-    # Count total samples across all shards
-    total_samples = 0
-    for shard_file in shard_files:
-        with h5py.File(shard_file, "r") as f:
-            total_samples += f["embeddings"].shape[0]
-
-    # Create the merged file
-    with h5py.File(merged_file, "w") as merged_f:
-        merged_dataset = merged_f.create_dataset(
-            "embeddings", shape=(total_samples, embedding_dim), dtype=dtype
+    # Count the embeddings of every group and the rows they are copied to
+    group_embeddings = []
+    for files, _ in shard_groups:
+        num_embeddings = 0
+        for shard_file in files:
+            with h5py.File(shard_file, "r") as f:
+                num_embeddings += f["embeddings"].shape[0]
+        group_embeddings.append(num_embeddings)
+    total_samples = sum(
+        num_embeddings if source_rows is None else len(source_rows)
+        for num_embeddings, (_, source_rows) in zip(
+            group_embeddings, shard_groups, strict=True
         )
+    )
 
-        # Copy embeddings from each shard
-        start_idx = 0
-        for shard_file in shard_files:
-            with h5py.File(shard_file, "r") as shard_f:
-                embeddings = shard_f["embeddings"][:]
-                end_idx = start_idx + embeddings.shape[0]
-                merged_dataset[start_idx:end_idx] = embeddings
-                start_idx = end_idx
-
-            # Remove shard file after merging
-            os.remove(shard_file)
-            # Remove shard directory if empty
-            shard_dir = os.path.dirname(shard_file)
-            if not os.listdir(shard_dir):
-                os.rmdir(shard_dir)
+    if append:
+        with h5py.File(merged_file, "r") as merged_f:
+            resizable = merged_f["embeddings"].maxshape[0] is None
+        if not resizable:
+            _make_embeddings_resizable(merged_file)
+
+    # Create the merged file, or extend it when appending
+    with h5py.File(merged_file, "a" if append else "w") as merged_f:
+        if append:
+            merged_dataset = merged_f["embeddings"]
+            start_idx = merged_dataset.shape[0]
+            merged_dataset.resize(start_idx + total_samples, axis=0)
+        else:
+            merged_dataset = merged_f.create_dataset(
+                "embeddings",
+                shape=(total_samples, embedding_dim),
+                maxshape=(None, embedding_dim),
+                chunks=(min(1024, total_samples), embedding_dim),
+                dtype=dtype,
+            )
+            start_idx = 0
+
+        for num_embeddings, (files, source_rows) in zip(
+            group_embeddings, shard_groups, strict=True
+        ):
+            if source_rows is None:
+                # Copy embeddings from each shard
+                for embeddings in _read_shard_chunks(files):
+                    end_idx = start_idx + embeddings.shape[0]
+                    merged_dataset[start_idx:end_idx] = embeddings
+                    start_idx = end_idx
+                continue
+
+            # The shard embeddings are gathered into a temporary memory-mapped
+            # file, from which every row reads the embedding of its text
+            unique_file = f"{merged_file}.unique.npy"
+            unique_embeddings = np.lib.format.open_memmap(
+                unique_file,
+                mode="w+",
+                dtype=dtype,
+                shape=(num_embeddings, embedding_dim),
+            )
+            row = 0
+            for embeddings in _read_shard_chunks(files):
+                unique_embeddings[row : row + embeddings.shape[0]] = embeddings
+                row += embeddings.shape[0]
+            for chunk_start in range(0, len(source_rows), 65536):
+                rows = source_rows[chunk_start : chunk_start + 65536]
+                merged_dataset[start_idx : start_idx + len(rows)] = unique_embeddings[
+                    rows
+                ]
+                start_idx += len(rows)
+            del unique_embeddings
+            os.remove(unique_file)
 
     device_label = "GPUs" if torch.cuda.is_available() else "CPU workers"
     logger.info(
@@ -735,119 +2476,456 @@ def _merge_shard_files(shard_files, merged_file):
     )
 
 
-def process_folds_with_gpu(args):
+def _read_shard_chunks(
+    shard_files: List[str], chunk_size: int = 65536
+) -> Iterator[np.ndarray]:
+    """Read the embeddings of shard files in order, removing each file once read."""
+    for shard_file in shard_files:
+        with h5py.File(shard_file, "r") as shard_f:
+            shard_embeddings = shard_f["embeddings"]
+            for chunk_start in range(0, shard_embeddings.shape[0], chunk_size):
+                yield shard_embeddings[chunk_start : chunk_start + chunk_size]
+
+        # Remove shard file after merging
+        os.remove(shard_file)
+        # Remove shard directory if empty
+        shard_dir = os.path.dirname(shard_file)
+        if not os.listdir(shard_dir):
+            os.rmdir(shard_dir)
+
+
+def _ensure_npy_embeddings(h5_path: str, chunk_size: int = 65536) -> str:
     """
-    Process folds on GPU or CPU with support for both percentage and absolute size specifications.
+    Ensure a raw ``.npy`` copy of an HDF5 embeddings file exists next to it.
+
+    The copy is (re)written in chunks whenever it is missing, older than the
+    HDF5 file or of a different shape, so re-runs on existing embeddings only
+    need to map it.
+
+    Args:
+        h5_path (str): Path of the HDF5 embeddings file.
+        chunk_size (int): Number of rows copied at a time.
+
+    Returns:
+        str: Path of the ``.npy`` file.
     """
-    (
-        gpu_id,
-        gpu_folds_info,
+    npy_path = os.path.splitext(h5_path)[0] + ".npy"
+    with h5py.File(h5_path, "r") as f:
+        h5_embeddings = f["embeddings"]
+        if os.path.exists(npy_path) and os.path.getmtime(
+            npy_path
+        ) >= os.path.getmtime(h5_path):
+            existing = np.load(npy_path, mmap_mode="r")
+            if existing.shape == h5_embeddings.shape:
+                return npy_path
+            del existing
+
+        logger.info(f"Writing memory-mappable embeddings to {npy_path}")
+        tmp_path = npy_path + ".tmp"
+        npy_embeddings = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=h5_embeddings.shape
+        )
+        for start in range(0, h5_embeddings.shape[0], chunk_size):
+            npy_embeddings[start : start + chunk_size] = h5_embeddings[
+                start : start + chunk_size
+            ]
+        npy_embeddings.flush()
+        del npy_embeddings
+    os.replace(tmp_path, npy_path)
+    return npy_path
+
+
+def _cluster_embeddings(
+    embeddings_path: str,
+    num_clusters: int,
+    device: str,
+    seed: int,
+    sample_indices: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Cluster the published embeddings (or the rows in ``sample_indices``) and
+    return the cluster of every sample.
+    """
+    embeddings = torch.from_numpy(attach_array(embeddings_path))
+    _, assignments = minibatch_kmeans(
         embeddings,
-        subset_sizes,
-        total_samples,
-        epsilon,
-        testing_mode,
-    ) = args
+        num_clusters=num_clusters,
+        device=device,
+        seed=seed,
+        rows=None if sample_indices is None else torch.from_numpy(sample_indices),
+    )
+    return assignments.numpy()
+
+
+def _find_near_duplicates(
+    embeddings_path: str,
+    threshold: float,
+    device: str,
+    ivf_params: Optional[Dict[str, int]],
+    seed: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find near-duplicates among the published embeddings."""
+    embeddings = torch.from_numpy(attach_array(embeddings_path))
+    return find_near_duplicates(
+        embeddings, threshold, device=device, ivf_params=ivf_params, seed=seed
+    )
 
-    # Third Party
-    # pylint: disable=import-error, import-outside-toplevel
-    from submodlib import FacilityLocationFunction
 
-    try:
-        if torch.cuda.is_available():
-            torch.cuda.set_device(gpu_id)
-            device = f"cuda:{gpu_id}"
-        else:
-            if not testing_mode:
-                raise RuntimeError("GPU processing required but CUDA is not available")
-            logger.warning(
-                "Running in CPU mode for testing. Production use requires GPU acceleration."
-            )
-            device = "cpu"
-
-        results = []
-        for fold_idx, fold_indices in gpu_folds_info:
-            try:
-                logger.info(f"Processing fold {fold_idx + 1} on GPU {gpu_id}")
+def _select_fold(
+    fold_idx: int,
+    fold_indices: np.ndarray,
+    embeddings: torch.Tensor,
+    device: str,
+    subset_sizes: List[Union[int, float]],
+    total_samples: int,
+    epsilon: float,
+    similarity_mode: str,
+    num_neighbors: int,
+    optimizer_backend: str = "submodlib",
+    seed: Optional[int] = None,
+    oversampling: float = 1.0,
+    ivf_params: Optional[Dict[str, int]] = None,
+    label: Optional[str] = None,
+    stats: Optional[Dict[str, float]] = None,
+) -> Dict[Union[int, float], Dict[str, list]]:
+    """
+    Select subsets of all requested sizes from a single fold.
+
+    With ``oversampling`` above 1, every budget is enlarged by that factor (up
+    to the fold size) to leave candidates for a second selection round. With
+    ``ivf_params``, the neighbours of the 'sparse_knn' kernel are found with an
+    approximate IVF index built with these parameters. If ``stats`` is given,
+    the fold size, the time and floating-point operations of the similarity
+    computation, the maximization time and the peak device memory are stored
+    in it.
+
+    Returns:
+        Dict mapping each subset size to the selected global indices and their gains.
+    """
+    native = optimizer_backend == "native"
+    label = label or f"fold {fold_idx + 1}"
+    if not native:
+        # Third Party
+        # pylint: disable=import-error, import-outside-toplevel
+        from submodlib import FacilityLocationFunction
+
+    if stats is None:
+        stats = {}
+    cuda = device.startswith("cuda")
+    if cuda:
+        torch.cuda.reset_peak_memory_stats(device)
 
-                fold_embeddings = embeddings[fold_indices].to(device)
+    try:
+        fold_embeddings = embeddings[fold_indices].to(device)
+        stats["size"] = len(fold_indices)
+        start = time.perf_counter()
 
-                logger.info(f"Computing similarity matrix for fold {fold_idx + 1}")
-                max_sim_mat = compute_pairwise_dense(
+        subsets = {}
+        if similarity_mode == "sparse_knn":
+            logger.info(
+                f"Computing {num_neighbors}-nearest-neighbour similarity kernel for {label}"
+            )
+            if ivf_params is not None:
+                knn_values, knn_indices = build_knn_graph(
+                    fold_embeddings,
+                    num_neighbors=num_neighbors,
+                    device=device,
+                    scaling="additive",
+                    seed=seed,
+                    **ivf_params,
+                )
+            else:
+                knn_values, knn_indices = compute_pairwise_sparse_knn(
                     fold_embeddings,
-                    batch_size=50000,
+                    num_neighbors=num_neighbors,
+                    batch_size=10000,
                     metric="cosine",
                     device=device,
                     scaling="additive",
                 )
-                similarity_matrix = max_sim_mat.cpu().numpy()
+            if native:
+                ds_func = FacilityLocation.from_knn(
+                    knn_values.to(device), knn_indices.to(device)
+                )
+            else:
+                similarity_matrix = build_sparse_knn_kernel(
+                    knn_values, knn_indices, num_columns=len(fold_indices)
+                )
+                ds_func = FacilityLocationFunction(
+                    n=similarity_matrix.shape[0],
+                    sijs=similarity_matrix,
+                    mode="sparse",
+                    num_neighbors=min(num_neighbors, similarity_matrix.shape[0]),
+                )
+            del knn_values, knn_indices
+            if ivf_params is None:
+                # The exact search computes every pairwise dot product
+                stats["similarity_flops"] = (
+                    2 * len(fold_indices) ** 2 * fold_embeddings.size(1)
+                )
+        else:
+            logger.info(f"Computing similarity matrix for {label}")
+            similarity_matrix = compute_pairwise_dense_streaming(
+                fold_embeddings,
+                # The native optimizer reads the kernel where it was computed
+                out=(
+                    torch.empty(len(fold_indices), len(fold_indices), device=device)
+                    if native
+                    else None
+                ),
+                batch_size=50000,
+                metric="cosine",
+                device=device,
+                scaling="additive",
+            )
 
-                subsets = {}
+            if native:
+                # A self-similarity kernel is symmetric
+                ds_func = FacilityLocation(similarity_matrix, symmetric=True)
+            else:
                 ds_func = FacilityLocationFunction(
                     n=similarity_matrix.shape[0],
                     sijs=similarity_matrix,
                     mode="dense",
                     separate_rep=False,
                 )
+            stats["similarity_flops"] = (
+                2 * len(fold_indices) ** 2 * fold_embeddings.size(1)
+            )
+        if cuda:
+            torch.cuda.synchronize(device)
+        stats["similarity_seconds"] = time.perf_counter() - start
+
+        budgets = {}
+        for size_spec in subset_sizes:
+            if isinstance(size_spec, float):
+                # Percentage-based selection
+                budget = max(1, math.ceil(size_spec * len(fold_indices)))
+            else:
+                # Absolute number-based selection
+                budget = max(
+                    1,
+                    math.ceil(size_spec * (len(fold_indices) / total_samples)),
+                )
+            if oversampling > 1:
+                budget = max(
+                    budget,
+                    min(math.ceil(budget * oversampling), len(fold_indices) - 1),
+                )
+            budgets[size_spec] = budget
+
+        # Greedy selection is nested: the subset for a smaller budget is a
+        # prefix of the gain-ordered result for the largest one, so a single
+        # maximize call per fold serves all subset sizes
+        max_budget = max(budgets.values())
+        logger.info(f"Selecting subset of size {max_budget} for {label}")
+        start = time.perf_counter()
+
+        if native:
+            subset_result = ds_func.maximize(
+                budget=max_budget,
+                optimizer="LazierThanLazyGreedy",
+                epsilon=epsilon,
+                seed=None if seed is None else seed + fold_idx,
+            )
+        else:
+            subset_result = ds_func.maximize(
+                budget=max_budget,
+                optimizer="LazierThanLazyGreedy",
+                epsilon=epsilon,
+                stopIfZeroGain=False,
+                stopIfNegativeGain=False,
+                verbose=False,
+            )
+        stats["maximize_seconds"] = time.perf_counter() - start
+        stats["device_peak_bytes"] = (
+            torch.cuda.max_memory_allocated(device) if cuda else 0
+        )
 
-                for size_spec in subset_sizes:
-                    if isinstance(size_spec, float):
-                        # Percentage-based selection
-                        budget = max(
-                            1, math.ceil(size_spec * similarity_matrix.shape[0])
-                        )
-                    else:
-                        # Absolute number-based selection
-                        budget = max(
-                            1,
-                            math.ceil(
-                                size_spec * (similarity_matrix.shape[0] / total_samples)
-                            ),
-                        )
+        for size_spec, budget in budgets.items():
+            subsets[size_spec] = {
+                "indices": [fold_indices[x[0]] for x in subset_result[:budget]],
+                "gains": [x[1] for x in subset_result[:budget]],
+            }
 
-                    logger.info(
-                        f"Selecting subset of size {budget} for fold {fold_idx + 1}"
-                    )
+        return subsets
 
-                    subset_result = ds_func.maximize(
-                        budget=budget,
-                        optimizer="LazierThanLazyGreedy",
-                        epsilon=epsilon,
-                        stopIfZeroGain=False,
-                        stopIfNegativeGain=False,
-                        verbose=False,
-                    )
+    finally:
+        # Clean up variables to free memory
+        if "ds_func" in locals():
+            del ds_func
+        if "similarity_matrix" in locals():
+            del similarity_matrix
+        if "fold_embeddings" in locals():
+            del fold_embeddings
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+# Per-process state of the fold selection workers, set by _init_fold_worker
+_fold_worker_state: Dict[str, Any] = {}
+
+
+def _process_exists(pid: int) -> bool:
+    """Whether a process with the given id is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _init_fold_worker(
+    devices,
+    device_owners,
+    embeddings_path,
+    selection_args,
+    cpu_threads,
+    replaced_workers=None,
+):
+    """
+    Initialize a fold selection worker.
+
+    Each worker claims one of ``devices`` (a GPU or "cpu") by writing its process
+    id to the device's slot of ``device_owners``, and memory-maps the published
+    embeddings once for all folds it processes. A worker the pool starts to
+    replace a dead one (e.g. killed for running out of memory) takes over the
+    dead worker's device, since the pool has reaped it by then, and counts itself
+    in ``replaced_workers``.
+    """
+    with device_owners.get_lock():
+        for slot, owner in enumerate(device_owners):
+            if owner == 0 or not _process_exists(owner):
+                if owner != 0 and replaced_workers is not None:
+                    with replaced_workers.get_lock():
+                        replaced_workers.value += 1
+                device_owners[slot] = os.getpid()
+                device = devices[slot]
+                break
+        else:
+            raise RuntimeError("No free device for a new fold selection worker")
+    if device.startswith("cuda"):
+        torch.cuda.set_device(device)
+    else:
+        # Avoid oversubscribing cores shared with the other workers
+        torch.set_num_threads(cpu_threads)
+    _fold_worker_state["device"] = device
+    _fold_worker_state["embeddings"] = torch.from_numpy(attach_array(embeddings_path))
+    _fold_worker_state["selection_args"] = selection_args
+
+
+# Per-process state of the rendering workers, set by _init_render_worker
+_render_worker_state: Dict[str, Any] = {}
+
+
+def _init_render_worker(dataset, template_source: str):
+    """Initialize a rendering worker with the dataset and the template."""
+    _render_worker_state["dataset"] = dataset
+    _render_worker_state["template"] = Environment(loader=BaseLoader()).from_string(
+        template_source
+    )
+
+
+def _render_chunk_task(task):
+    """Render a chunk of rows into an Arrow file, unless an earlier attempt did."""
+    start, end, chunk_file = task
+    if os.path.exists(chunk_file):
+        return
+    template = _render_worker_state["template"]
+    texts = [
+        template.render(**example)
+        for example in _render_worker_state["dataset"].select(range(start, end))
+    ]
+    table = pa.table(
+        {
+            "text": pa.array(texts, type=pa.large_string()),
+            "hash": pa.array([_text_hash(text) for text in texts], type=pa.binary(16)),
+        }
+    )
+    # Written under a temporary name, so only complete chunks are ever reused
+    tmp_file = f"{chunk_file}.tmp"
+    with pa.OSFile(tmp_file, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_file, chunk_file)
 
-                    subset_indices = [fold_indices[x[0]] for x in subset_result]
-                    subset_gains = [x[1] for x in subset_result]
-                    subsets[size_spec] = {
-                        "indices": subset_indices,
-                        "gains": subset_gains,
-                    }
-
-                results.append((fold_idx, subsets))
-
-            except Exception as e:
-                logger.error(
-                    f"Error processing fold {fold_idx + 1} on GPU {gpu_id}: {str(e)}"
-                )
-                raise
-            finally:
-                # Clean up variables to free memory
-                if 'ds_func' in locals():
-                    del ds_func
-                if 'similarity_matrix' in locals():
-                    del similarity_matrix
-                if 'fold_embeddings' in locals():
-                    del fold_embeddings
-                gc.collect()
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-
-        return results
+
+# Per-process state of the subset materialization workers
+_materialize_worker_state: Dict[str, Any] = {}
+
+
+def _init_materialize_worker(dataset, input_file):
+    """Initialize a subset materialization worker with the dataset to read from."""
+    _materialize_worker_state["dataset"] = dataset
+    _materialize_worker_state["input_file"] = input_file
+
+
+def _materialize_subset_task(task):
+    """Write the rows of one subset, given in increasing order, to its file."""
+    indices, output_file = task
+    DataProcessor._save_subset(
+        _materialize_worker_state["dataset"].select(indices),
+        output_file,
+        _materialize_worker_state["input_file"],
+    )
+    return output_file, len(indices)
+
+
+def _select_fold_task(task):
+    """Select subsets from one fold pulled from the shared work queue."""
+    fold_idx, fold_indices = task
+    device = _fold_worker_state["device"]
+    stats = {}
+    try:
+        logger.info(f"Processing fold {fold_idx + 1} on {device}")
+        subsets = _select_fold(
+            fold_idx,
+            fold_indices,
+            _fold_worker_state["embeddings"],
+            device,
+            *_fold_worker_state["selection_args"],
+            stats=stats,
+        )
     except Exception as e:
-        logger.error(f"Error in process_folds_with_gpu on GPU {gpu_id}: {str(e)}")
+        logger.error(f"Error processing fold {fold_idx + 1} on {device}: {str(e)}")
         raise
+    return fold_idx, subsets, stats
+
+
+def _select_second_round_task(
+    fold_idx: int, candidates: np.ndarray, budget: int
+) -> Tuple[List[int], List[float]]:
+    """Select ``budget`` samples from the union of the fold winners."""
+    (
+        _,
+        _,
+        epsilon,
+        similarity_mode,
+        num_neighbors,
+        optimizer_backend,
+        seed,
+        _,
+        ivf_params,
+    ) = _fold_worker_state["selection_args"]
+    subsets = _select_fold(
+        fold_idx,
+        candidates,
+        _fold_worker_state["embeddings"],
+        _fold_worker_state["device"],
+        [budget],
+        len(candidates),
+        epsilon,
+        similarity_mode,
+        num_neighbors,
+        optimizer_backend,
+        seed,
+        ivf_params=ivf_params,
+        label="second round",
+    )
+    return subsets[budget]["indices"], subsets[budget]["gains"]
 
 
 def get_supported_encoders():
@@ -870,24 +2948,31 @@ def subset_datasets(
     """Create subsets of datasets using facility location for diverse subset selection."""
 
     # Get system's available GPU count
-    available_gpus = get_default_num_gpus(testing_mode=testing_mode)
-
-    # Create configuration groups
-    basic_config = BasicConfig()
-    encoder_config = EncoderConfig(testing_mode=testing_mode)
-    template_config = TemplateConfig()
-    system_config = SystemConfig(testing_mode=testing_mode)
-
-    # Update configuration groups from kwargs
+    cpu_mode = kwargs.get("cpu_mode", False)
+    available_gpus = get_default_num_gpus(testing_mode=testing_mode, cpu_mode=cpu_mode)
+
+    # Split kwargs between the configuration groups and create each group from
+    # its own, so that every group validates the values it is given
+    config_kwargs: Dict[type, Dict[str, Any]] = {
+        BasicConfig: {},
+        EncoderConfig: {"testing_mode": testing_mode},
+        TemplateConfig: {},
+        SystemConfig: {"testing_mode": testing_mode},
+    }
+    requested_gpus = kwargs.pop("num_gpus", None)
     for key, value in kwargs.items():
-        if hasattr(basic_config, key):
-            setattr(basic_config, key, value)
-        elif hasattr(encoder_config, key):
-            setattr(encoder_config, key, value)
-        elif hasattr(template_config, key):
-            setattr(template_config, key, value)
-        elif hasattr(system_config, key):
-            setattr(system_config, key, value)
+        for config_cls, group_kwargs in config_kwargs.items():
+            if key in {f.name for f in fields(config_cls) if f.init}:
+                group_kwargs[key] = value
+                break
+        else:
+            logger.warning(f"Ignoring unknown option {key!r}")
+    basic_config = BasicConfig(**config_kwargs[BasicConfig])
+    encoder_config = EncoderConfig(**config_kwargs[EncoderConfig])
+    template_config = TemplateConfig(**config_kwargs[TemplateConfig])
+    system_config = SystemConfig(**config_kwargs[SystemConfig])
+    if requested_gpus is not None:
+        system_config.num_gpus = requested_gpus
 
     # Ensure num_gpus doesn't exceed available GPUs
     if system_config.num_gpus > available_gpus:
@@ -908,6 +2993,8 @@ def subset_datasets(
     )
 
     try:
+        if system_config.distributed:
+            init_distributed(system_config.distributed_timeout_minutes)
         logger.info(f"Processing configuration: {config}")
         processor = DataProcessor(config)
         processor.process_files(input_files, config.basic.output_dir)
@@ -918,6 +3005,7 @@ def subset_datasets(
 
     finally:
         # Cleanup
+        cleanup()
         gc.collect()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
\ No newline at end of file
@@ -3,14 +3,30 @@ Utility functions for subset selection.
 """
 
 from .subset_selection_utils import (
+    attach_array,
+    build_sparse_knn_kernel,
     compute_pairwise_dense,
+    compute_pairwise_dense_streaming,
+    compute_pairwise_sparse_knn,
+    get_available_memory_bytes,
+    get_default_num_cpu_workers,
     get_default_num_gpus,
+    get_num_available_cores,
+    publish_array,
     retry_on_exception,
 )
 
 __all__ = [
+    "attach_array",
+    "build_sparse_knn_kernel",
     "compute_pairwise_dense",
+    "compute_pairwise_dense_streaming",
+    "compute_pairwise_sparse_knn",
+    "get_available_memory_bytes",
+    "get_default_num_cpu_workers",
     "get_default_num_gpus",
+    "get_num_available_cores",
+    "publish_array",
     "retry_on_exception",
 ]
 
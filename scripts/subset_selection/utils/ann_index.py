@@ -0,0 +1,324 @@
+# Standard
+from typing import Optional, Tuple, Union
+import logging
+import math
+
+# Third Party
+from torch import Tensor
+from torch.nn import functional as F
+import torch
+
+# Local
+from .clustering import assign_clusters, minibatch_kmeans
+
+logger = logging.getLogger(__name__)
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate cosine-similarity search.
+
+    Vectors are assigned to the nearest of ``num_lists`` k-means centroids, and a
+    query only scans the ``num_probes`` lists whose centroids are most similar
+    to it. With ``pq_subspaces`` set, vectors are stored as product-quantized
+    residuals from their centroid (one byte per subspace) instead of in full,
+    and similarities are estimated from the decoded residuals.
+    """
+
+    def __init__(
+        self,
+        num_lists: int,
+        num_probes: int = 8,
+        pq_subspaces: int = 0,
+        device: Optional[Union[str, torch.device]] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        """
+        Create an empty index.
+
+        Args:
+            num_lists (int): Number of inverted lists (coarse centroids).
+            num_probes (int): Number of lists scanned per query.
+            pq_subspaces (int): Number of product quantization subspaces, which must
+                divide the dimension. 0 stores the vectors uncompressed.
+            device (Optional[Union[str, torch.device]]): Device used for the computation.
+            seed (Optional[int]): Seed of the k-means training.
+        """
+        if num_lists <= 0 or num_probes <= 0:
+            raise ValueError("num_lists and num_probes must be positive")
+        if pq_subspaces < 0:
+            raise ValueError("pq_subspaces must not be negative")
+        if not device:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.num_lists = num_lists
+        self.num_probes = min(num_probes, num_lists)
+        self.pq_subspaces = pq_subspaces
+        self.device = device
+        self.seed = seed
+        self.centroids: Optional[Tensor] = None
+        self.codebooks: Optional[Tensor] = None
+        self.ntotal = 0
+
+    def train(self, vectors: Tensor, batch_size: int = 65536) -> None:
+        """
+        Train the coarse centroids (and PQ codebooks) on a set of vectors.
+
+        Args:
+            vectors (Tensor): Training vectors of shape (n, d), on any device.
+            batch_size (int): Number of vectors per mini-batch.
+        """
+        self.centroids, assignments = minibatch_kmeans(
+            vectors,
+            num_clusters=self.num_lists,
+            batch_size=batch_size,
+            device=self.device,
+            seed=self.seed,
+        )
+        if not self.pq_subspaces:
+            return
+
+        dimension = vectors.size(1)
+        if dimension % self.pq_subspaces:
+            raise ValueError(
+                f"pq_subspaces ({self.pq_subspaces}) must divide the dimension ({dimension})"
+            )
+        generator = torch.Generator()
+        if self.seed is not None:
+            generator.manual_seed(self.seed)
+        sample = torch.randperm(len(vectors), generator=generator)[:batch_size]
+        sample, _ = torch.sort(sample)
+        residuals = self._residuals(
+            vectors[sample].to(self.device).float(),
+            assignments[sample].to(self.device),
+        )
+        num_codes = min(256, len(residuals))
+        subvectors = residuals.view(len(residuals), self.pq_subspaces, -1)
+        self.codebooks = torch.stack(
+            [
+                _euclidean_kmeans(subvectors[:, m], num_codes, generator)
+                for m in range(self.pq_subspaces)
+            ]
+        )
+
+    def add(self, vectors: Tensor, batch_size: int = 65536) -> None:
+        """
+        Add vectors to the index. Their ids are their positions in ``vectors``.
+
+        Args:
+            vectors (Tensor): Vectors of shape (n, d), on any device.
+            batch_size (int): Number of vectors assigned at a time.
+        """
+        if self.centroids is None:
+            raise RuntimeError("The index must be trained before vectors are added")
+        if self.ntotal:
+            raise RuntimeError("Vectors can only be added to an empty index")
+
+        assignments = assign_clusters(
+            vectors, self.centroids, batch_size, self.device
+        ).to(self.device)
+        order = torch.argsort(assignments, stable=True)
+        counts = torch.bincount(assignments, minlength=self.num_lists)
+        self.list_offsets = torch.cat(
+            [torch.zeros(1, dtype=torch.long), torch.cumsum(counts.cpu(), dim=0)]
+        ).tolist()
+        self.ids = order
+
+        # Entries stored in list order, encoded in batches
+        entries = []
+        for start in range(0, len(order), batch_size):
+            batch_ids = order[start : start + batch_size]
+            batch = F.normalize(
+                vectors[batch_ids.cpu()].to(self.device).float(), p=2, dim=1
+            )
+            if self.pq_subspaces:
+                batch = self._encode(self._residuals(batch, assignments[batch_ids]))
+            entries.append(batch)
+        self.entries = torch.cat(entries)
+        self.ntotal = len(order)
+
+    def search(self, queries: Tensor, k: int) -> Tuple[Tensor, Tensor]:
+        """
+        Find the approximate ``k`` most similar indexed vectors of every query.
+
+        Args:
+            queries (Tensor): Query vectors of shape (nq, d), on any device.
+            k (int): Number of neighbours to return.
+
+        Returns:
+            Tuple[Tensor, Tensor]: Cosine similarities of shape (nq, k), sorted in
+            descending order, and the ids of the neighbours. Missing neighbours,
+            when the probed lists hold fewer than ``k`` vectors, have id -1 and
+            similarity -inf.
+        """
+        queries = F.normalize(queries.to(self.device).float(), p=2, dim=1)
+        num_queries = len(queries)
+        best_values = torch.full((num_queries, k), -math.inf, device=self.device)
+        best_ids = torch.full(
+            (num_queries, k), -1, dtype=torch.long, device=self.device
+        )
+
+        centroid_scores = queries @ self.centroids.T
+        probe_scores, probes = torch.topk(centroid_scores, self.num_probes, dim=1)
+        # Group the (query, list) pairs by list so each list is scanned once
+        probe_lists = probes.reshape(-1)
+        probe_queries = torch.arange(num_queries, device=self.device).repeat_interleave(
+            self.num_probes
+        )
+        probe_base = probe_scores.reshape(-1)
+        order = torch.argsort(probe_lists, stable=True)
+        probe_lists, probe_queries, probe_base = (
+            probe_lists[order],
+            probe_queries[order],
+            probe_base[order],
+        )
+        counts = torch.bincount(probe_lists, minlength=self.num_lists).cpu().tolist()
+
+        start = 0
+        for list_idx, count in enumerate(counts):
+            if count == 0:
+                continue
+            query_idx = probe_queries[start : start + count]
+            base = probe_base[start : start + count]
+            start += count
+            list_start, list_end = (
+                self.list_offsets[list_idx],
+                self.list_offsets[list_idx + 1],
+            )
+            if list_start == list_end:
+                continue
+
+            scores = self._scores(
+                queries[query_idx], base, self.entries[list_start:list_end]
+            )
+            list_ids = self.ids[list_start:list_end].expand(count, -1)
+            candidate_values = torch.cat([best_values[query_idx], scores], dim=1)
+            candidate_ids = torch.cat([best_ids[query_idx], list_ids], dim=1)
+            top_values, top_positions = torch.topk(candidate_values, k, dim=1)
+            best_values[query_idx] = top_values
+            best_ids[query_idx] = torch.gather(candidate_ids, 1, top_positions)
+
+        return best_values, best_ids
+
+    def _residuals(self, vectors: Tensor, assignments: Tensor) -> Tensor:
+        """Residuals of unit-norm vectors from their assigned centroids."""
+        return F.normalize(vectors, p=2, dim=1) - self.centroids[assignments]
+
+    def _encode(self, residuals: Tensor) -> Tensor:
+        """Product-quantize residuals into one uint8 code per subspace."""
+        subvectors = residuals.view(len(residuals), self.pq_subspaces, -1)
+        codes = torch.empty(
+            len(residuals), self.pq_subspaces, dtype=torch.uint8, device=self.device
+        )
+        for m in range(self.pq_subspaces):
+            codes[:, m] = torch.argmin(
+                torch.cdist(subvectors[:, m], self.codebooks[m]), dim=1
+            ).to(torch.uint8)
+        return codes
+
+    def _scores(self, queries: Tensor, base: Tensor, entries: Tensor) -> Tensor:
+        """
+        Similarities between queries probing one list and the list's entries.
+
+        ``base`` holds the similarity of every query to the list's centroid,
+        which the similarities to the PQ-encoded residuals are added to.
+        """
+        if not self.pq_subspaces:
+            return queries @ entries.T
+
+        # Decoding the list's residuals once turns scoring into a single matmul
+        codes = entries.long()
+        residuals = torch.cat(
+            [self.codebooks[m][codes[:, m]] for m in range(self.pq_subspaces)], dim=1
+        )
+        return base.unsqueeze(1) + queries @ residuals.T
+
+
+def build_knn_graph(
+    tensor: Tensor,
+    num_neighbors: int,
+    num_lists: Optional[int] = None,
+    num_probes: int = 8,
+    pq_subspaces: int = 0,
+    batch_size: int = 65536,
+    device: Optional[Union[str, torch.device]] = None,
+    scaling: Optional[str] = None,
+    seed: Optional[int] = None,
+) -> Tuple[Tensor, Tensor]:
+    """
+    Build an approximate cosine k-nearest-neighbour graph with an IVF index.
+
+    This is an approximate counterpart of compute_pairwise_sparse_knn for
+    datasets too large for an exact quadratic search: with the default
+    ``sqrt(n)`` lists, every vector is compared to about
+    ``num_probes * sqrt(n)`` others instead of ``n``.
+
+    Args:
+        tensor (Tensor): Vectors of shape (n, d), on any device.
+        num_neighbors (int): Number of neighbours to keep per vector.
+        num_lists (Optional[int]): Number of inverted lists. Defaults to sqrt(n).
+        num_probes (int): Number of lists scanned per vector.
+        pq_subspaces (int): Number of product quantization subspaces, 0 for none.
+        batch_size (int): Number of vectors searched at a time.
+        device (Optional[Union[str, torch.device]]): Device used for the computation.
+        scaling (Optional[str]): Optional "additive" scaling of the similarities
+            to [0, 1].
+        seed (Optional[int]): Seed of the index training.
+
+    Returns:
+        Tuple[Tensor, Tensor]: CPU tensors of shape (n, k) holding the neighbour
+        similarities (sorted in descending order) and their indices. Rows with
+        fewer than k candidates are padded with their own index and similarity 0.
+    """
+    assert num_neighbors > 0, "Number of neighbors must be positive."
+    if scaling not in (None, "additive"):
+        raise ValueError("Only additive scaling is supported for approximate graphs")
+
+    num_samples = len(tensor)
+    num_neighbors = min(num_neighbors, num_samples)
+    if num_lists is None:
+        num_lists = max(1, math.isqrt(num_samples))
+    num_lists = min(num_lists, num_samples)
+
+    index = IVFIndex(
+        num_lists,
+        num_probes=num_probes,
+        pq_subspaces=pq_subspaces,
+        device=device,
+        seed=seed,
+    )
+    index.train(tensor, batch_size=batch_size)
+    index.add(tensor, batch_size=batch_size)
+
+    knn_values = torch.empty(num_samples, num_neighbors, dtype=torch.float32)
+    knn_indices = torch.empty(num_samples, num_neighbors, dtype=torch.long)
+    for start in range(0, num_samples, batch_size):
+        end = min(start + batch_size, num_samples)
+        values, indices = index.search(tensor[start:end], num_neighbors)
+        if scaling == "additive":
+            values = (values + 1) / 2
+        missing = indices < 0
+        if missing.any():
+            rows = torch.arange(start, end, device=indices.device).unsqueeze(1)
+            indices = torch.where(missing, rows, indices)
+            values = values.masked_fill(missing, 0)
+        knn_values[start:end] = values.cpu()
+        knn_indices[start:end] = indices.cpu()
+    return knn_values, knn_indices
+
+
+def _euclidean_kmeans(
+    vectors: Tensor,
+    num_clusters: int,
+    generator: torch.Generator,
+    num_iterations: int = 20,
+) -> Tensor:
+    """Lloyd's k-means with euclidean distance, used to train PQ codebooks."""
+    initial = torch.randperm(len(vectors), generator=generator)[:num_clusters]
+    centroids = vectors[initial.to(vectors.device)].clone()
+    for _ in range(num_iterations):
+        assignments = torch.argmin(torch.cdist(vectors, centroids), dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, vectors)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        updated = counts > 0
+        centroids[updated] = sums[updated] / counts[updated].unsqueeze(1)
+    return centroids
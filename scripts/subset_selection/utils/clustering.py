@@ -0,0 +1,210 @@
+# Standard
+from typing import List, Optional, Tuple, Union
+import heapq
+import logging
+
+# Third Party
+from torch import Tensor
+from torch.nn import functional as F
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def assign_clusters(
+    embeddings: Tensor,
+    centroids: Tensor,
+    batch_size: int = 65536,
+    device: Optional[Union[str, torch.device]] = None,
+    rows: Optional[Tensor] = None,
+) -> Tensor:
+    """
+    Assign every embedding to its most similar centroid by cosine similarity.
+
+    Args:
+        embeddings (Tensor): Embeddings of shape (n, d), on any device.
+        centroids (Tensor): Unit-norm centroids of shape (k, d).
+        batch_size (int): Number of embeddings assigned at a time.
+        device (Optional[Union[str, torch.device]]): Device used for the computation.
+        rows (Optional[Tensor]): Rows of ``embeddings`` to assign, in place of all
+            of them. They are read a batch at a time, so memory-mapped embeddings
+            are never copied as a whole.
+
+    Returns:
+        Tensor: CPU tensor with the cluster of every embedding (or row).
+    """
+    if not device:
+        device = centroids.device
+    centroids = centroids.to(device)
+    num_samples = len(embeddings) if rows is None else len(rows)
+    assignments = torch.empty(num_samples, dtype=torch.long)
+    for start in range(0, num_samples, batch_size):
+        if rows is None:
+            batch = embeddings[start : start + batch_size]
+        else:
+            batch = embeddings[rows[start : start + batch_size]]
+        batch = F.normalize(batch.to(device).float(), p=2, dim=1)
+        assignments[start : start + batch_size] = torch.argmax(
+            batch @ centroids.T, dim=1
+        ).cpu()
+    return assignments
+
+
+def minibatch_kmeans(
+    embeddings: Tensor,
+    num_clusters: int,
+    batch_size: int = 65536,
+    num_iterations: int = 100,
+    device: Optional[Union[str, torch.device]] = None,
+    seed: Optional[int] = None,
+    rows: Optional[Tensor] = None,
+) -> Tuple[Tensor, Tensor]:
+    """
+    Cluster embeddings with mini-batch spherical k-means.
+
+    Centroids are seeded with k-means++ on a random mini-batch. Every iteration
+    then assigns a random mini-batch to the nearest centroids and moves each
+    centroid towards the mean of its new members, with a per-centroid learning
+    rate of one over the number of samples it has absorbed so far.
+    Centroids that have never been assigned a sample are re-seeded from the
+    batch. Only the mini-batch and the centroids are held on the device.
+
+    Args:
+        embeddings (Tensor): Embeddings of shape (n, d), on any device.
+        num_clusters (int): Number of clusters.
+        batch_size (int): Number of embeddings per mini-batch.
+        num_iterations (int): Number of mini-batch updates.
+        device (Optional[Union[str, torch.device]]): Device used for the computation.
+        seed (Optional[int]): Seed of the initialization and mini-batch sampling.
+        rows (Optional[Tensor]): Rows of ``embeddings`` to cluster, in place of all
+            of them. Only the sampled rows are read, so memory-mapped embeddings
+            are never copied as a whole.
+
+    Returns:
+        Tuple[Tensor, Tensor]: Unit-norm centroids of shape (num_clusters, d) and
+        CPU tensor with the cluster of every embedding (or row).
+    """
+    num_samples = len(embeddings) if rows is None else len(rows)
+    batch_size = min(batch_size, num_samples)
+    if not 0 < num_clusters <= num_samples:
+        raise ValueError(
+            f"num_clusters must be between 1 and the number of samples ({num_samples})"
+        )
+    if not device:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    generator = torch.Generator()
+    if seed is not None:
+        generator.manual_seed(seed)
+
+    def sample(size: int) -> Tensor:
+        indices = torch.randperm(num_samples, generator=generator)[:size]
+        if rows is not None:
+            indices = rows[indices]
+        # Sorted indices read memory-mapped embeddings sequentially
+        indices, _ = torch.sort(indices)
+        return F.normalize(embeddings[indices].to(device).float(), p=2, dim=1)
+
+    centroids = _kmeans_plus_plus(
+        sample(max(num_clusters, batch_size)), num_clusters, generator
+    )
+    counts = torch.zeros(num_clusters, device=device)
+
+    for _ in range(num_iterations):
+        batch = sample(batch_size)
+        assignments = torch.argmax(batch @ centroids.T, dim=1)
+        batch_counts = torch.bincount(assignments, minlength=num_clusters).float()
+        batch_sums = torch.zeros_like(centroids).index_add_(0, assignments, batch)
+
+        counts += batch_counts
+        updated = batch_counts > 0
+        # c <- c + (sum(x) - m * c) / n, the closed form of m sequential updates
+        # with learning rate 1 / n
+        centroids[updated] += (
+            batch_sums[updated]
+            - batch_counts[updated].unsqueeze(1) * centroids[updated]
+        ) / counts[updated].unsqueeze(1)
+        centroids = F.normalize(centroids, p=2, dim=1)
+
+        unused = torch.nonzero(counts == 0).squeeze(1)
+        if len(unused) > 0:
+            replacements = torch.randperm(len(batch), generator=generator)
+            centroids[unused] = batch[replacements[: len(unused)].to(device)]
+
+    return centroids, assign_clusters(
+        embeddings, centroids, batch_size, device, rows=rows
+    )
+
+
+def _kmeans_plus_plus(
+    samples: Tensor, num_clusters: int, generator: torch.Generator
+) -> Tensor:
+    """Pick initial centroids among unit-norm samples with k-means++ seeding."""
+    first = torch.randint(len(samples), (1,), generator=generator)
+    centroids = [samples[first.item()]]
+    # Squared euclidean distance of unit vectors is 2 - 2 * cosine similarity
+    distances = (2 - 2 * samples @ centroids[0]).clamp_(min=0)
+    for _ in range(1, num_clusters):
+        if distances.sum() > 0:
+            weights = distances.cpu()
+        else:
+            weights = torch.ones(len(samples))
+        index = torch.multinomial(weights, 1, generator=generator).item()
+        centroids.append(samples[index])
+        torch.minimum(
+            distances, (2 - 2 * samples @ samples[index]).clamp_(min=0), out=distances
+        )
+    return torch.stack(centroids)
+
+
+def balance_clusters(
+    assignments: np.ndarray, num_folds: int, seed: Optional[int] = None
+) -> List[np.ndarray]:
+    """
+    Pack clusters into folds of at most ``ceil(n / num_folds)`` samples.
+
+    Clusters are assigned, largest first, to the fold with the fewest samples so
+    far (longest-processing-time packing). A cluster that does not fit in that
+    fold fills it up and its remainder, a random part of the cluster, is packed
+    like any other cluster, so most folds are made of a few whole clusters.
+
+    Args:
+        assignments (np.ndarray): Cluster of every sample, of shape (n,).
+        num_folds (int): Number of folds.
+        seed (Optional[int]): Seed of the random splitting of clusters.
+
+    Returns:
+        List[np.ndarray]: Sample indices of every non-empty fold.
+    """
+    rng = np.random.default_rng(seed)
+    max_fold_size = -(-len(assignments) // num_folds)
+
+    order = np.argsort(assignments, kind="stable")
+    _, starts = np.unique(assignments[order], return_index=True)
+    clusters = np.split(order, starts[1:])
+    # Max-heap of clusters and cluster remainders by size
+    pending = [(-len(members), i) for i, members in enumerate(clusters)]
+    heapq.heapify(pending)
+
+    loads = [(0, fold_idx) for fold_idx in range(num_folds)]
+    fold_pieces: List[List[np.ndarray]] = [[] for _ in range(num_folds)]
+    while pending:
+        _, cluster_idx = heapq.heappop(pending)
+        members = clusters[cluster_idx]
+        load, fold_idx = heapq.heappop(loads)
+        free = max_fold_size - load
+        if len(members) > free:
+            members = rng.permutation(members)
+            clusters[cluster_idx] = members[free:]
+            heapq.heappush(pending, (-(len(members) - free), cluster_idx))
+            members = members[:free]
+        fold_pieces[fold_idx].append(members)
+        heapq.heappush(loads, (load + len(members), fold_idx))
+
+    folds = [np.concatenate(pieces) for pieces in fold_pieces if pieces]
+    logger.info(
+        f"Packed {len(clusters)} clusters into {len(folds)} folds of "
+        f"{min(map(len, folds))}-{max(map(len, folds))} samples"
+    )
+    return folds
@@ -0,0 +1,124 @@
+# Standard
+from typing import Dict, Optional, Tuple, Union
+import logging
+
+# Third Party
+from scipy import sparse
+from torch import Tensor
+from torch.nn import functional as F
+import numpy as np
+import torch
+
+# Local
+from .ann_index import build_knn_graph
+from .subset_selection_utils import compute_pairwise_sparse_knn
+
+logger = logging.getLogger(__name__)
+
+
+def find_near_duplicates(
+    embeddings: Tensor,
+    threshold: float,
+    num_neighbors: int = 16,
+    batch_size: int = 10000,
+    device: Optional[Union[str, torch.device]] = None,
+    ivf_params: Optional[Dict[str, int]] = None,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the rows that are near-duplicates of an earlier kept row.
+
+    Every row's ``num_neighbors`` most similar rows are found, either exactly
+    block by block or with an approximate IVF index. Pairs with an exact cosine
+    similarity of at least ``threshold`` link two rows. Rows are then visited
+    in order, and a row is removed if it is linked to an earlier row that was
+    kept, which becomes its representative (the most similar one, if several).
+    Similarity is not transitive, so a row is never removed because of a chain
+    of links: every removed row is at least ``threshold`` similar to its
+    representative. Links missing from the neighbour lists, e.g. within groups
+    larger than ``num_neighbors``, leave rows kept.
+
+    Args:
+        embeddings (Tensor): Embeddings of shape (n, d), on any device.
+        threshold (float): Minimum cosine similarity of near-duplicates.
+        num_neighbors (int): Number of neighbours searched per row.
+        batch_size (int): Number of rows processed at a time.
+        device (Optional[Union[str, torch.device]]): Device used for the computation.
+        ivf_params (Optional[Dict[str, int]]): Parameters of build_knn_graph to use
+            an approximate IVF index instead of an exact search.
+        seed (Optional[int]): Seed of the IVF index training.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Indices of the removed rows, in
+        increasing order, the kept row representing each of them, and the cosine
+        similarity between the two.
+    """
+    num_samples = len(embeddings)
+    # One extra neighbour, as every row is its own nearest neighbour
+    num_neighbors = min(num_neighbors + 1, num_samples)
+    if ivf_params is not None:
+        knn_values, knn_indices = build_knn_graph(
+            embeddings,
+            num_neighbors=num_neighbors,
+            batch_size=batch_size,
+            device=device,
+            seed=seed,
+            **ivf_params,
+        )
+    else:
+        knn_values, knn_indices = compute_pairwise_sparse_knn(
+            embeddings,
+            num_neighbors=num_neighbors,
+            batch_size=batch_size,
+            metric="cosine",
+            device=device,
+        )
+
+    rows = torch.arange(num_samples).unsqueeze(1).expand_as(knn_indices)
+    linked = (knn_values >= threshold) & (knn_indices != rows)
+    # Every link once, from the later to the earlier row
+    first, second = rows[linked].numpy(), knn_indices[linked].numpy()
+    later, earlier = np.maximum(first, second), np.minimum(first, second)
+    pairs = np.unique(later * num_samples + earlier)
+    later, earlier = np.divmod(pairs, num_samples)
+
+    # Exact similarities, as approximate (e.g. quantized) ones may be off
+    link_similarities = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), batch_size):
+        end = start + batch_size
+        link_similarities[start:end] = (
+            F.cosine_similarity(
+                embeddings[later[start:end]].float(),
+                embeddings[earlier[start:end]].float(),
+            )
+            .cpu()
+            .numpy()
+        )
+    close = link_similarities >= threshold
+    graph = sparse.csr_matrix(
+        (link_similarities[close], (later[close], earlier[close])),
+        shape=(num_samples, num_samples),
+    )
+
+    kept = np.ones(num_samples, dtype=bool)
+    representatives = np.arange(num_samples)
+    row_similarities = np.ones(num_samples, dtype=np.float32)
+    # Only rows linked to an earlier row can be removed; earlier rows are
+    # always decided first
+    for row in np.nonzero(np.diff(graph.indptr))[0]:
+        start, end = graph.indptr[row], graph.indptr[row + 1]
+        candidates = np.where(
+            kept[graph.indices[start:end]], graph.data[start:end], -np.inf
+        )
+        best = np.argmax(candidates)
+        if candidates[best] >= threshold:
+            kept[row] = False
+            representatives[row] = graph.indices[start + best]
+            row_similarities[row] = candidates[best]
+
+    removed = np.nonzero(~kept)[0]
+    logger.info(
+        f"Found {len(removed)} near-duplicates of {num_samples} rows "
+        f"at similarity {threshold}"
+    )
+    return removed, representatives[removed], row_similarities[removed]
@@ -0,0 +1,93 @@
+# Standard
+from datetime import timedelta
+from typing import Any, List, Optional, TypeVar
+import logging
+
+# Third Party
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def init_distributed(timeout_minutes: int = 1440) -> None:
+    """
+    Join the process group described by the torchrun environment variables.
+
+    The group only exchanges small Python objects (row ranges, shard lists,
+    fold indices and selections), so it always uses the gloo backend. NCCL
+    would also initialize CUDA in the main process, which must stay
+    CUDA-free because it forks the GPU workers.
+
+    Args:
+        timeout_minutes (int): How long a rank waits for the others at a
+            collective, e.g. while they are still encoding their rows.
+    """
+    if not dist.is_initialized():
+        dist.init_process_group(
+            backend="gloo", timeout=timedelta(minutes=timeout_minutes)
+        )
+    logger.info(
+        f"Joined the process group as rank {dist.get_rank()} "
+        f"of {dist.get_world_size()}"
+    )
+
+
+def cleanup() -> None:
+    """Leave the process group, if joined."""
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def get_rank() -> int:
+    """Rank of this process, 0 when not running distributed."""
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size() -> int:
+    """Number of ranks, 1 when not running distributed."""
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def barrier() -> None:
+    """Wait for all ranks, if running distributed."""
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def broadcast_object(obj: T, src: int = 0) -> T:
+    """
+    Send a picklable object from one rank to all others.
+
+    Args:
+        obj (T): Object to send; ignored on the other ranks.
+        src (int): Rank sending the object.
+
+    Returns:
+        T: The object of rank ``src``.
+    """
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def gather_objects(obj: Any, dst: int = 0) -> Optional[List[Any]]:
+    """
+    Collect a picklable object from every rank on one rank.
+
+    Args:
+        obj (Any): Object of this rank.
+        dst (int): Rank receiving the objects.
+
+    Returns:
+        Optional[List[Any]]: Objects of all ranks in rank order on rank ``dst``,
+        None on the other ranks.
+    """
+    if not dist.is_initialized():
+        return [obj]
+    objects = [None] * dist.get_world_size() if dist.get_rank() == dst else None
+    dist.gather_object(obj, objects, dst=dst)
+    return objects
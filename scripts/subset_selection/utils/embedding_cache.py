@@ -0,0 +1,176 @@
+# Standard
+from typing import Dict, List
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+# Third Party
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of bound parameters per statement
+_SQLITE_MAX_VARIABLES = 900
+
+
+class EmbeddingCache:
+    """
+    Persistent, size-capped embedding store keyed by content hash.
+
+    Entries are keyed by a hash of the rendered text, encoder model, instruction
+    and template, so any change to one of them results in a cache miss. The store
+    is a single SQLite database, which is safe to share between the per-GPU
+    worker processes. Least recently used entries are evicted once the stored
+    embeddings exceed ``max_size_bytes``. Their total size is kept up to date by
+    triggers in a one-row ``cache_meta`` table, so checking it is O(1).
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int) -> None:
+        """
+        Open (or create) the cache stored in ``cache_dir``.
+
+        Args:
+            cache_dir (str): Directory holding the cache database.
+            max_size_bytes (int): Maximum total size of the stored embeddings.
+        """
+        if max_size_bytes <= 0:
+            raise ValueError("max_size_bytes must be positive")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "embeddings.sqlite")
+        self.max_size_bytes = max_size_bytes
+        self.conn = sqlite3.connect(self.db_path, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Rows replaced by INSERT OR REPLACE only fire the delete trigger with
+        # recursive triggers enabled
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, "
+            "last_access REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access "
+            "ON embeddings (last_access)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_meta ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), total_size INTEGER NOT NULL)"
+        )
+        # Caches created before the running total was kept are summed once
+        self.conn.execute(
+            "INSERT OR IGNORE INTO cache_meta (id, total_size) "
+            "SELECT 0, COALESCE(SUM(size), 0) FROM embeddings"
+        )
+        self.conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_insert AFTER INSERT ON embeddings "
+            "BEGIN UPDATE cache_meta SET total_size = total_size + NEW.size; END"
+        )
+        self.conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_delete AFTER DELETE ON embeddings "
+            "BEGIN UPDATE cache_meta SET total_size = total_size - OLD.size; END"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(text: str, encoder_model: str, instruction: str, template: str) -> str:
+        """
+        Build the cache key of a rendered text.
+
+        Args:
+            text (str): The rendered text.
+            encoder_model (str): Name of the encoder model.
+            instruction (str): Instruction passed to the encoder.
+            template (str): Source of the Jinja template used to render the text.
+
+        Returns:
+            str: Hex digest identifying the embedding.
+        """
+        digest = hashlib.sha256()
+        for part in (encoder_model, instruction, template, text):
+            encoded = part.encode("utf-8")
+            # Length-prefix every part so different splits never collide
+            digest.update(len(encoded).to_bytes(8, "little"))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up embeddings and mark the hits as recently used.
+
+        Args:
+            keys (List[str]): Keys to look up.
+
+        Returns:
+            Dict[str, np.ndarray]: Embeddings of the keys found in the cache.
+        """
+        unique_keys = list(dict.fromkeys(keys))
+        found: Dict[str, np.ndarray] = {}
+        for start in range(0, len(unique_keys), _SQLITE_MAX_VARIABLES):
+            chunk = unique_keys[start : start + _SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self.conn.commit()
+        return found
+
+    def put_many(self, keys: List[str], embeddings: np.ndarray) -> None:
+        """
+        Store embeddings and evict old entries if the size cap is exceeded.
+
+        Args:
+            keys (List[str]): Keys of the embeddings.
+            embeddings (np.ndarray): Embeddings of shape (len(keys), dim).
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (key, vector.tobytes(), vector.nbytes, now)
+                for key, vector in zip(keys, embeddings, strict=True)
+            ],
+        )
+        self.conn.commit()
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete least recently used entries until the cache fits its size cap."""
+        (total_size,) = self.conn.execute(
+            "SELECT total_size FROM cache_meta"
+        ).fetchone()
+        excess = total_size - self.max_size_bytes
+        if excess <= 0:
+            return
+
+        evicted_keys = []
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM embeddings ORDER BY last_access"
+        ):
+            evicted_keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        self.conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted_keys)
+        self.conn.commit()
+        logger.info(f"Evicted {len(evicted_keys)} entries from embedding cache")
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        self.conn.close()
@@ -0,0 +1,262 @@
+# Standard
+from typing import List, Optional, Tuple
+import math
+
+# Third Party
+from torch import Tensor
+import torch
+
+OPTIMIZERS = ("NaiveGreedy", "LazyGreedy", "LazierThanLazyGreedy")
+
+
+class FacilityLocation:
+    """
+    Facility location function maximized directly on the device holding the kernel.
+
+    The function is ``f(A) = sum_i max_{j in A} K[i, j]``, where ``K`` is either a
+    dense (n, n) similarity tensor or a k-nearest-neighbour kernel in which row
+    ``i`` holds the similarities to its neighbours. Marginal gains are computed
+    for blocks of candidates at once, so the kernel never has to be copied back
+    to the host.
+    """
+
+    def __init__(
+        self,
+        kernel: Tensor,
+        symmetric: bool = False,
+        max_block_elements: int = 2**26,
+    ) -> None:
+        """
+        Create the function from a dense similarity kernel.
+
+        Args:
+            kernel (Tensor): float32 similarity kernel of shape (n, n).
+            symmetric (bool): Whether the kernel is symmetric, in which case
+                contiguous rows are read instead of strided columns.
+            max_block_elements (int): Upper bound on the size of the temporary
+                tensors used to compute marginal gains.
+        """
+        if kernel.dim() != 2 or kernel.size(0) != kernel.size(1):
+            raise ValueError(f"Kernel must be square, got shape {tuple(kernel.shape)}")
+        self.n = kernel.size(0)
+        self.device = kernel.device
+        self.kernel = kernel
+        self.symmetric = symmetric
+        self.max_block_elements = max_block_elements
+        self._sparse = False
+        self.current_max = torch.zeros(self.n, device=self.device)
+
+    @classmethod
+    def from_knn(
+        cls, knn_values: Tensor, knn_indices: Tensor, max_block_elements: int = 2**26
+    ) -> "FacilityLocation":
+        """
+        Create the function from per-row nearest neighbours.
+
+        Args:
+            knn_values (Tensor): Neighbour similarities of shape (n, k).
+            knn_indices (Tensor): Neighbour column indices of shape (n, k).
+            max_block_elements (int): Upper bound on the size of the temporary
+                tensors used to compute marginal gains.
+        """
+        self = cls.__new__(cls)
+        self.n, num_neighbors = knn_values.shape
+        self.device = knn_values.device
+        self.max_block_elements = max_block_elements
+        self._sparse = True
+        self.current_max = torch.zeros(self.n, device=self.device)
+
+        # Non-zeros in column-major order: the gain of candidate j is a sum over
+        # the rows that have j as a neighbour, and adding j updates those rows
+        rows = torch.arange(self.n, device=self.device).repeat_interleave(
+            num_neighbors
+        )
+        columns = knn_indices.reshape(-1).to(self.device)
+        order = torch.argsort(columns, stable=True)
+        self.columns = columns[order]
+        self.rows = rows[order]
+        self.values = knn_values.reshape(-1).float()[order]
+        counts = torch.bincount(columns, minlength=self.n)
+        offsets = torch.cat(
+            [torch.zeros(1, dtype=torch.long), torch.cumsum(counts.cpu(), dim=0)]
+        )
+        self.column_offsets = offsets.tolist()
+        self.column_offsets_tensor = offsets.to(self.device)
+        return self
+
+    def marginal_gains(self, candidates: Tensor) -> Tensor:
+        """
+        Compute the marginal gains of adding each candidate to the current set.
+
+        Args:
+            candidates (Tensor): Indices of the candidates on the kernel's device.
+
+        Returns:
+            Tensor: Marginal gains of shape (len(candidates),).
+        """
+        if self._sparse:
+            if len(candidates) == self.n:
+                return self._all_sparse_gains()[candidates]
+            return self._sparse_gains(candidates)
+
+        block_size = max(1, self.max_block_elements // self.n)
+        gains = torch.empty(len(candidates), device=self.device)
+        # Candidates along dim 0 (rows of a symmetric kernel) or dim 1 (columns)
+        dim = 0 if self.symmetric else 1
+        current_max = self.current_max.unsqueeze(dim)
+        for start in range(0, len(candidates), block_size):
+            block = self.kernel.index_select(
+                dim, candidates[start : start + block_size]
+            )
+            block.sub_(current_max).clamp_(min=0)
+            torch.sum(block, dim=1 - dim, out=gains[start : start + block_size])
+        return gains
+
+    def _all_sparse_gains(self) -> Tensor:
+        """Compute the marginal gains of all items in one pass over the kernel."""
+        gains = torch.zeros(self.n, device=self.device)
+        for start in range(0, self.values.numel(), self.max_block_elements):
+            end = start + self.max_block_elements
+            contributions = self.values[start:end] - self.current_max[
+                self.rows[start:end]
+            ]
+            gains.index_add_(0, self.columns[start:end], contributions.clamp_(min=0))
+        return gains
+
+    def _sparse_gains(self, candidates: Tensor) -> Tensor:
+        """
+        Compute the marginal gains of some items from their columns only.
+
+        The cost is the number of non-zeros in the candidates' columns, so that
+        the lazy optimizers' small batches do not pay for a pass over the kernel.
+        """
+        starts = self.column_offsets_tensor[candidates]
+        counts = self.column_offsets_tensor[candidates + 1] - starts
+        gains = torch.zeros(len(candidates), device=self.device)
+        # Position of every entry of the candidates' columns, and its candidate
+        owners = torch.repeat_interleave(
+            torch.arange(len(candidates), device=self.device), counts
+        )
+        first_entries = torch.cumsum(counts, dim=0) - counts
+        positions = torch.arange(len(owners), device=self.device)
+        positions += (starts - first_entries)[owners]
+        for start in range(0, len(positions), self.max_block_elements):
+            block = positions[start : start + self.max_block_elements]
+            contributions = self.values[block] - self.current_max[self.rows[block]]
+            gains.index_add_(
+                0,
+                owners[start : start + self.max_block_elements],
+                contributions.clamp_(min=0),
+            )
+        return gains
+
+    def add(self, item: int) -> None:
+        """Add an item to the current set."""
+        if self._sparse:
+            start, end = self.column_offsets[item], self.column_offsets[item + 1]
+            rows = self.rows[start:end]
+            self.current_max[rows] = torch.maximum(
+                self.current_max[rows], self.values[start:end]
+            )
+        else:
+            column = self.kernel[item] if self.symmetric else self.kernel[:, item]
+            torch.maximum(self.current_max, column, out=self.current_max)
+
+    def maximize(
+        self,
+        budget: int,
+        optimizer: str = "LazierThanLazyGreedy",
+        epsilon: float = 0.1,
+        lazy_batch_size: int = 64,
+        seed: Optional[int] = None,
+    ) -> List[Tuple[int, float]]:
+        """
+        Greedily select ``budget`` items.
+
+        ``LazyGreedy`` keeps an upper bound on every item's gain and re-evaluates
+        the ``lazy_batch_size`` most promising items at a time until the best
+        exact gain beats every remaining bound. ``LazierThanLazyGreedy`` does the
+        same over a random sample of the remaining items per step, of the size
+        submodlib uses: ``int(n / budget * log(1 / epsilon))`` items for
+        ``epsilon < 1``, and ``int(epsilon)`` items for ``epsilon >= 1``.
+
+        Args:
+            budget (int): Number of items to select, smaller than the ground set.
+            optimizer (str): "NaiveGreedy", "LazyGreedy" or "LazierThanLazyGreedy".
+            epsilon (float): Sampling parameter of LazierThanLazyGreedy, used as
+                the sample size from 1 upwards.
+            lazy_batch_size (int): Number of items re-evaluated at a time by the
+                lazy optimizers.
+            seed (Optional[int]): Seed of the sampling of LazierThanLazyGreedy.
+
+        Returns:
+            List[Tuple[int, float]]: Selected items and their marginal gains, in
+            the order in which they were selected.
+        """
+        if optimizer not in OPTIMIZERS:
+            raise ValueError(f"optimizer must be one of {', '.join(OPTIMIZERS)}")
+        if not 0 < budget < self.n:
+            raise ValueError("Budget must be positive and less than the ground set size")
+
+        sample_size = self.n
+        if optimizer == "LazierThanLazyGreedy":
+            if epsilon >= 1:
+                sample_size = int(epsilon)
+            else:
+                # Truncated like submodlib, but never empty
+                sample_size = max(1, int(self.n / budget * math.log(1 / epsilon)))
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+
+        all_items = torch.arange(self.n, device=self.device)
+        # Exact gains of the empty set are the initial upper bounds
+        upper_bounds = self.marginal_gains(all_items)
+        remaining = torch.ones(self.n, dtype=torch.bool, device=self.device)
+
+        selected = []
+        for step in range(budget):
+            if optimizer == "NaiveGreedy":
+                if step > 0:
+                    upper_bounds = self.marginal_gains(all_items)
+                upper_bounds[~remaining] = -math.inf
+                item = int(torch.argmax(upper_bounds))
+                gain = float(upper_bounds[item])
+            else:
+                candidates = torch.nonzero(remaining).squeeze(1)
+                if sample_size < len(candidates):
+                    sample = torch.randperm(len(candidates), generator=generator)
+                    candidates = candidates[sample[:sample_size].to(self.device)]
+                item, gain = self._lazy_argmax(
+                    candidates, upper_bounds, lazy_batch_size
+                )
+
+            selected.append((item, gain))
+            remaining[item] = False
+            upper_bounds[item] = -math.inf
+            self.add(item)
+        return selected
+
+    def _lazy_argmax(
+        self, candidates: Tensor, upper_bounds: Tensor, batch_size: int
+    ) -> Tuple[int, float]:
+        """
+        Find the candidate with the largest marginal gain using lazy evaluations.
+
+        ``upper_bounds`` is updated in place with the exact gains computed.
+        """
+        bounds = upper_bounds[candidates]
+        while True:
+            k = min(batch_size + 1, len(candidates))
+            top_bounds, top_positions = torch.topk(bounds, k)
+            batch = top_positions[:batch_size]
+            exact = self.marginal_gains(candidates[batch])
+            bounds[batch] = exact
+            upper_bounds[candidates[batch]] = exact
+
+            best = int(torch.argmax(exact))
+            best_gain = float(exact[best])
+            # By submodularity no other candidate can beat the best exact gain
+            # once it is at least the largest bound left unevaluated
+            if k <= batch_size or best_gain >= float(top_bounds[batch_size]):
+                return int(candidates[batch[best]]), best_gain
@@ -0,0 +1,208 @@
+# Standard
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import json
+import os
+import resource
+import sys
+import time
+
+MetricsHook = Callable[[str, float, Dict[str, str]], None]
+
+PROMETHEUS_PREFIX = "subset_selection"
+# Fold statistics that are also summed over all folds
+FOLD_TOTALS = ("similarity_seconds", "similarity_flops", "maximize_seconds")
+
+
+class MetricsRecorder:
+    """
+    Structured metrics of one subset selection run on one dataset.
+
+    Stage timings, counters, peak gauges and per-fold statistics are collected
+    as the pipeline runs. Every observation is also passed to an optional hook,
+    called as ``hook(name, value, labels)``, so that metrics can be forwarded to
+    an external system as they happen. At the end of the run the metrics are
+    written as a JSON report. The Prometheus text format file, if any, is also
+    rewritten whenever a stage ends, so running and failed runs expose metrics.
+    """
+
+    def __init__(
+        self,
+        dataset_name: str,
+        hook: Optional[MetricsHook] = None,
+        prometheus_path: Optional[str] = None,
+    ) -> None:
+        """
+        Create an empty recorder.
+
+        Args:
+            dataset_name (str): Name of the dataset, added as a label to every metric.
+            hook (Optional[MetricsHook]): Called with every observation.
+            prometheus_path (Optional[str]): Prometheus text format file rewritten
+                at the end of every stage.
+        """
+        self.dataset_name = dataset_name
+        self.hook = hook
+        self.prometheus_path = prometheus_path
+        self.started_at = time.time()
+        self.stages: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        self.peaks: Dict[str, float] = {}
+        self.folds: List[Dict[str, Any]] = []
+
+    def _emit(self, name: str, value: float, **labels: str) -> None:
+        """Pass an observation to the hook."""
+        if self.hook is not None:
+            self.hook(name, value, {"dataset": self.dataset_name, **labels})
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage; repeated stages (e.g. retries) accumulate."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            self._emit("stage_seconds", elapsed, stage=name)
+            if self.prometheus_path is not None:
+                self.write_prometheus(self.prometheus_path)
+
+    def add(self, name: str, value: float) -> None:
+        """Add to a counter."""
+        self.counters[name] = self.counters.get(name, 0.0) + value
+        self._emit(name, value)
+
+    def add_file_bytes(self, name: str, path: str) -> None:
+        """Add the size of a file, if it exists, to a byte counter."""
+        if os.path.exists(path):
+            self.add(name, os.path.getsize(path))
+
+    def observe_peak(self, name: str, value: float) -> None:
+        """Keep the largest value observed for a gauge."""
+        self.peaks[name] = max(self.peaks.get(name, 0.0), value)
+        self._emit(name, value)
+
+    def record_fold(self, fold_idx: int, stats: Dict[str, float]) -> None:
+        """
+        Record the statistics of one fold selection.
+
+        Args:
+            fold_idx (int): Index of the fold.
+            stats (Dict[str, float]): Statistics reported by the fold worker, such
+                as ``similarity_seconds``, ``similarity_flops`` and
+                ``maximize_seconds``.
+        """
+        self.folds.append({"fold": fold_idx, **stats})
+        for name, value in stats.items():
+            self._emit(f"fold_{name}", value, fold=str(fold_idx))
+            if name in FOLD_TOTALS:
+                self.counters[name] = self.counters.get(name, 0.0) + value
+            elif name == "device_peak_bytes":
+                self.peaks[name] = max(self.peaks.get(name, 0.0), value)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Derive the run summary from the collected metrics.
+
+        Returns:
+            Dict[str, Any]: Stage timings, counters, peaks, throughput figures and
+            per-fold statistics.
+        """
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        peaks = dict(self.peaks)
+        peaks["host_peak_bytes"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        )
+        peaks["worker_host_peak_bytes"] = (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        )
+
+        throughput = {}
+        if self.stages.get("encode") and self.counters.get("encoded_rows"):
+            throughput["encode_samples_per_second"] = (
+                self.counters["encoded_rows"] / self.stages["encode"]
+            )
+        if self.counters.get("similarity_seconds") and self.counters.get(
+            "similarity_flops"
+        ):
+            throughput["similarity_gflops_per_second"] = (
+                self.counters["similarity_flops"]
+                / self.counters["similarity_seconds"]
+                / 1e9
+            )
+
+        return {
+            "dataset": self.dataset_name,
+            "started_at": self.started_at,
+            "duration_seconds": time.time() - self.started_at,
+            "stages": self.stages,
+            "counters": self.counters,
+            "peaks": peaks,
+            "throughput": throughput,
+            "folds": sorted(self.folds, key=lambda fold: fold["fold"]),
+        }
+
+    def write_json(self, path: str) -> None:
+        """Write the run summary as a JSON report."""
+        _write_atomically(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Write the run summary in the Prometheus text format.
+
+        The file is replaced atomically, so it can be read by the node exporter's
+        textfile collector while the run is in progress.
+        """
+        summary = self.summary()
+        labels = f'dataset="{_escape(self.dataset_name)}"'
+        lines = []
+
+        def metric(name: str, help_text: str, samples: List[tuple]) -> None:
+            if not samples:
+                return
+            full_name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} gauge")
+            for extra_labels, value in samples:
+                lines.append(f"{full_name}{{{labels}{extra_labels}}} {value}")
+
+        metric(
+            "stage_seconds",
+            "Time spent in each pipeline stage.",
+            [
+                (f',stage="{_escape(stage)}"', seconds)
+                for stage, seconds in summary["stages"].items()
+            ],
+        )
+        for group, help_text in (
+            ("counters", "Run total."),
+            ("peaks", "Peak value over the run."),
+            ("throughput", "Throughput over the run."),
+        ):
+            for name, value in summary[group].items():
+                metric(name, help_text, [("", value)])
+        metric(
+            "fold_maximize_seconds",
+            "Time spent maximizing facility location per fold.",
+            [
+                (f',fold="{fold["fold"]}"', fold["maximize_seconds"])
+                for fold in summary["folds"]
+                if "maximize_seconds" in fold
+            ],
+        )
+        _write_atomically(path, "\n".join(lines) + "\n")
+
+
+def _escape(value: str) -> str:
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomically(path: str, content: str) -> None:
+    """Write a text file through a temporary file and a rename."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
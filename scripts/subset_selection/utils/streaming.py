@@ -0,0 +1,496 @@
+# Standard
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import copy
+import hashlib
+import io
+import json
+import logging
+import os
+
+# Third Party
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the bytes of JSON Lines or CSV input read and parsed at once
+BLOCK_BYTES = 64 * 1024**2
+# Selected rows further apart than this are read separately rather than by
+# reading through the rows between them
+MAX_GAP_BYTES = 1024**2
+# Bytes scanned at once while indexing a text file
+_SCAN_BYTES = 16 * 1024**2
+
+_FORMATS = {"json": "json", "jsonl": "json", "csv": "csv", "parquet": "parquet"}
+# Column holding the row numbers while a row filter is evaluated
+_ROW_NUMBER = "__row_number__"
+
+RowFilter = List[Union[Tuple, List]]
+
+
+def filter_expression(row_filter: RowFilter) -> Tuple[pads.Expression, List[str]]:
+    """
+    Turn a row filter in disjunctive normal form into a pyarrow expression.
+
+    Args:
+        row_filter (RowFilter): Conditions such as ``("lang", "==", "en")``, in the
+            format of ``pyarrow.parquet.read_table(filters=...)``: a list of
+            conditions that must all hold, or a list of such lists of which one
+            must hold. Conditions may be lists, e.g. when read from JSON.
+
+    Returns:
+        Tuple[pads.Expression, List[str]]: The expression and the columns it reads.
+    """
+    if row_filter and isinstance(row_filter[0][0], str):
+        row_filter = [row_filter]
+    conjunctions = [
+        [tuple(condition) for condition in conjunction] for conjunction in row_filter
+    ]
+    columns = list(
+        dict.fromkeys(
+            condition[0] for conjunction in conjunctions for condition in conjunction
+        )
+    )
+    return pq.filters_to_expression(conjunctions), columns
+
+
+def _index_text_file(path: str, quoted: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the byte offset and length of every non-empty record of a text file.
+
+    Records end at newlines. With ``quoted`` (CSV), newlines inside quoted
+    fields are skipped: they are preceded by an odd number of double quotes,
+    since quotes inside a quoted field are escaped by doubling them.
+
+    Args:
+        path (str): Path of the file.
+        quoted (bool): Whether records may contain quoted newlines.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Offsets and lengths of the records,
+        without their newlines.
+    """
+    offsets = [np.empty(0, dtype=np.int64)]
+    lengths = [np.empty(0, dtype=np.int64)]
+    record_start = 0
+    position = 0
+    quote_parity = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(_SCAN_BYTES):
+            data = np.frombuffer(chunk, dtype=np.uint8)
+            newlines = np.flatnonzero(data == ord("\n"))
+            if quoted:
+                # Only the parity matters, so the count may wrap around
+                parity = (
+                    np.cumsum(data == ord('"'), dtype=np.uint8) + quote_parity
+                ) & 1
+                newlines = newlines[parity[newlines] == 0]
+                quote_parity = int(parity[-1])
+            ends = newlines.astype(np.int64) + position
+            starts = np.concatenate(([record_start], ends[:-1] + 1))[: len(ends)]
+            offsets.append(starts)
+            lengths.append(ends - starts)
+            if len(ends):
+                record_start = int(ends[-1]) + 1
+            position += len(chunk)
+    # Last record without a trailing newline
+    if position > record_start:
+        offsets.append(np.array([record_start], dtype=np.int64))
+        lengths.append(np.array([position - record_start], dtype=np.int64))
+
+    offsets = np.concatenate(offsets)
+    lengths = np.concatenate(lengths)
+    non_empty = lengths > 0
+    return offsets[non_empty], lengths[non_empty]
+
+
+class StreamingDataset:
+    """
+    Rows of JSON Lines, CSV or Parquet files, read from disk on demand.
+
+    Only the location of every row is kept in memory: its file and the byte
+    offset and length of its record, or its row number in a Parquet file. Rows
+    are read and parsed in blocks of at most ``BLOCK_BYTES`` (one row group for
+    Parquet), so inputs much larger than memory can be processed, and selected
+    rows are fetched later with sequential reads.
+
+    The class provides the subset of the ``datasets.Dataset`` interface used by
+    the pipeline: ``len``, ``select``, ``select_columns``, iteration over rows
+    as dictionaries and ``iter(batch_size)`` over column batches. Selections are
+    views sharing the files, which are cheap to send to worker processes.
+    """
+
+    def __init__(
+        self, input_files: List[str], row_filter: Optional[RowFilter] = None
+    ) -> None:
+        """
+        Index the rows of the input files.
+
+        Args:
+            input_files (List[str]): Files to read, in order; they must all have
+                the same format, and CSV files the same header.
+            row_filter (Optional[RowFilter]): Only index the rows matching this
+                filter, see ``filter_expression``. Parquet inputs only.
+        """
+        formats = {_FORMATS.get(path.split(".")[-1]) for path in input_files}
+        if None in formats or len(formats) != 1:
+            raise ValueError(
+                "Streaming input files must all be JSON Lines, CSV or Parquet files"
+            )
+        self.format = formats.pop()
+        if row_filter is not None and self.format != "parquet":
+            raise ValueError("row_filter is only supported for Parquet inputs")
+        self.files = list(input_files)
+        self.header: Optional[bytes] = None
+        # Columns to read, or None for all of them
+        self.columns: Optional[List[str]] = None
+
+        file_ids, offsets, lengths = [], [], []
+        for file_id, path in enumerate(self.files):
+            if self.format == "parquet":
+                if row_filter is None:
+                    num_rows = pq.ParquetFile(path).metadata.num_rows
+                    file_offsets = np.arange(num_rows, dtype=np.int64)
+                else:
+                    file_offsets = filter_parquet_rows(path, row_filter)
+                file_lengths = np.zeros(len(file_offsets), dtype=np.int64)
+            else:
+                file_offsets, file_lengths = _index_text_file(
+                    path, quoted=self.format == "csv"
+                )
+                if len(file_offsets):
+                    first_record = self._read_record(
+                        path, file_offsets[0], file_lengths[0]
+                    )
+                    if self.format == "json" and first_record.lstrip()[:1] == b"[":
+                        raise ValueError(
+                            f"Streaming requires JSON Lines, but {path} holds "
+                            "a JSON array"
+                        )
+                    if self.format == "csv":
+                        if self.header is not None and first_record != self.header:
+                            raise ValueError(
+                                f"Header of {path} differs from {self.files[0]}"
+                            )
+                        self.header = first_record
+                        file_offsets, file_lengths = file_offsets[1:], file_lengths[1:]
+            file_ids.append(np.full(len(file_offsets), file_id, dtype=np.int32))
+            offsets.append(file_offsets)
+            lengths.append(file_lengths.astype(np.uint32))
+
+        self.file_ids = np.concatenate(file_ids)
+        self.offsets = np.concatenate(offsets)
+        self.lengths = np.concatenate(lengths)
+        logger.info(f"Indexed {len(self)} rows of {len(self.files)} file(s)")
+
+    @staticmethod
+    def _read_record(path: str, offset: int, length: int) -> bytes:
+        """Read one record of a text file."""
+        with open(path, "rb") as f:
+            f.seek(int(offset))
+            return f.read(int(length))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def select(
+        self, indices: Union[range, List[int], np.ndarray]
+    ) -> "StreamingDataset":
+        """
+        Select rows by index, like ``datasets.Dataset.select``.
+
+        Args:
+            indices: Indices of the rows to keep, in the order to keep them in.
+                Rows are read fastest in increasing order.
+
+        Returns:
+            StreamingDataset: A view over the selected rows.
+        """
+        if isinstance(indices, range) and indices.step == 1:
+            key = slice(indices.start, indices.stop)
+        else:
+            key = np.asarray(indices, dtype=np.int64)
+        view = copy.copy(self)
+        view.file_ids = self.file_ids[key]
+        view.offsets = self.offsets[key]
+        view.lengths = self.lengths[key]
+        return view
+
+    def select_columns(self, columns: Iterable[str]) -> "StreamingDataset":
+        """
+        Read only some of the columns, like ``datasets.Dataset.select_columns``.
+
+        Columns missing from the input are ignored. Parquet files are only read
+        for the selected columns; JSON Lines and CSV records still have to be
+        read whole, but only the selected fields are kept.
+
+        Args:
+            columns (Iterable[str]): Names of the columns to read.
+
+        Returns:
+            StreamingDataset: A view reading only the selected columns.
+        """
+        view = copy.copy(self)
+        view.columns = list(dict.fromkeys(columns))
+        if self.format == "parquet":
+            names = pq.read_schema(self.files[0]).names
+            view.columns = [name for name in names if name in view.columns]
+        elif self.format == "csv":
+            names = pacsv.read_csv(io.BytesIO(self.header + b"\n")).column_names
+            view.columns = [name for name in names if name in view.columns]
+        return view
+
+    def fingerprint(self) -> str:
+        """
+        Identify the rows read from the metadata of the input files, like
+        ``datasets.Dataset._fingerprint``.
+
+        The fingerprint covers the path, size and modification time of every
+        input file, the selected columns and the location of every row, so it
+        changes whenever an input file is rewritten, without reading the files.
+        """
+        digest = hashlib.sha256()
+        for path in self.files:
+            stat = os.stat(path)
+            digest.update(
+                json.dumps(
+                    [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+                ).encode("utf-8")
+            )
+        digest.update(json.dumps(self.columns).encode("utf-8"))
+        for array in (self.file_ids, self.offsets, self.lengths):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def digest(self) -> str:
+        """
+        Hash the content of the rows.
+
+        JSON Lines and CSV records are hashed verbatim, without parsing them, so
+        the digest also covers the columns that are not selected. Parquet rows
+        are hashed with ``table_digest``.
+        """
+        if self.format == "parquet":
+            tables = list(self._blocks())
+            if not tables:
+                return hashlib.sha256().hexdigest()
+            return table_digest(pa.concat_tables(tables))
+        digest = hashlib.sha256()
+        for records in self._blocks():
+            for record in records:
+                digest.update(record + b"\n")
+        return digest.hexdigest()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for block in self._blocks():
+            yield from self._decode(block)
+
+    def iter(self, batch_size: int) -> Iterator[Dict[str, List[Any]]]:
+        """
+        Iterate over batches of rows, like ``datasets.Dataset.iter``.
+
+        Args:
+            batch_size (int): Number of rows per batch.
+
+        Yields:
+            Dict[str, List[Any]]: Values of every column in the batch.
+        """
+        rows = []
+        for row in self:
+            rows.append(row)
+            if len(rows) == batch_size:
+                yield _to_columns(rows)
+                rows = []
+        if rows:
+            yield _to_columns(rows)
+
+    def write(self, output_file: str) -> None:
+        """
+        Write the rows to a file in the format of the input files.
+
+        JSON Lines and CSV records are copied verbatim, without parsing them.
+
+        Args:
+            output_file (str): Path of the file to write.
+        """
+        if self.format == "parquet":
+            schema = pq.ParquetFile(self.files[0]).schema_arrow
+            with pq.ParquetWriter(output_file, schema) as writer:
+                for table in self._blocks():
+                    writer.write_table(table)
+            return
+        with open(output_file, "wb") as f:
+            if self.header is not None:
+                f.write(self.header + b"\n")
+            for records in self._blocks():
+                f.write(b"\n".join(records) + b"\n")
+
+    def _decode(self, block: Union[List[bytes], pa.Table]) -> List[Dict[str, Any]]:
+        """Parse the rows of a block."""
+        if self.format == "parquet":
+            return block.to_pylist()
+        if self.format == "json":
+            rows = [json.loads(record) for record in block]
+            if self.columns is not None:
+                rows = [
+                    {key: row[key] for key in self.columns if key in row}
+                    for row in rows
+                ]
+            return rows
+        # Empty fields are missing values, as when loading with `datasets`
+        return pacsv.read_csv(
+            io.BytesIO(b"\n".join([self.header, *block])),
+            convert_options=pacsv.ConvertOptions(
+                strings_can_be_null=True, include_columns=self.columns
+            ),
+        ).to_pylist()
+
+    def _blocks(self) -> Iterator[Union[List[bytes], pa.Table]]:
+        """
+        Read the rows in order, in blocks of rows that lie close together in one file.
+
+        Yields:
+            The raw records of the rows in a block of JSON Lines or CSV input, or
+            a table of the rows in a block of Parquet input.
+        """
+        if not len(self):
+            return
+        if self.format == "parquet":
+            yield from self._parquet_blocks()
+            return
+
+        ends = self.offsets + self.lengths
+        # Rows can share a read if they follow each other closely in one file
+        breaks = (
+            np.flatnonzero(
+                (self.file_ids[1:] != self.file_ids[:-1])
+                | (self.offsets[1:] < ends[:-1])
+                | (self.offsets[1:] - ends[:-1] > MAX_GAP_BYTES)
+            )
+            + 1
+        )
+        start = 0
+        current_file_id, f = None, None
+        try:
+            for run_end in np.append(breaks, len(self)):
+                while start < run_end:
+                    # Rows of the run that fit into one block, at least one
+                    end = start + max(
+                        1,
+                        int(
+                            np.searchsorted(
+                                ends[start:run_end],
+                                self.offsets[start] + BLOCK_BYTES,
+                                side="right",
+                            )
+                        ),
+                    )
+                    file_id = int(self.file_ids[start])
+                    if file_id != current_file_id:
+                        if f is not None:
+                            f.close()
+                        current_file_id, f = file_id, open(self.files[file_id], "rb")
+                    block_start = int(self.offsets[start])
+                    f.seek(block_start)
+                    data = f.read(int(ends[end - 1]) - block_start)
+                    yield [
+                        data[offset : offset + length]
+                        for offset, length in zip(
+                            (self.offsets[start:end] - block_start).tolist(),
+                            self.lengths[start:end].tolist(),
+                            strict=True,
+                        )
+                    ]
+                    start = end
+        finally:
+            if f is not None:
+                f.close()
+
+    def _parquet_blocks(self) -> Iterator[pa.Table]:
+        """Read the rows in order, one block per row group they fall into."""
+        file_breaks = np.flatnonzero(self.file_ids[1:] != self.file_ids[:-1]) + 1
+        for run_start, run_end in zip(
+            np.r_[0, file_breaks], np.r_[file_breaks, len(self)], strict=True
+        ):
+            parquet_file = pq.ParquetFile(self.files[self.file_ids[run_start]])
+            metadata = parquet_file.metadata
+            group_starts = np.cumsum(
+                [0]
+                + [
+                    metadata.row_group(i).num_rows
+                    for i in range(metadata.num_row_groups)
+                ]
+            )
+            rows = self.offsets[run_start:run_end]
+            groups = np.searchsorted(group_starts, rows, side="right") - 1
+            group_breaks = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+            for start, end in zip(
+                np.r_[0, group_breaks], np.r_[group_breaks, len(rows)], strict=True
+            ):
+                group = int(groups[start])
+                yield parquet_file.read_row_group(group, columns=self.columns).take(
+                    rows[start:end] - group_starts[group]
+                )
+
+
+def table_digest(table: pa.Table) -> str:
+    """
+    Hash the content of an Arrow table.
+
+    The table is serialized as uncompressed Parquet with a single row group,
+    which unlike the Arrow IPC format depends only on the values, not on how
+    the rows were split into chunks or whether a column without nulls carries
+    a validity bitmap.
+    """
+    sink = pa.BufferOutputStream()
+    pq.write_table(
+        table,
+        sink,
+        row_group_size=max(1, len(table)),
+        compression="none",
+        use_dictionary=False,
+        write_statistics=False,
+    )
+    return hashlib.sha256(sink.getvalue()).hexdigest()
+
+
+def filter_parquet_rows(path: str, row_filter: RowFilter) -> np.ndarray:
+    """
+    Find the numbers of the rows of a Parquet file that match a row filter.
+
+    Row groups whose statistics rule out a match are skipped, and of the others
+    only the columns used by the filter are read.
+
+    Args:
+        path (str): Path of the Parquet file.
+        row_filter (RowFilter): Filter to apply, see ``filter_expression``.
+
+    Returns:
+        np.ndarray: Numbers of the matching rows, in increasing order.
+    """
+    expression, columns = filter_expression(row_filter)
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    group_starts = np.cumsum(
+        [0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    )
+    fragment = next(pads.dataset(path, format="parquet").get_fragments())
+    rows = [np.empty(0, dtype=np.int64)]
+    for group_fragment in fragment.split_by_row_group(filter=expression):
+        group = group_fragment.row_groups[0].id
+        table = parquet_file.read_row_group(group, columns=columns)
+        table = table.append_column(
+            _ROW_NUMBER,
+            pa.array(np.arange(group_starts[group], group_starts[group + 1])),
+        )
+        rows.append(table.filter(expression)[_ROW_NUMBER].to_numpy())
+    return np.concatenate(rows)
+
+
+def _to_columns(rows: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """Turn rows into columns, with None for keys missing from a row."""
+    keys = dict.fromkeys(key for row in rows for key in row)
+    return {key: [row.get(key) for row in rows] for key in keys}
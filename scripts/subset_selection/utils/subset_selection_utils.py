@@ -1,11 +1,15 @@
 # Standard
 from functools import wraps
-from typing import Optional, Union
+from typing import Optional, Tuple, Union
 import gc
 import logging
+import os
+import tempfile
 import time
 
 # Third Party
+from scipy import sparse
+import numpy as np
 from torch import Tensor
 from torch.nn import functional as F
 import torch
@@ -25,7 +29,13 @@ def retry_on_exception(func):
     @wraps(func)
     def wrapper(self, *args, **kwargs):
         last_exception = None
-        for attempt in range(self.config.system.max_retries):
+        # A rank of a distributed run cannot retry alone, as the other ranks
+        # would be waiting in a different collective; the job is relaunched
+        # instead and resumes from the shard checkpoints
+        max_retries = (
+            1 if torch.distributed.is_initialized() else self.config.system.max_retries
+        )
+        for attempt in range(max_retries):
             try:
                 return func(self, *args, **kwargs)
             except torch.cuda.OutOfMemoryError as e:
@@ -51,7 +61,7 @@ def retry_on_exception(func):
                 last_exception = e
                 logger.error(f"Index error on attempt {attempt + 1}: {str(e)}")
 
-            if attempt < self.config.system.max_retries - 1:
+            if attempt < max_retries - 1:
                 logger.info(f"Retrying in {self.config.system.retry_delay} seconds...")
                 time.sleep(self.config.system.retry_delay)
                 gc.collect()
@@ -63,14 +73,128 @@ def retry_on_exception(func):
     return wrapper
 
 
-def get_default_num_gpus(testing_mode: bool = False) -> int:
+def publish_array(array: np.ndarray, directory: str, chunk_size: int = 65536) -> str:
+    """
+    Write an array once to a temporary ``.npy`` file that worker processes can
+    memory-map instead of receiving a pickled copy.
+
+    Args:
+        array (np.ndarray): The array to publish.
+        directory (str): Directory in which the file is created.
+        chunk_size (int): Number of rows copied at a time.
+
+    Returns:
+        str: Path of the published file. The caller is responsible for removing it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".npy", dir=directory)
+    os.close(fd)
+    published = np.lib.format.open_memmap(
+        path, mode="w+", dtype=array.dtype, shape=array.shape
+    )
+    for start in range(0, array.shape[0], chunk_size):
+        published[start : start + chunk_size] = array[start : start + chunk_size]
+    published.flush()
+    del published
+    return path
+
+
+def attach_array(path: str) -> np.ndarray:
+    """
+    Memory-map an array published with publish_array.
+
+    The mapping is copy-on-write, so pages are shared between processes and read
+    on demand, and the result can be wrapped with ``torch.from_numpy`` without a copy.
+    """
+    return np.load(path, mmap_mode="c")
+
+
+def get_num_available_cores() -> int:
+    """Number of CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_available_memory_bytes() -> int:
+    """Host memory available to new allocations, from /proc/meminfo if possible."""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_default_num_cpu_workers(
+    bytes_per_worker: int, threads_per_worker: int = 4, reserved_workers: int = 0
+) -> int:
+    """
+    Get the number of CPU workers that fit the available cores and memory.
+
+    Args:
+        bytes_per_worker (int): Peak host memory needed by one worker.
+        threads_per_worker (int): Cores given to each CPU worker.
+        reserved_workers (int): Workers already running (e.g. one per GPU), each
+            taking one core and ``bytes_per_worker`` of memory.
+    """
+    by_cores = (get_num_available_cores() - reserved_workers) // threads_per_worker
+    by_memory = get_available_memory_bytes() // max(1, bytes_per_worker)
+    by_memory -= reserved_workers
+    return max(0, min(by_cores, by_memory))
+
+
+def get_cpu_worker_split(
+    num_workers: int, bytes_per_worker: int, threads_per_worker: int = 8
+) -> Tuple[int, int]:
+    """
+    Split the available cores between CPU worker processes.
+
+    Args:
+        num_workers (int): Number of workers, or -1 to size them from the
+            available cores and memory.
+        bytes_per_worker (int): Peak host memory needed by one worker.
+        threads_per_worker (int): Cores per worker when sizing automatically.
+
+    Returns:
+        Tuple[int, int]: Number of workers, at least 1, and threads per worker.
+    """
+    if num_workers < 0:
+        num_workers = get_default_num_cpu_workers(bytes_per_worker, threads_per_worker)
+    num_workers = max(1, num_workers)
+    return num_workers, max(1, get_num_available_cores() // num_workers)
+
+
+def pin_cpu_worker(worker_idx: int, num_threads: int) -> None:
+    """
+    Restrict a CPU worker to its own block of cores.
+
+    Worker ``i`` runs on the ``i``-th block of ``num_threads`` available cores
+    (wrapping around if there are more workers than blocks), so that workers
+    do not migrate onto each other's cores, and torch uses one thread per core.
+    """
+    torch.set_num_threads(num_threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        start = worker_idx * num_threads % len(cores)
+        os.sched_setaffinity(0, cores[start : start + num_threads])
+
+
+def get_default_num_gpus(testing_mode: bool = False, cpu_mode: bool = False) -> int:
     """
     Get the default number of GPUs based on available CUDA devices.
 
     Args:
         testing_mode (bool): If True, allows CPU usage with warnings. For testing only.
+        cpu_mode (bool): If True, allows running on CPU workers when there are
+            no GPUs. Their number is chosen when encoding.
     """
     if not torch.cuda.is_available():
+        if cpu_mode:
+            logger.info("No CUDA devices detected. Running on CPU workers.")
+            return 1
         if testing_mode:
             logger.warning(
                 "No CUDA devices detected. Running in testing mode with CPU. "
@@ -83,6 +207,24 @@ def get_default_num_gpus(testing_mode: bool = False) -> int:
     return torch.cuda.device_count()
 
 
+def _calculate_metric(a: Tensor, b: Tensor, metric: str, kw: float) -> Tensor:
+    """Compute the pairwise metric between two blocks of vectors."""
+    if metric in ["cosine", "dot"]:
+        return torch.mm(a, b.T)
+    if metric == "euclidean":
+        distances = torch.cdist(a, b, p=2)
+        similarities = 1 / (1 + distances**2)
+        return similarities
+    if metric == "rbf":
+        distance = torch.cdist(a, b)
+        squared_distance = distance**2
+        avg_dist = torch.mean(squared_distance)
+        torch.div(squared_distance, kw * avg_dist, out=squared_distance)
+        torch.exp(-squared_distance, out=squared_distance)
+        return squared_distance
+    raise ValueError(f"Unknown metric: {metric}")
+
+
 def compute_pairwise_dense(
     tensor1: Tensor,
     tensor2: Optional[Tensor] = None,
@@ -111,22 +253,6 @@ def compute_pairwise_dense(
             F.normalize(tensor2, p=2, dim=1),
         )
 
-    def calculate_metric(a: Tensor, b: Tensor, metric: str, kw: float) -> Tensor:
-        if metric in ["cosine", "dot"]:
-            return torch.mm(a, b.T)
-        if metric == "euclidean":
-            distances = torch.cdist(a, b, p=2)
-            similarities = 1 / (1 + distances**2)
-            return similarities
-        if metric == "rbf":
-            distance = torch.cdist(a, b)
-            squared_distance = distance**2
-            avg_dist = torch.mean(squared_distance)
-            torch.div(squared_distance, kw * avg_dist, out=squared_distance)
-            torch.exp(-squared_distance, out=squared_distance)
-            return squared_distance
-        raise ValueError(f"Unknown metric: {metric}")
-
     for i in range(0, n_samples1, batch_size):
         end_i = min(i + batch_size, n_samples1)
         rows = tensor1[i:end_i]
@@ -134,7 +260,7 @@ def compute_pairwise_dense(
         for j in range(0, n_samples2, batch_size):
             end_j = min(j + batch_size, n_samples2)
             cols = tensor2[j:end_j]
-            batch_results = calculate_metric(rows, cols, metric, kw).cpu()
+            batch_results = _calculate_metric(rows, cols, metric, kw).cpu()
             results[i:end_i, j:end_j] = batch_results
 
     if scaling == "min-max":
@@ -144,4 +270,207 @@ def compute_pairwise_dense(
     elif scaling == "additive":
         results = (results + 1) / 2
 
-    return results
\ No newline at end of file
+    return results
+
+
+def compute_pairwise_dense_streaming(
+    tensor1: Tensor,
+    tensor2: Optional[Tensor] = None,
+    out: Optional[Union[np.ndarray, Tensor]] = None,
+    batch_size: int = 10000,
+    metric: str = "cosine",
+    device: Optional[Union[str, torch.device]] = None,
+    scaling: Optional[str] = None,
+    kw: float = 0.1,
+) -> Union[np.ndarray, Tensor]:
+    """
+    Compute a pairwise metric tile by tile straight into a preallocated buffer.
+
+    Unlike compute_pairwise_dense, no intermediate full-size tensor is created:
+    scaling is applied to each tile on the compute device and the tile is copied
+    directly into its slice of ``out``, so the output buffer is the only
+    full-size matrix held at any time. ``out`` may be a regular array or an
+    ``np.memmap`` to keep the matrix on disk, or a tensor to keep it on the
+    compute device.
+
+    Args:
+        tensor1 (Tensor): Row vectors of shape (n1, d).
+        tensor2 (Optional[Tensor]): Column vectors of shape (n2, d). Defaults to tensor1.
+        out (Optional[Union[np.ndarray, Tensor]]): float32 buffer of shape (n1, n2).
+            Allocated as an np.ndarray if not given.
+        batch_size (int): Number of rows/columns per tile.
+        metric (str): Similarity metric ("cosine", "dot", "euclidean" or "rbf").
+        device (Optional[Union[str, torch.device]]): Device used for the computation.
+        scaling (Optional[str]): Optional "min-max" or "additive" scaling of the values.
+        kw (float): Kernel width for the "rbf" metric.
+
+    Returns:
+        Union[np.ndarray, Tensor]: The filled ``out`` buffer.
+    """
+    assert batch_size > 0, "Batch size must be positive."
+
+    if not device:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if tensor2 is None:
+        tensor2 = tensor1
+
+    tensor1, tensor2 = tensor1.to(device), tensor2.to(device)
+    n_samples1, n_samples2 = tensor1.size(0), tensor2.size(0)
+
+    if out is None:
+        out = np.empty((n_samples1, n_samples2), dtype=np.float32)
+    expected_dtype = torch.float32 if isinstance(out, Tensor) else np.float32
+    if tuple(out.shape) != (n_samples1, n_samples2) or out.dtype != expected_dtype:
+        raise ValueError(
+            f"Output buffer must be float32 with shape {(n_samples1, n_samples2)}, "
+            f"got {out.dtype} with shape {out.shape}"
+        )
+
+    if metric == "cosine":
+        tensor1, tensor2 = (
+            F.normalize(tensor1, p=2, dim=1),
+            F.normalize(tensor2, p=2, dim=1),
+        )
+
+    min_val, max_val = float("inf"), float("-inf")
+    for i in range(0, n_samples1, batch_size):
+        end_i = min(i + batch_size, n_samples1)
+        rows = tensor1[i:end_i]
+
+        for j in range(0, n_samples2, batch_size):
+            end_j = min(j + batch_size, n_samples2)
+            cols = tensor2[j:end_j]
+            batch_results = _calculate_metric(rows, cols, metric, kw).float()
+            if scaling == "min-max":
+                min_val = min(min_val, batch_results.min().item())
+                max_val = max(max_val, batch_results.max().item())
+            elif scaling == "additive":
+                batch_results.add_(1).div_(2)
+            if isinstance(out, Tensor):
+                out[i:end_i, j:end_j].copy_(batch_results)
+            else:
+                torch.from_numpy(out[i:end_i, j:end_j]).copy_(batch_results)
+
+    if scaling == "min-max" and max_val != min_val:
+        # Rescale in place, one block of rows at a time
+        for i in range(0, n_samples1, batch_size):
+            block = out[i : i + batch_size]
+            block -= min_val
+            block /= max_val - min_val
+
+    return out
+
+
+def compute_pairwise_sparse_knn(
+    tensor1: Tensor,
+    num_neighbors: int,
+    tensor2: Optional[Tensor] = None,
+    batch_size: int = 10000,
+    metric: str = "cosine",
+    device: Optional[Union[str, torch.device]] = None,
+    scaling: Optional[str] = None,
+    kw: float = 0.1,
+) -> Tuple[Tensor, Tensor]:
+    """
+    Compute the top-k most similar columns for every row without materializing
+    the full pairwise matrix.
+
+    Rows are processed in blocks of ``batch_size`` and each block is compared
+    against the columns one tile at a time, keeping only a running top-k, so
+    peak memory is ``batch_size * (batch_size + num_neighbors)`` per block.
+
+    Args:
+        tensor1 (Tensor): Row vectors of shape (n1, d).
+        num_neighbors (int): Number of neighbours to keep per row.
+        tensor2 (Optional[Tensor]): Column vectors of shape (n2, d). Defaults to tensor1.
+        batch_size (int): Number of rows/columns per tile.
+        metric (str): Similarity metric ("cosine", "dot", "euclidean" or "rbf").
+        device (Optional[Union[str, torch.device]]): Device used for the computation.
+        scaling (Optional[str]): Optional "min-max" or "additive" scaling of the values.
+        kw (float): Kernel width for the "rbf" metric.
+
+    Returns:
+        Tuple[Tensor, Tensor]: CPU tensors of shape (n1, k) holding the neighbour
+        similarities (sorted in descending order) and their column indices.
+    """
+    assert batch_size > 0, "Batch size must be positive."
+    assert num_neighbors > 0, "Number of neighbors must be positive."
+
+    if not device:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if tensor2 is None:
+        tensor2 = tensor1
+
+    tensor1, tensor2 = tensor1.to(device), tensor2.to(device)
+    n_samples1, n_samples2 = tensor1.size(0), tensor2.size(0)
+    num_neighbors = min(num_neighbors, n_samples2)
+
+    if metric == "cosine":
+        tensor1, tensor2 = (
+            F.normalize(tensor1, p=2, dim=1),
+            F.normalize(tensor2, p=2, dim=1),
+        )
+
+    knn_values = torch.empty(n_samples1, num_neighbors, dtype=torch.float32)
+    knn_indices = torch.empty(n_samples1, num_neighbors, dtype=torch.long)
+    min_val, max_val = float("inf"), float("-inf")
+
+    for i in range(0, n_samples1, batch_size):
+        end_i = min(i + batch_size, n_samples1)
+        rows = tensor1[i:end_i]
+        best_values = torch.empty(end_i - i, 0, device=device)
+        best_indices = torch.empty(end_i - i, 0, dtype=torch.long, device=device)
+
+        for j in range(0, n_samples2, batch_size):
+            end_j = min(j + batch_size, n_samples2)
+            cols = tensor2[j:end_j]
+            batch_results = _calculate_metric(rows, cols, metric, kw).float()
+            if scaling == "min-max":
+                min_val = min(min_val, batch_results.min().item())
+                max_val = max(max_val, batch_results.max().item())
+
+            col_indices = torch.arange(j, end_j, device=device).expand(end_i - i, -1)
+            candidate_values = torch.cat([best_values, batch_results], dim=1)
+            candidate_indices = torch.cat([best_indices, col_indices], dim=1)
+            k = min(num_neighbors, candidate_values.size(1))
+            best_values, top_positions = torch.topk(candidate_values, k, dim=1)
+            best_indices = torch.gather(candidate_indices, 1, top_positions)
+
+        knn_values[i:end_i] = best_values.cpu()
+        knn_indices[i:end_i] = best_indices.cpu()
+
+    if scaling == "min-max":
+        if max_val != min_val:
+            knn_values = (knn_values - min_val) / (max_val - min_val)
+    elif scaling == "additive":
+        knn_values = (knn_values + 1) / 2
+
+    return knn_values, knn_indices
+
+
+def build_sparse_knn_kernel(
+    knn_values: Tensor, knn_indices: Tensor, num_columns: int
+) -> sparse.csr_matrix:
+    """
+    Convert per-row nearest neighbours into a CSR similarity kernel.
+
+    Args:
+        knn_values (Tensor): Neighbour similarities of shape (n, k).
+        knn_indices (Tensor): Neighbour column indices of shape (n, k).
+        num_columns (int): Number of columns of the kernel.
+
+    Returns:
+        sparse.csr_matrix: Kernel of shape (n, num_columns) with k entries per row.
+    """
+    num_rows, num_neighbors = knn_values.shape
+    indptr = torch.arange(0, num_rows * num_neighbors + 1, num_neighbors)
+    return sparse.csr_matrix(
+        (
+            knn_values.reshape(-1).numpy(),
+            knn_indices.reshape(-1).numpy(),
+            indptr.numpy(),
+        ),
+        shape=(num_rows, num_columns),
+    )